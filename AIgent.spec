@@ -33,8 +33,6 @@ a = Analysis(
         'pkg_resources', # setuptools 的一部分，运行时有时需要，先保留
         'wheel',    # 打包工具，运行时不需要
         # 其他不需要的模块 - 保留排除这些，比较确定不需要
-        'asyncio', # 异步库，如果你代码没用async/await可以排除，先保留
-        'concurrent', # 并发库，如果没用线程/进程池可以排除，先保留
         'curses',    # 终端UI库，大概率不需要
         'lib2to3',  # Python2to3转换工具，不需要
         'pydoc_data',# 文档数据，不需要
@@ -1,8 +1,17 @@
+import asyncio
+import functools
+import os
+import threading
 import requests
 import json
+import re
 import time
-import random
-import streamlit as st
+from concurrent.futures import Future, ThreadPoolExecutor
+import http_client
+from key_pool import parse_retry_after
+from context_builder import SUMMARY_MAX_TOKENS, estimate_tokens
+from telemetry import new_call_record, finish_call_record
+import latency_tracker
 
 # API配置 - 定义了与AI模型通信的服务器地址
 # 这是发送AI请求的目标网址，所有的AI对话都会发送到这个地址
@@ -11,372 +20,998 @@ API_URL = "https://api.siliconflow.cn/v1/chat/completions"
 # 模型配置 - 定义了可用的AI模型及其参数设置
 # 每个模型都有一个最大令牌数限制，这决定了AI回答的最大长度
 # 令牌(token)是AI处理文本的基本单位，大约相当于1-2个汉字或0.75个英文单词
+# context_budget是开启上下文压缩后，之前步骤的输出最多可以占用的令牌数，按模型的上下文窗口留出余量
 MODEL_CONFIGS = {
-    "Qwen/QwQ-32B": {"max_tokens": 8192},  # 通义千问QwQ模型，可输出最多8192个令牌
-    "Pro/deepseek-ai/DeepSeek-R1": {"max_tokens": 8192},  # DeepSeek-R1模型，可输出最多8192个令牌
-    "Qwen/Qwen2.5-72B-Instruct-128K": {"max_tokens": 4096},  # 通义千问2.5大模型，可输出最多4096个令牌
-    "Pro/deepseek-ai/DeepSeek-V3": {"max_tokens": 4096}  # DeepSeek-V3模型，可输出最多4096个令牌
+    "Qwen/QwQ-32B": {"max_tokens": 8192, "context_budget": 12000},  # 通义千问QwQ模型，可输出最多8192个令牌
+    "Pro/deepseek-ai/DeepSeek-R1": {"max_tokens": 8192, "context_budget": 24000},  # DeepSeek-R1模型，可输出最多8192个令牌
+    "Qwen/Qwen2.5-72B-Instruct-128K": {"max_tokens": 4096, "context_budget": 48000},  # 通义千问2.5大模型，可输出最多4096个令牌
+    "Pro/deepseek-ai/DeepSeek-V3": {"max_tokens": 4096, "context_budget": 24000}  # DeepSeek-V3模型，可输出最多4096个令牌
 }
 
 # 指令优化模型 - 用于优化用户输入的指令的专用模型
 # 这个模型会分析用户的原始指令，并将其改写为更加详细、明确的形式
 INPUT_OPTIMIZER_MODEL = "Pro/deepseek-ai/DeepSeek-R1-Distill-Qwen-32B"
 
-def call_qwq_api(prompt, initial_prompt="", chain_input="", all_previous_outputs=None):
-    # 构建API请求消息列表
-    messages = []
-    # 如果提供了初始提示，将其作为系统消息添加到列表中
-    # 系统消息用于设定AI的行为规则、角色和限制
-    if initial_prompt:
-        messages.append({"role": "system", "content": initial_prompt})
-    
-    # 处理链式输入：如果存在前一个AI的输出，将其与当前prompt组合
-    # 这允许多个AI模型协作完成复杂任务，前一个AI的输出可以作为下一个AI的输入
-    if all_previous_outputs and len(all_previous_outputs) > 0:
-        # 如果提供了所有之前的输出，将它们全部包含在提示中
-        # 这种方式可以让AI看到整个处理过程中的所有中间结果
-        previous_outputs_text = "\n\n".join([f"第{i+1}个AI的输出：\n{output}" for i, output in enumerate(all_previous_outputs)])
-        prompt = f"之前所有AI的输出：\n{previous_outputs_text}\n\n你的任务：\n{prompt}"
-    elif chain_input:
-        # 向后兼容：如果只提供了单个chain_input
-        # 这是一种简化的链式调用方式，只考虑前一个AI的输出
-        prompt = f"前一个AI的输出：\n{chain_input}\n\n你的任务：\n{prompt}"
-    
-    # 添加用户消息到列表中
-    # 用户消息包含实际的问题或指令，是AI需要回答或执行的内容
-    messages.append({"role": "user", "content": prompt})
-    
-    # 获取当前选择的模型配置
-    # 不同的模型有不同的参数设置，如最大输出长度
-    model_config = MODEL_CONFIGS[st.session_state.selected_model]
-    
-    # 构建API请求参数
-    # 这些参数控制AI生成回答的方式，如温度（创造性）、最大长度等
-    payload = {
-        "model": st.session_state.selected_model,  # 使用用户选择的AI模型
-        "messages": messages,  # 包含系统提示和用户问题的消息列表
-        "stream": False,  # 不使用流式输出（即等待完整回答后一次性返回）
-        "max_tokens": model_config["max_tokens"],  # 设置回答的最大长度
-        "stop": None,  # 不设置特定的停止词
-        "temperature": 0.7,  # 温度参数，控制回答的随机性/创造性，0.7是适中的值
-        "top_p": 0.7,  # 控制词汇选择的多样性，与temperature配合使用
-        "top_k": 50,  # 每一步只考虑概率最高的前50个词
-        "frequency_penalty": 0.5,  # 降低重复词汇的概率，避免AI重复自己
-        "n": 1,  # 只生成一个回答
-        "response_format": {"type": "text"}  # 指定回答格式为纯文本
-    }
-    
-    # 获取当前应该使用的API密钥
-    # 系统支持两个API密钥，随机选择一个使用，增加可靠性
-    st.session_state.current_api = random.randint(0, 1)
-    current_api_key = st.session_state.api_key if st.session_state.current_api == 0 else st.session_state.api_key2
-    
-    # 设置HTTP请求头，包含认证信息和内容类型
-    headers = {
-        "Authorization": f"Bearer {current_api_key}",  # 使用Bearer令牌认证方式
-        "Content-Type": "application/json"  # 指定请求内容为JSON格式
+# 指令优化的系统提示 - 详细说明了指令优化助手的角色和任务要求
+OPTIMIZER_SYSTEM_PROMPT = """你是一个专业的指令优化助手。你的任务是分析用户的原始指令，并将其扩展为更加详细、明确和结构化的指令。
+请确保优化后的指令：
+1. 保留原始指令的核心意图和目标
+2. 添加必要的上下文和背景信息
+3. 明确任务的具体步骤和预期输出
+4. 消除歧义和模糊表述
+5. 使用清晰的结构和格式
+6. 必须确保是LLM可以制作的任务
+7. 此AI无法上网，请确保你的指令准确无误
+8. 理解用户想要真是的表达信息
+9. 不要加自己的东西
+
+请直接输出优化后的指令，不要添加解释或其他内容。"""
+
+# 融合规划的附加要求 - 指令优化和步骤规划在同一次调用中完成时，要求回答先给出优化后的指令，再按规划格式给出步骤
+FUSED_PLAN_INSTRUCTION = """这一次你收到的是用户的原始指令。请先在心里把它优化成更详细、明确的指令（要求见下文），再根据优化后的指令拆分步骤。
+回答分为两部分：第一部分以单独一行的【优化后的指令】开头，接着写出优化后的完整指令；第二部分以单独一行的【步骤】开头，之后完全按照上面对步骤的格式要求输出。除了这两部分不要输出其他内容。"""
+
+# 融合规划回答中两部分的标记
+FUSED_OPTIMIZED_MARK = "【优化后的指令】"
+FUSED_STEPS_MARK = "【步骤】"
+
+# 规划格式：text为第一行写步骤数、之后每行一个步骤（默认）；json为只输出一个JSON对象，步骤的内容可以随意换行
+# 解析时两种格式都兼容，见parse_plan
+PLAN_FORMATS = ("text", "json")
+
+# json格式下追加到规划prompt后面的要求，代替上面关于第一行步骤数和每行一个步骤的要求；并行模式下再要求给出depends_on
+JSON_PLAN_INSTRUCTION = """上面关于回答格式的要求（第一行写步骤数、每行一个步骤、用空行隔开）全部改为：只输出一个JSON对象，不要输出其他文字，也不要用```包起来。格式为{"steps": [{"prompt": "第一步的完整prompt"}, {"prompt": "第二步的完整prompt"}]}，steps按执行顺序排列，每个prompt是一段完整的话，可以很长。"""
+JSON_PLAN_DEPENDENCY_INSTRUCTION = """每个步骤再加上"depends_on"字段，列出这个步骤需要用到哪些前面步骤的输出（步骤序号从1开始），不需要任何前面步骤的输出时写[]，例如{"prompt": "...", "depends_on": [1, 3]}。只依赖真正需要的步骤，互不依赖的步骤会被同时执行。"""
+
+# 步骤修复 - 规划回答中只有个别步骤缺失或格式有问题时，只让这个模型补写这几个步骤，不重新规划整个任务
+# 补写几个步骤的任务很小，用非推理模型即可，输出长度也只需要几个步骤
+PLAN_REPAIR_MODEL = "Qwen/Qwen2.5-72B-Instruct-128K"
+PLAN_REPAIR_MAX_TOKENS = 2048
+PLAN_REPAIR_PROMPT = """你负责补全一个多步骤任务的规划。用户会给出整体任务和已经拆分好的步骤，其中标为“（待补写）”的步骤缺失了。请只补写这些步骤，使它们与前后步骤衔接，每个步骤是一段完整的、超过100字的prompt，交给普通的大语言模型执行。
+只输出一个JSON对象，不要输出其他文字：{"steps": [{"index": 步骤序号, "prompt": "补写的prompt"}]}"""
+PLAN_REPAIR_DEPENDENCY_PROMPT = """每个补写的步骤再加上"depends_on"字段，列出它需要用到哪些前面步骤的输出（步骤序号从1开始），不需要时写[]。"""
+
+# 摘要模型 - 上下文压缩时用来把较早步骤的输出压缩成摘要的小模型
+# 摘要任务简单，用便宜快速的非推理模型即可
+SUMMARY_MODEL = "Qwen/Qwen2.5-7B-Instruct"
+
+# 摘要提示 - 要求摘要保留后续步骤可能用到的信息
+SUMMARY_PROMPT = f"请把用户给出的内容压缩成不超过{SUMMARY_MAX_TOKENS}字的要点摘要，保留关键结论、数据、名称和后续步骤可能需要用到的信息，不要添加原文没有的内容，直接输出摘要。"
+
+# 重试策略 - 请求失败时的最大重试次数、基础重试延迟（秒）、单次请求的网络超时（秒）和整个调用的总时限（秒）
+# 每次重试的等待时间会翻倍（指数退避）；总时限包括排队、重试和退避，到时后无论还剩几次重试都放弃
+STEP_RETRY_POLICY = {"max_retries": 5, "base_retry_delay": 2, "timeout": 180, "total_timeout": 600}
+OPTIMIZER_RETRY_POLICY = {"max_retries": 3, "base_retry_delay": 5, "timeout": 300, "total_timeout": 600}
+
+# 流式输出刷新间隔（秒）- 流式模式下每隔多久通知一次界面刷新累积的文字
+# 逐个令牌刷新会产生大量前端消息，按时间间隔合并刷新可以保持界面流畅
+STREAM_RENDER_INTERVAL = 0.1
+
+# 异步传输 - 阻塞的网络读写在工作线程中执行，事件循环只负责等待、退避和取消检查
+# MAX_IN_FLIGHT_REQUESTS: 整个进程同时进行的网络请求上限（AIGENT_MAX_IN_FLIGHT），由_in_flight信号量控制，
+#                         每次尝试在发送前占用一个名额，结束或被放弃时立即归还
+# ABORT_CHECK_INTERVAL: 等待期间每隔多久检查一次取消标志和总时限（秒）
+# 发送请求和读取流式响应可能长时间阻塞，各自使用单独的线程，被放弃后还没结束的线程不会占住共享线程池；
+# 共享的_io_executor只执行很短的等待（如分段等待密钥和名额）
+MAX_IN_FLIGHT_REQUESTS = int(os.environ.get("AIGENT_MAX_IN_FLIGHT", "32"))
+ABORT_CHECK_INTERVAL = 0.1
+_in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT_REQUESTS)
+_io_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="aigent-io")
+
+def _start_thread(func, *args):
+    # 在单独的守护线程中执行func，返回concurrent.futures.Future；线程开始前取消Future则不会执行
+    job = Future()
+
+    def run():
+        if not job.set_running_or_notify_cancel():
+            return
+        try:
+            job.set_result(func(*args))
+        except BaseException as e:
+            job.set_exception(e)
+
+    threading.Thread(target=run, daemon=True, name="aigent-request").start()
+    return job
+
+def _emit_nothing(event, data):
+    # 没有提供事件回调时使用的空回调
+    pass
+
+def _iter_sse_events(response):
+    """
+    逐行解析OpenAI兼容接口返回的SSE(Server-Sent Events)流
+
+    Args:
+        response (requests.Response): 以stream=True发送的请求得到的响应对象
+
+    Yields:
+        dict: 每个"data:"行解析出的JSON数据块，遇到[DONE]时结束
+    """
+    # 按字节读取每一行再用UTF-8解码，避免requests把text/event-stream误判为ISO-8859-1导致中文乱码
+    for raw_line in response.iter_lines():
+        if not raw_line:
+            continue  # 空行是事件之间的分隔符
+        line = raw_line.decode("utf-8", errors="replace")
+        if not line.startswith("data:"):
+            continue  # 忽略注释行(":"开头)以及event/id等其他字段
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break  # 服务器标记流结束
+        try:
+            yield json.loads(data)
+        except json.JSONDecodeError:
+            continue  # 跳过无法解析的残缺数据块
+
+class _CallAborted(Exception):
+    # 调用被取消或超过总时限，消息是给用户看的原因
+    pass
+
+class _CallControl:
+    """
+    一次调用的取消和总时限控制
+
+    所有等待（退避、排队、等待响应、读取流式数据）都按ABORT_CHECK_INTERVAL切成小段，
+    每段之间检查取消标志和总时限，不会在某一次等待中卡住。
+    """
+
+    def __init__(self, cancel_event=None, deadline=None, parent=None):
+        self.cancel_event = cancel_event
+        self.deadline = deadline
+        self.parent = parent
+        # 收到第一个令牌（非流式为收到成功的响应）后设置，对冲时用来决定采用哪一个请求
+        self.responded = False
+
+    def child(self):
+        # 对冲时每个请求各自的控制：可以单独取消，同时服从整个调用的取消和总时限
+        return _CallControl(threading.Event(), self.deadline, self)
+
+    def check(self):
+        if self.parent is not None:
+            self.parent.check()
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise _CallAborted("调用已取消")
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise _CallAborted("超过总时限，已放弃")
+
+    def remaining(self):
+        # 距离总时限还有多少秒，没有时限时为None
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    async def sleep(self, seconds):
+        # 可以被取消的等待，不占用任何线程
+        end = time.monotonic() + seconds
+        while True:
+            self.check()
+            left = end - time.monotonic()
+            if left <= 0:
+                return
+            await asyncio.sleep(min(left, ABORT_CHECK_INTERVAL))
+
+    async def run_blocking(self, func, *args, on_abandon=None, on_abort=None, dedicated=False):
+        """
+        在共享的I/O线程池（dedicated为True时在单独的线程）中执行阻塞函数并等待结果，等待期间可以被取消
+
+        中止时还没开始执行的任务直接取消；已经在执行的先调用on_abort()尽量打断它（如关闭连接），
+        等它结束后把结果交给on_abandon清理（如关闭响应、归还密钥）。可能长时间阻塞的函数应使用dedicated，
+        被放弃后还在执行的函数不会占住共享线程池
+        """
+        job = _start_thread(func, *args) if dedicated else _io_executor.submit(func, *args)
+        future = asyncio.wrap_future(job)
+        try:
+            while True:
+                self.check()
+                done, _ = await asyncio.wait({future}, timeout=ABORT_CHECK_INTERVAL)
+                if done:
+                    return future.result()
+        except BaseException:
+            # 也包括事件循环被关闭时的CancelledError；函数自己抛出异常时任务已经结束，on_abandon不会被调用
+            if not job.cancel():
+                if on_abort is not None:
+                    on_abort()
+                if on_abandon is not None:
+                    job.add_done_callback(lambda f: f.exception() is None and on_abandon(f.result()))
+            raise
+
+def _pump_stream(response, loop, queue, stop):
+    # 在I/O线程中读取SSE数据块并转交给事件循环，读完或出错后关闭响应
+    def post(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # 调用已经结束，事件循环已关闭
+            stop.set()
+
+    try:
+        for chunk in _iter_sse_events(response):
+            if stop.is_set():
+                break
+            post(("chunk", chunk))
+    except Exception as e:
+        post(("error", e))
+    finally:
+        # 流式响应不会自动归还连接，读完后显式关闭，让连接回到连接池
+        response.close()
+        post(("end", None))
+
+async def _acollect_stream(response, control, on_delta=None, started_at=None):
+    """
+    消费流式响应，边接收边通知调用方，并拼装成与非流式响应相同结构的数据
+
+    网络读取在I/O线程中进行，这里只在事件循环中处理收到的数据块，等待期间可以被取消。
+
+    Args:
+        response (requests.Response): 以stream=True发送的请求得到的响应对象
+        control (_CallControl): 取消和总时限控制
+        on_delta (callable): on_delta(已收到的回答, 已收到的思考过程, 是否结束)，按固定间隔调用，为None时不通知
+        started_at (float): 请求发出的时间戳，用于计算首字延迟
+
+    Returns:
+        dict: 与非流式接口结构一致的响应数据（choices/usage），
+              额外包含ttft字段（首字延迟，秒；未收到任何内容时为None）
+    """
+    started_at = started_at if started_at is not None else time.time()
+    content_parts = []
+    reasoning_parts = []
+    usage = {}
+    finish_reason = None
+    ttft = None
+    last_render = 0.0
+
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    _start_thread(_pump_stream, response, asyncio.get_running_loop(), queue, stop)
+    try:
+        while True:
+            control.check()
+            try:
+                kind, chunk = await asyncio.wait_for(queue.get(), ABORT_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+            if kind == "end":
+                break
+            if kind == "error":
+                raise chunk
+            # 用量信息一般出现在最后一个数据块中，以最后收到的为准
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            for choice in chunk.get("choices") or []:
+                delta = choice.get("delta") or {}
+                piece = delta.get("content") or ""
+                reasoning = delta.get("reasoning_content") or ""
+                if (piece or reasoning) and ttft is None:
+                    # 记录首字延迟：从发出请求到收到第一个有效令牌的时间
+                    ttft = time.time() - started_at
+                    control.responded = True
+                if piece:
+                    content_parts.append(piece)
+                if reasoning:
+                    reasoning_parts.append(reasoning)
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+
+            # 按固定间隔通知界面刷新，避免每个令牌都触发一次渲染
+            if on_delta is not None and time.time() - last_render >= STREAM_RENDER_INTERVAL:
+                on_delta("".join(content_parts), "".join(reasoning_parts), False)
+                last_render = time.time()
+    except BaseException:
+        # 中止时让读取线程停下，关闭响应可以打断正在等待的读取
+        stop.set()
+        response.close()
+        raise
+
+    content = "".join(content_parts)
+    reasoning_content = "".join(reasoning_parts)
+    if on_delta is not None:
+        on_delta(content, reasoning_content, True)
+
+    message = {"role": "assistant", "content": content}
+    if reasoning_content:
+        message["reasoning_content"] = reasoning_content
+    return {
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": usage,
+        "ttft": ttft
     }
-    
-    # 设置重试参数
-    # 如果请求失败，系统会自动重试，提高成功率
-    max_retries = 5  # 最大重试次数
-    base_retry_delay = 2  # 基础重试延迟（秒）
-    timeout = 180  # 请求超时时间（秒）
+
+def _estimate_payload_tokens(payload):
+    # 按消息文本估算请求的输入令牌数，用于密钥的TPM限额（实际用量在调用结束后修正）
+    return sum(estimate_tokens(message.get("content") or "") for message in payload.get("messages", []))
+
+def chat_completion(payload, key_pool, max_retries=5, base_retry_delay=2, timeout=180, total_timeout=None,
+                    on_event=None, call_id=None, step_name="", rate_limiter=None, deadline=None, cancel_event=None,
+                    adaptive_timeout=True, hedge=False, call_kind=""):
+    """
+    achat_completion的同步版本：在当前线程中运行一个事件循环，直到调用结束
+
+    参数和返回值与achat_completion相同。事件在调用线程中发出。
+    已经在运行事件循环的线程（协程中）请直接使用achat_completion。
+    """
+    return asyncio.run(achat_completion(payload, key_pool, max_retries, base_retry_delay, timeout, total_timeout,
+                                        on_event, call_id, step_name, rate_limiter, deadline, cancel_event,
+                                        adaptive_timeout=adaptive_timeout, hedge=hedge, call_kind=call_kind))
+
+async def achat_completion(payload, key_pool, max_retries=5, base_retry_delay=2, timeout=180, total_timeout=None,
+                           on_event=None, call_id=None, step_name="", rate_limiter=None, deadline=None,
+                           cancel_event=None, adaptive_timeout=True, hedge=False, call_kind=""):
+    """
+    发送一次对话请求，失败时按指数退避自动重试，每次尝试都从密钥池中选择负载最小的健康密钥
+
+    这里只负责HTTP传输、重试和响应解析，不涉及任何界面，过程中的状态通过on_event通知调用方：
+    queued / call_start / status / http_error / request_error / retry / hedge / delta / call_end / call_failed，
+    每个事件的数据都包含call_id和step。无论成功失败，结束时都会发出call_trace事件，
+    数据中的record是本次调用的完整记录（排队、连接、首字延迟、重试、令牌用量等，字段见telemetry模块）。
+
+    阻塞的网络读写在工作线程中执行，退避和排队都是非阻塞的等待。整个进程同时进行的请求不超过MAX_IN_FLIGHT_REQUESTS个，
+    名额用完时发出queued事件并排队；cancel_event被设置或超过总时限时，正在进行的等待会在ABORT_CHECK_INTERVAL内结束，
+    正在发送的请求的连接被关闭，名额和密钥立即归还，调用以失败返回。
+
+    每次成功的请求都会记入latency_tracker中该模型和调用类型(call_kind)的耗时直方图。开启adaptive_timeout时，单次请求的超时按直方图计算
+    （不超过timeout）；开启hedge时，请求超过该模型平时的响应时间还没有响应，就在对冲预算允许的情况下
+    用另一个密钥再发一次，采用先响应的一个，另一个立即取消。对冲过的调用在record中记为hedged（对冲请求胜出时hedge_won）。
+
+    Args:
+        payload (dict): 发给API的请求参数，payload["stream"]决定是否使用流式输出
+        key_pool (KeyPool): API密钥池
+        max_retries (int): 最大重试次数
+        base_retry_delay (int): 基础重试延迟（秒）
+        timeout (int): 单次请求的网络超时时间（秒）
+        total_timeout (float): 本次调用（包括排队、重试和退避）最多花费的秒数，为None时不限制
+        on_event (callable): on_event(事件名, 数据字典)
+        call_id: 本次调用的编号，用于界面区分并行的多个调用
+        step_name (str): 调用所属的步骤名称
+        rate_limiter (RateLimiter): 全局速率限制，每次发送（包括重试）前等待，为None时不限制
+        deadline (float): 整条链的截止时间（time.monotonic()的值），与total_timeout同时生效
+        cancel_event (threading.Event): 被设置后放弃本次调用，如界面上的停止按钮
+        adaptive_timeout (bool): 是否根据观测到的响应时间缩短单次请求的超时
+        hedge (bool): 是否对明显变慢的请求发出对冲请求
+        call_kind (str): 调用类型（如model_router.ROLES中的角色），输出长度差别很大的调用（指令优化和最终总结）分开统计耗时
+
+    Returns:
+        dict: 成功时返回{"response_data", "content", "ttft", "latency", "key_index", "attempts", "record"}，失败返回None
+    """
+    emit = on_event or _emit_nothing
+    record = new_call_record(call_id, step_name, payload)
+    base = {"call_id": call_id, "step": step_name}
+    if total_timeout:
+        call_deadline = time.monotonic() + total_timeout
+        deadline = min(deadline, call_deadline) if deadline is not None else call_deadline
+    control = _CallControl(cancel_event, deadline)
+    latency_tracker.note_call()
+    hedge_delay = (latency_tracker.hedge_delay(payload.get("model"), bool(payload.get("stream")), call_kind)
+                   if hedge else None)
+    send = functools.partial(_send_with_retries, payload, key_pool, max_retries, base_retry_delay, timeout,
+                             rate_limiter, adaptive_timeout, call_kind)
+
+    async def run():
+        if hedge_delay is None:
+            return await send(on_event=emit, base=base, record=record, control=control)
+        return await _send_hedged(send, hedge_delay, payload, emit, base, record, control)
+
+    result = None
+    try:
+        result = await run()
+        return result
+    except _CallAborted as e:
+        record["status"] = "aborted"
+        record["error"] = str(e)
+        emit("call_failed", {**base, "message": str(e), "aborted": True})
+        return None
+    except BaseException:
+        # 调用方在事件回调中中断（如界面脚本被停止）
+        record["status"] = "aborted"
+        raise
+    finally:
+        finish_call_record(record, result["response_data"] if result else None)
+        if result:
+            result["record"] = record
+        emit("call_trace", {**base, "record": record})
+
+async def _acquire_key(key_pool, estimated_tokens, control):
+    # 分小段等待密钥，每段之间检查取消和总时限；中止时已经拿到的密钥原样归还
+    while True:
+        key_index = await control.run_blocking(
+            key_pool.acquire, estimated_tokens, ABORT_CHECK_INTERVAL,
+            on_abandon=lambda index: index is not None and key_pool.release(index, aborted=True))
+        if key_index is not None:
+            return key_index
+
+def _close_response(response):
+    response.close()
+
+async def _acquire_slot(control, on_queued):
+    # 占用一个同时进行的请求名额，名额用完时调用一次on_queued()，之后分小段等待，中止时已经拿到的名额原样归还
+    if _in_flight.acquire(blocking=False):
+        return
+    on_queued()
+    while not await control.run_blocking(_in_flight.acquire, True, ABORT_CHECK_INTERVAL,
+                                         on_abandon=lambda acquired: acquired and _in_flight.release()):
+        pass
+
+async def _send_hedged(send, delay, payload, on_event, base, record, control):
+    # 主请求发出delay秒后还没有响应时再发一个相同的请求，先响应的胜出（流式以第一个令牌为准），另一个立即取消
+    # 两个请求各自重试，其中一个最终失败时继续等待另一个
+    state = {"winner": None}
+
+    def start(task_control, task_record, extra):
+        def emit(event, data):
+            # 一个请求胜出后，另一个请求的事件不再转给调用方
+            if state["winner"] in (None, task_control):
+                on_event(event, {**data, **extra})
+        return asyncio.ensure_future(send(on_event=emit, base=base, record=task_record, control=task_control))
+
+    primary = control.child()
+    contenders = {start(primary, record, {}): (primary, record)}
+    hedge_record = None
+    task_record = record
+    result = None
+    try:
+        while contenders:
+            control.check()
+            winner = None
+            for task, (task_control, _) in list(contenders.items()):
+                if task.done():
+                    # 取消和总时限之外的异常原样抛出
+                    if task.result() is not None:
+                        winner = task
+                        break
+                    del contenders[task]
+                elif task_control.responded:
+                    winner = task
+                    break
+            if winner is None and not contenders:
+                # 所有请求都已失败（主请求在对冲之前就失败也是这种情况），整个调用失败
+                break
+            if winner is not None:
+                task_control, task_record = contenders.pop(winner)
+                state["winner"] = task_control
+                for other_control, _ in contenders.values():
+                    other_control.cancel_event.set()
+                result = await winner
+                break
+            sent_for = time.time() - record["started_at"] - record["send_offset"]
+            if (hedge_record is None and record["attempts"] and not primary.responded and sent_for >= delay
+                    and latency_tracker.reserve_hedge()):
+                # 对冲请求的记录与主请求共用开始时间，胜出时直接代替主请求的记录
+                hedge_record = dict(new_call_record(record["call_id"], record["step"], payload),
+                                    started_at=record["started_at"])
+                on_event("hedge", {**base, "delay": delay})
+                hedge_control = control.child()
+                contenders[start(hedge_control, hedge_record, {"hedge": True})] = (hedge_control, hedge_record)
+            await asyncio.wait(list(contenders), timeout=ABORT_CHECK_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+        return result
+    finally:
+        # 输掉或还在进行的请求：取消后等它们归还密钥
+        for task_control, _ in contenders.values():
+            task_control.cancel_event.set()
+        await asyncio.gather(*contenders, return_exceptions=True)
+        if state["winner"] is not None and task_record is hedge_record:
+            record.update(hedge_record)
+            record["hedge_won"] = True
+        elif state["winner"] is None and hedge_record is not None:
+            # 两个请求都没有成功：对冲请求的失败原因补进调用记录，主请求只是被取消时以对冲请求的失败为准
+            if hedge_record["status"] == "failed":
+                record["status"] = "failed"
+            for name in ("status_code", "error"):
+                if record[name] is None:
+                    record[name] = hedge_record[name]
+        record["hedged"] = hedge_record is not None
+
+async def _send_with_retries(payload, key_pool, max_retries, base_retry_delay, timeout, rate_limiter, adaptive_timeout,
+                             call_kind, on_event, base, record, control):
+    # chat_completion的重试循环，过程中把排队、退避和每次尝试的结果写进record
+    stream = payload.get("stream", False)
+
+    def emit(event, data):
+        # 失败信息同时记进调用记录
+        if event in ("call_failed", "request_error"):
+            record["error"] = data["message"]
+        on_event(event, data)
+
+    estimated_tokens = _estimate_payload_tokens(payload) + payload.get("max_tokens", 0) // 4
+    # 上一次尝试失败后需要等待的时间，在归还密钥之后才开始等待，避免等待期间占着密钥
+    backoff = 0
     
     # 开始尝试发送请求，支持多次重试
     for retry in range(max_retries + 1):
+        if backoff:
+            # 退避期间不占用线程，也可以随时被取消
+            backoff_started = time.time()
+            try:
+                await control.sleep(backoff)
+            finally:
+                record["backoff"] += time.time() - backoff_started
+            backoff = 0
+        # 计算当前重试的延迟时间（指数退避策略）
+        # 每次重试的等待时间会翻倍，避免对服务器造成过大压力
+        current_retry_delay = base_retry_delay * (2 ** retry) if retry > 0 else 0
+        response = None
+        
+        # 先占用一个同时进行的请求名额，再从密钥池中取出当前负载最小的健康密钥，所有密钥都被限流时在这里排队
+        queued_at = time.time()
+        await _acquire_slot(control, lambda: emit("queued", {**base, "limit": MAX_IN_FLIGHT_REQUESTS}))
+        try:
+            key_index = await _acquire_key(key_pool, estimated_tokens, control)
+        except BaseException:
+            _in_flight.release()
+            raise
+        record["attempts"] = retry + 1
+        record["key_index"] = key_index
+        # 本次尝试的结果，结束时归还给密钥池，用于健康状况和延迟统计
+        outcome = {"status_code": None, "estimated_tokens": estimated_tokens}
+        started_at = time.time()
         try:
-            # 显示当前尝试信息
-            retry_msg = "" if retry == 0 else f"（第{retry}次重试）"
-            st.info(f"正在使用API {st.session_state.current_api + 1} 发送请求...{retry_msg}")
+            emit("call_start", {**base, "attempt": retry, "key_index": key_index, "model": payload.get("model"),
+                                "stream": stream})
             
-            # 计算当前重试的延迟时间（指数退避策略）
-            # 每次重试的等待时间会翻倍，避免对服务器造成过大压力
-            current_retry_delay = base_retry_delay * (2 ** retry) if retry > 0 else 0
+            if rate_limiter is not None:
+                await control.sleep(rate_limiter.reserve())
+            record["queue_wait"] += time.time() - queued_at
             
-            # 发送HTTP POST请求到API服务器
-            response = requests.post(API_URL, json=payload, headers=headers, timeout=timeout)
+            # 设置HTTP请求头，包含认证信息和内容类型
+            headers = {
+                "Authorization": f"Bearer {key_pool.api_key(key_index)}",  # 使用Bearer令牌认证方式
+                "Content-Type": "application/json"  # 指定请求内容为JSON格式
+            }
             
-            # 显示API响应状态码
-            st.write(f"API响应状态码: {response.status_code}")
+            # 通过共享的连接池发送HTTP POST请求到API服务器，复用已建立的TCP/TLS连接
+            # 流式模式下requests不会一次性读取整个响应体，而是在后面逐块消费
+            # 网络超时按该模型观测到的响应时间计算，并且不超过剩下的总时限
+            request_timeout = (latency_tracker.adaptive_timeout(payload.get("model"), stream, timeout, retry, call_kind)
+                               if adaptive_timeout else timeout)
+            remaining = control.remaining()
+            if remaining is not None:
+                request_timeout = min(request_timeout, remaining)
+            started_at = time.time()
+            record["send_offset"] = started_at - record["started_at"]
+            # 中止时关闭正在使用的连接，发送线程立即结束，不会等到网络超时
+            handle = http_client.RequestHandle()
+            response = await control.run_blocking(
+                lambda: http_client.post(API_URL, handle=handle, json=payload, headers=headers, timeout=request_timeout,
+                                         stream=stream),
+                on_abandon=_close_response, on_abort=handle.abort, dedicated=True)
+            outcome["status_code"] = response.status_code
+            record["status_code"] = response.status_code
+            if response.status_code == 200 and not stream:
+                control.responded = True
+            record["connect_time"] = response.elapsed.total_seconds()
+            emit("status", {**base, "status_code": response.status_code, "key_index": key_index})
             
             # 处理非成功状态码
             if response.status_code != 200:
-                # 显示错误信息
-                error_msg = f"API {st.session_state.current_api + 1} 请求失败: HTTP {response.status_code}"
-                st.error(error_msg)
+                emit("http_error", {**base, "status_code": response.status_code, "key_index": key_index})
                 
-                # 切换到另一个API密钥
-                # 如果一个API密钥失败，尝试使用另一个，增加成功率
-                st.session_state.current_api = 1 - st.session_state.current_api
-                current_api_key = st.session_state.api_key if st.session_state.current_api == 0 else st.session_state.api_key2
-                headers["Authorization"] = f"Bearer {current_api_key}"
+                # 429表示这个密钥被限流，记录服务器要求的等待时间，密钥池会在这段时间内改用其他密钥
+                if response.status_code == 429:
+                    outcome["retry_after"] = parse_retry_after(response.headers.get("Retry-After"))
+                    if retry < max_retries:
+                        emit("retry", {**base, "reason": "rate_limit", "delay": outcome["retry_after"] or 0,
+                                       "key_index": key_index})
+                        response.close()
+                        continue
                 
                 # 对于服务器错误，尝试重试
                 # 504是网关超时，500以上是服务器内部错误，这些情况下重试可能会成功
-                if (response.status_code == 504 or response.status_code >= 500) and retry < max_retries:
-                    st.warning(f"检测到服务器错误，将使用API {st.session_state.current_api + 1} 在{current_retry_delay}秒后重试...")
-                    time.sleep(current_retry_delay)  # 等待一段时间后重试
-                    timeout += 30  # 每次重试增加超时时间，给服务器更多处理时间
+                if response.status_code >= 500 and retry < max_retries:
+                    emit("retry", {**base, "reason": "server", "delay": current_retry_delay, "key_index": key_index})
+                    response.close()  # 释放连接回连接池，流式请求未读取的响应体不会自动释放
+                    backoff = current_retry_delay  # 等待一段时间后重试
                     continue
-                    
-                # 尝试解析错误响应为JSON并显示
+                
+                # 尝试解析错误响应为JSON，交给调用方显示
                 try:
-                    error_json = response.json() if response.content else {"error": "无响应内容"}
-                    st.json(error_json)
+                    error_body = response.json() if response.content else {"error": "无响应内容"}
                 except json.JSONDecodeError:
-                    # 如果无法解析为JSON，显示原始响应
-                    st.error("API返回了非JSON格式的响应:")
-                    st.code(response.text if response.content else "无响应内容")
+                    error_body = response.text if response.content else "无响应内容"
+                emit("call_failed", {**base, "message": f"API请求失败: HTTP {response.status_code}",
+                                     "status_code": response.status_code, "body": error_body})
                 return None  # 请求失败，返回None
             
-            # 确保响应状态码正常
-            # 这会在状态码不是2xx时抛出异常
-            response.raise_for_status()
-            
-            # 尝试将响应解析为JSON
-            try:
-                response_data = response.json()
-            except json.JSONDecodeError as e:
-                # 解析失败时显示错误信息
-                st.error(f"无法解析API响应为JSON: {str(e)}")
-                st.error("原始响应内容:")
-                st.code(response.text if response.content else "无响应内容")
-                return None  # 解析失败，返回None
+            # 流式模式：逐块接收并实时通知，最后拼装成与非流式相同结构的数据
+            if stream:
+                def on_delta(content, reasoning, finished):
+                    emit("delta", {**base, "content": content, "reasoning": reasoning, "finished": finished})
+                response_data = await _acollect_stream(response, control, on_delta, started_at)
+                ttft = response_data.pop("ttft")
+            else:
+                # 尝试将响应解析为JSON
+                try:
+                    response_data = response.json()
+                except json.JSONDecodeError as e:
+                    emit("call_failed", {**base, "message": f"无法解析API响应为JSON: {str(e)}",
+                                         "body": response.text if response.content else "无响应内容"})
+                    return None  # 解析失败，返回None
+                # 非流式调用要等完整回答返回后才能看到内容，首字延迟即总耗时
+                ttft = time.time() - started_at
+            record["ttft"] = ttft
+            latency_tracker.observe(payload.get("model"), stream, ttft, call_kind)
             
-            # 显示API响应详情（可展开查看）
-            with st.expander("查看API响应详情"):
-                st.json(response_data)
-                if "choices" in response_data and len(response_data["choices"]) > 0:
-                    st.write(f"Finish Reason: {response_data['choices'][0].get('finish_reason', 'unknown')}")
-                
-            # 更新令牌使用统计
-            # 跟踪输入、输出和总令牌数，用于计费和监控
-            if "usage" in response_data:
-                usage = response_data["usage"]
-                st.session_state.token_usage["prompt_tokens"] += usage.get("prompt_tokens", 0)
-                st.session_state.token_usage["completion_tokens"] += usage.get("completion_tokens", 0)
-                st.session_state.token_usage["total_tokens"] += usage.get("total_tokens", 0)
+            if (response_data.get("usage") or {}).get("total_tokens"):
+                outcome["used_tokens"] = response_data["usage"]["total_tokens"]
             
-            # 返回AI的回答内容
-            return response_data["choices"][0]["message"]["content"]
+            # 获取AI的回答内容
+            content = response_data["choices"][0]["message"]["content"]
+            emit("call_end", {**base, "response_data": response_data, "key_index": key_index})
+            return {
+                "response_data": response_data,
+                "content": content,
+                "ttft": ttft,
+                "latency": time.time() - started_at,
+                "key_index": key_index,
+                "attempts": retry + 1
+            }
+        except _CallAborted:
+            # 取消和超时是调用方的决定，不计入密钥的健康状况
+            outcome["aborted"] = True
+            raise
         except requests.exceptions.RequestException as e:
             # 处理请求异常（如网络错误、超时等）
-            st.error(f"API请求异常: {str(e)}")
+            outcome["status_code"] = None
+            emit("request_error", {**base, "message": f"API请求异常: {str(e)}"})
             if retry < max_retries:
                 # 如果还有重试次数，等待后重试
-                st.warning(f"网络请求异常，将在{current_retry_delay}秒后重试...")
-                time.sleep(current_retry_delay)
-                timeout += 30  # 增加超时时间
+                emit("retry", {**base, "reason": "network", "delay": current_retry_delay, "key_index": key_index})
+                backoff = current_retry_delay
                 continue
+            emit("call_failed", {**base, "message": "网络请求多次失败，已放弃"})
             return None  # 所有重试都失败，返回None
-        except (KeyError, json.JSONDecodeError) as e:
+        except (KeyError, IndexError, TypeError, json.JSONDecodeError) as e:
             # 处理响应解析错误
-            st.error(f"API响应解析错误: {str(e)}")
-            if response and response.content:
-                st.error("原始响应内容:")
-                st.code(response.text)
+            emit("call_failed", {**base, "message": f"API响应解析错误: {str(e)}",
+                                 "body": response.text if response is not None and not stream and response.content else None})
             return None  # 解析错误，返回None
         except Exception as e:
             # 处理其他未知错误
-            st.error(f"未知错误: {str(e)}")
+            emit("call_failed", {**base, "message": f"未知错误: {str(e)}"})
             return None  # 未知错误，返回None
+        except BaseException:
+            # 调用方在事件回调中中断（如界面脚本被停止）
+            outcome["aborted"] = True
+            raise
+        finally:
+            key_pool.release(key_index, latency=time.time() - started_at, **outcome)
+            _in_flight.release()
 
-def optimize_user_input(user_prompt):
+def split_reasoning(text):
     """
-    使用DeepSeek-R1-Distill-Qwen-32B模型优化用户输入的指令
-    
+    把回答中的推理过程和正式回答分开
+
+    QwQ、DeepSeek-R1等推理模型有时会把思考过程用<think>...</think>包在回答正文里（也可能缺少开头的<think>），
+    正式回答是最后一个</think>之后的内容。回答被截断在思考过程中时，正式回答为空。
+
     Args:
-        user_prompt (str): 用户原始输入的指令或问题文本
-        
+        text (str): 模型返回的回答内容
+
     Returns:
-        str: 优化后的指令文本，如果优化失败则返回原始输入
+        tuple: (推理过程, 正式回答)，没有推理标记时推理过程为空字符串
     """
-    # 构建优化指令的系统提示
-    # 这个系统提示详细说明了指令优化助手的角色和任务要求
-    system_prompt = """你是一个专业的指令优化助手。你的任务是分析用户的原始指令，并将其扩展为更加详细、明确和结构化的指令。
-请确保优化后的指令：
-1. 保留原始指令的核心意图和目标
-2. 添加必要的上下文和背景信息
-3. 明确任务的具体步骤和预期输出
-4. 消除歧义和模糊表述
-5. 使用清晰的结构和格式
-6. 必须确保是LLM可以制作的任务
-7. 此AI无法上网，请确保你的指令准确无误
-8. 理解用户想要真是的表达信息
-9. 不要加自己的东西
+    if not text:
+        return "", ""
+    if "</think>" in text:
+        reasoning, _, answer = text.rpartition("</think>")
+        return reasoning.replace("<think>", "").strip(), answer.strip()
+    if text.lstrip().startswith("<think>"):
+        return text.lstrip()[len("<think>"):].strip(), ""
+    return "", text
 
-请直接输出优化后的指令，不要添加解释或其他内容。"""
-    
-    # 构建API请求消息列表
-    # 包含系统提示和用户原始指令
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt+system_prompt}
-    ]
-    
-    # 构建API请求参数
-    # 设置模型和各种生成参数
-    payload = {
-        "model": "Qwen/QwQ-32B",  # 使用Qwen/QwQ-32B模型进行指令优化
-        "messages": messages,  # 包含系统提示和用户指令的消息列表
-        "stream": False,  # 不使用流式输出
-        "max_tokens": 4096,  # 设置回答的最大长度
-        "stop": None,  # 不设置特定的停止词
-        "temperature": 0.7,  # 温度参数，控制回答的随机性
-        "top_p": 0.7,  # 控制词汇选择的多样性
-        "top_k": 50,  # 每一步只考虑概率最高的前50个词
-        "frequency_penalty": 0.5,  # 降低重复词汇的概率
-        "n": 1  # 只生成一个回答
-    }
-    
-    # 获取当前应该使用的API密钥
-    # 随机选择一个API密钥，增加系统可靠性
-    st.session_state.current_api = random.randint(0, 1)
-    current_api_key = st.session_state.api_key if st.session_state.current_api == 0 else st.session_state.api_key2
-    
-    # 设置HTTP请求头
-    headers = {
-        "Authorization": f"Bearer {current_api_key}",  # 使用Bearer令牌认证
-        "Content-Type": "application/json"  # 指定请求内容为JSON格式
-    }
-    
-    # 设置重试参数
-    # 如果请求失败，系统会自动重试
-    max_retries = 3  # 最大重试次数
-    base_retry_delay = 5  # 基础重试延迟（秒）
-    timeout = 300  # 请求超时时间（秒）
-    
-    # 开始尝试发送请求，支持多次重试
-    for retry in range(max_retries + 1):
+# 步骤依赖标记 - 并行模式下规划AI会在每个步骤末尾写上"[依赖 1 3]"或"[依赖 无]"
+# 兼容全角括号和冒号，数字之间可以用空格、逗号或顿号分隔
+DEPENDENCY_MARK_PATTERN = re.compile(r"[\[【]\s*依赖\s*[:：]?\s*([^\]】]*)[\]】]\s*$")
+
+def split_fused_plan(response):
+    """
+    拆分融合规划的回答
+
+    Args:
+        response (str): 同时包含优化后的指令和步骤的回答（可能带有推理过程）
+
+    Returns:
+        tuple: (优化后的指令, 规划回答)，规划回答去掉了优化指令部分、保留推理过程，可以直接交给process_qwq_response；
+               找不到标记时优化后的指令为None，规划回答为原始回答
+    """
+    reasoning, answer = split_reasoning(response)
+    start = answer.find(FUSED_OPTIMIZED_MARK)
+    end = answer.find(FUSED_STEPS_MARK, start + len(FUSED_OPTIMIZED_MARK)) if start != -1 else -1
+    if end == -1:
+        return None, response
+    optimized_prompt = answer[start + len(FUSED_OPTIMIZED_MARK):end].strip()
+    plan_text = answer[end + len(FUSED_STEPS_MARK):].strip()
+    if reasoning:
+        plan_text = f"<think>{reasoning}</think>\n{plan_text}"
+    return optimized_prompt or None, plan_text
+
+def _split_dependencies(steps):
+    """
+    从步骤文本中剥离依赖标记
+
+    Args:
+        steps (list): 规划AI返回的步骤文本列表
+
+    Returns:
+        tuple: (清理后的步骤列表, 依赖列表)，依赖列表中每一项是前置步骤的下标（从0开始），
+               没有依赖标记的步骤对应None，表示依赖前面所有步骤
+    """
+    clean_steps = []
+    dependencies = []
+    for step in steps:
+        match = DEPENDENCY_MARK_PATTERN.search(step)
+        if match:
+            clean_steps.append(step[:match.start()].strip())
+            # 步骤编号从1开始，转换为从0开始的下标；"无"之类的文字不含数字，得到空列表
+            dependencies.append([int(n) - 1 for n in re.findall(r"\d+", match.group(1))])
+        else:
+            clean_steps.append(step)
+            dependencies.append(None)
+    return clean_steps, dependencies
+
+# 规划回答的容错解析
+# PLAN_MAX_STEPS: 最多使用的步骤数，超出的部分丢弃
+# PLAN_STEP_MIN_CHARS: 少于这么多字的步骤视为格式有问题（要求每个步骤超过100字，这里只排除明显残缺的行）
+PLAN_MAX_STEPS = 30
+PLAN_STEP_MIN_CHARS = 10
+
+# 第一行的步骤数，兼容"5"、"共5步"、"步骤数：5"等写法
+PLAN_COUNT_PATTERN = re.compile(r"^(?:共|总共|一共)?\s*(?:步骤数|步数)?\s*[:：]?\s*(\d+)\s*(?:个步骤|个|步)?\s*[。.]?$")
+
+# 行首的步骤编号：1. / 1、 / 1) / (1) / 第1步： / 步骤1：，"1.5倍"这种小数不算编号
+PLAN_NUMBER_PATTERN = re.compile(
+    r"^\s*(?:[(（]\s*(\d+)\s*[)）]|第\s*(\d+)\s*步\s*[:：.、]?|步骤\s*(\d+)\s*[:：.、]?|(\d+)\s*[.、．:：)）](?!\d))\s*")
+
+# 行首的列表符号：- / * / • / ·，没有编号的步骤去掉这些符号
+PLAN_BULLET_PATTERN = re.compile(r"^\s*[-*•·]\s+")
+
+# JSON步骤对象中步骤内容可能使用的字段名，以及依赖字段名
+_PLAN_PROMPT_FIELDS = ("prompt", "step", "content", "task", "description")
+_PLAN_DEPENDENCY_FIELDS = ("depends_on", "dependencies", "deps")
+
+class ParsedPlan:
+    """
+    规划回答的解析结果
+
+    steps与计划中的步骤位置一一对应，缺失或格式有问题、不能直接使用的步骤为None，原因记录在problems中；
+    dependencies中每一项是前置步骤的下标（从0开始），没有给出依赖时为None，表示依赖前面所有步骤；
+    format为识别出的格式："json"、"numbered"（带编号的文本）或"lines"（每行或每段一个步骤）
+    """
+
+    def __init__(self, steps, dependencies, problems, format):
+        self.steps = steps
+        self.dependencies = dependencies
+        self.problems = problems
+        self.format = format
+
+    @property
+    def missing(self):
+        # 需要补写的步骤下标
+        return [i for i, step in enumerate(self.steps) if step is None]
+
+    def fill(self, index, step, dependencies=None):
+        self.steps[index] = step
+        self.dependencies[index] = dependencies
+        self.problems.pop(index, None)
+
+    def usable(self):
+        """
+        去掉仍然缺失的步骤
+
+        Returns:
+            tuple: (步骤列表, 依赖列表)，依赖中的下标按去掉缺失步骤后的位置重新编号，指向缺失步骤的依赖被丢弃
+        """
+        positions = {}
+        for i, step in enumerate(self.steps):
+            if step is not None:
+                positions[i] = len(positions)
+        steps = [self.steps[i] for i in positions]
+        dependencies = [None if self.dependencies[i] is None else [positions[d] for d in self.dependencies[i] if d in positions]
+                        for i in positions]
+        return steps, dependencies
+
+def _json_candidates(text):
+    # 回答中可能的JSON文本：去掉```代码块标记后从第一个{或[开始
+    text = re.sub(r"```(?:json)?", "", text)
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    return text[min(starts):] if starts else None
+
+def _load_json_steps(text):
+    # 解析JSON格式的步骤列表，返回(步骤对象列表, 是否完整)；回答被截断时从已经完整的步骤对象中恢复，都没有时返回(None, False)
+    candidate = _json_candidates(text)
+    if candidate is None:
+        return None, False
+    try:
+        data, _ = json.JSONDecoder().raw_decode(candidate)
+        if isinstance(data, dict):
+            data = next((data[key] for key in ("steps", "plan") if isinstance(data.get(key), list)), None)
+        if isinstance(data, list):
+            return data, True
+    except ValueError:
+        pass
+    # 逐个解析不含嵌套的{...}，截断在最后一个步骤中间时前面的步骤仍然可以使用
+    items = []
+    for match in re.finditer(r"\{[^{}]*\}", candidate):
         try:
-            # 显示当前尝试信息
-            retry_msg = "" if retry == 0 else f"（第{retry}次重试）"
-            st.info(f"正在使用API {st.session_state.current_api + 1} 优化用户指令...{retry_msg}")
-            
-            # 计算当前重试的延迟时间（指数退避策略）
-            current_retry_delay = base_retry_delay * (2 ** retry) if retry > 0 else 0
-            
-            # 发送HTTP POST请求到API服务器
-            response = requests.post(API_URL, json=payload, headers=headers, timeout=timeout)
-            
-            # 处理非成功状态码
-            if response.status_code != 200:
-                # 显示错误信息
-                error_msg = f"指令优化API请求失败: HTTP {response.status_code}"
-                st.error(error_msg)
-                
-                # 切换到另一个API密钥
-                st.session_state.current_api = 1 - st.session_state.current_api
-                current_api_key = st.session_state.api_key if st.session_state.current_api == 0 else st.session_state.api_key2
-                headers["Authorization"] = f"Bearer {current_api_key}"
-                
-                # 对于服务器错误，尝试重试
-                if (response.status_code == 504 or response.status_code >= 500) and retry < max_retries:
-                    st.warning(f"检测到服务器错误，将使用API {st.session_state.current_api + 1} 在{current_retry_delay}秒后重试...")
-                    time.sleep(current_retry_delay)  # 等待一段时间后重试
-                    timeout += 30  # 每次重试增加超时时间
-                    continue
-                    
-                # 如果优化失败，返回原始输入
-                # 确保即使优化失败，用户的请求仍然能够被处理
-                st.warning("指令优化失败，将使用原始指令继续处理")
-                return user_prompt
-            
-            # 确保响应状态码正常
-            response.raise_for_status()
-            
-            # 尝试将响应解析为JSON
-            try:
-                response_data = response.json()
-            except json.JSONDecodeError as e:
-                # 解析失败时显示错误信息
-                st.error(f"无法解析指令优化API响应为JSON: {str(e)}")
-                # 如果解析失败，返回原始输入
-                # 确保即使解析失败，用户的请求仍然能够被处理
-                return user_prompt
-            
-            # 显示API响应详情（可展开查看）
-            with st.expander("查看指令优化响应详情"):
-                st.json(response_data)
-                
-            # 更新令牌使用统计
-            # 跟踪输入、输出和总令牌数，用于计费和监控
-            if "usage" in response_data:
-                usage = response_data["usage"]
-                st.session_state.token_usage["prompt_tokens"] += usage.get("prompt_tokens", 0)
-                st.session_state.token_usage["completion_tokens"] += usage.get("completion_tokens", 0)
-                st.session_state.token_usage["total_tokens"] += usage.get("total_tokens", 0)
-            
-            # 获取优化后的指令文本
-            optimized_prompt = response_data["choices"][0]["message"]["content"]
-            
-            # 显示优化前后的对比
-            # 帮助用户了解指令是如何被优化的
-            with st.expander("查看指令优化前后对比"):
-                st.subheader("原始指令")
-                st.write(user_prompt)
-                st.subheader("优化后的指令")
-                st.write(optimized_prompt)
-            
-            # 返回优化后的指令
-            return optimized_prompt
-        except requests.exceptions.RequestException as e:
-            # 处理请求异常（如网络错误、超时等）
-            st.error(f"指令优化API请求异常: {str(e)}")
-            if retry < max_retries:
-                # 如果还有重试次数，等待后重试
-                st.warning(f"网络请求异常，将在{current_retry_delay}秒后重试...")
-                time.sleep(current_retry_delay)
-                timeout += 30  # 增加超时时间
-                continue
-            # 如果所有重试都失败，返回原始输入
-            # 确保即使所有重试都失败，用户的请求仍然能够被处理
-            st.warning("指令优化失败，将使用原始指令继续处理")
-            return user_prompt
-        except Exception as e:
-            # 处理其他未知错误
-            st.error(f"指令优化过程中发生未知错误: {str(e)}")
-            # 发生任何其他错误，返回原始输入
-            # 确保即使发生未知错误，用户的请求仍然能够被处理
-            return user_prompt
-
-def process_qwq_response(response):
-    if response:
-        # 显示原始响应内容（可展开查看）
-        st.expander("原始响应内容").code(response)
-        
-        # 处理带有思考标记的响应
-        # 某些AI模型会使用</think>标记来分隔思考过程和实际回答
-        if "</think>" in response:
-            # 分割响应，获取实际内容部分（思考标记之后的内容）
-            actual_content = response.split("</think>", 1)[1].strip()
-            # 将内容按行分割，并移除空行
-            lines = [p.strip() for p in actual_content.split('\n') if p.strip()]
-            try:
-                # 尝试从第一行获取循环次数（步骤数量）
-                # 这是基于特定的响应格式，第一行应该是一个数字，表示总步骤数
-                num_steps = int(lines[0])
-                # 返回指定数量的步骤，跳过第一行（循环次数）
-                # 这些步骤将用于后续的处理
-                return lines[1:num_steps+1]
-            except (ValueError, IndexError):
-                # 如果无法从第一行获取有效的循环次数，显示警告并使用默认处理方式
-                st.warning("无法从第一行获取有效的循环次数，将使用默认的处理方式")
-                # 默认返回前10个非空行作为步骤
-                return lines[:10]
+            item = json.loads(match.group(0))
+        except ValueError:
+            continue
+        if isinstance(item, dict) and any(isinstance(item.get(field), str) for field in _PLAN_PROMPT_FIELDS):
+            items.append(item)
+    return (items, False) if items else (None, False)
+
+def _json_step(item):
+    # 校验一个JSON步骤，返回(步骤文本或None, 依赖下标列表或None, 问题描述或None)
+    if isinstance(item, str):
+        prompt, raw_dependencies = item, None
+    elif isinstance(item, dict):
+        prompt = next((item[field] for field in _PLAN_PROMPT_FIELDS if isinstance(item.get(field), str)), None)
+        raw_dependencies = next((item[field] for field in _PLAN_DEPENDENCY_FIELDS if field in item), None)
+    else:
+        return None, None, "步骤不是文本或对象"
+    if prompt is None or len(prompt.strip()) < PLAN_STEP_MIN_CHARS:
+        return None, None, "步骤内容为空或过短"
+    dependencies = None
+    if isinstance(raw_dependencies, list):
+        dependencies = [int(d) - 1 for d in raw_dependencies
+                        if isinstance(d, int) or (isinstance(d, str) and d.strip().isdigit())]
+    return prompt.strip(), dependencies, None
+
+def _parse_json_plan(answer, with_dependencies):
+    items, complete = _load_json_steps(answer)
+    if items is None:
+        return None
+    steps, dependencies, problems = [], [], {}
+    for item in items[:PLAN_MAX_STEPS]:
+        step, deps, problem = _json_step(item)
+        if problem:
+            problems[len(steps)] = problem
+        elif with_dependencies and deps is None:
+            # 没有depends_on字段时兼容写在步骤末尾的依赖标记
+            (step,), (deps,) = _split_dependencies([step])
+        steps.append(step)
+        dependencies.append(deps if with_dependencies else None)
+    if not complete:
+        problems[len(steps)] = "JSON不完整，回答可能被截断，之后的步骤已丢失"
+    return ParsedPlan(steps, dependencies, problems, "json")
+
+def _parse_text_plan(answer, with_dependencies):
+    lines = [line.strip() for line in answer.split("\n")]
+    nonblank = [line for line in lines if line]
+    count = None
+    if nonblank:
+        match = PLAN_COUNT_PATTERN.match(nonblank[0])
+        if match:
+            count = int(match.group(1))
+            lines = lines[lines.index(nonblank[0]) + 1:]
+    problems = {}
+    numbered = [PLAN_NUMBER_PATTERN.match(line) for line in lines]
+    if any(numbered):
+        # 带编号的步骤：编号行开始一个新步骤，之后没有编号的行是被换行打断的同一步骤；第一个编号之前的文字是说明，丢弃
+        by_number = {}
+        current = None
+        for line, match in zip(lines, numbered):
+            if match:
+                current = int(next(group for group in match.groups() if group))
+                if current in by_number:
+                    # 编号重复时（如步骤中引用了"1."开头的小点）把这一行当作上一步的内容
+                    current = max(by_number)
+                    by_number[current] += " " + line
+                else:
+                    by_number[current] = line[match.end():]
+            elif line and current is not None:
+                by_number[current] += " " + line
+        last = max(by_number)
+        total = count or last
+        steps = [by_number.get(n, "").strip() or None for n in range(1, min(total, PLAN_MAX_STEPS) + 1)]
+        for i, step in enumerate(steps):
+            if step is None:
+                problems[i] = "缺少这个编号的步骤"
+        plan_format = "numbered"
+    else:
+        # 没有编号：按空行分段，段内被换行打断的内容合并为一个步骤；没有空行时每行一个步骤
+        lines = [PLAN_BULLET_PATTERN.sub("", line) for line in lines]
+        blocks = re.split(r"\n\s*\n", "\n".join(lines).strip())
+        if len(blocks) > 1 and any("\n" in block for block in blocks):
+            steps = [" ".join(line.strip() for line in block.split("\n") if line.strip()) for block in blocks]
         else:
-            # 如果响应中没有思考标记，显示警告
-            st.warning("未找到</think>标记，可能响应不完整")
-            # 将内容按行分割，并移除空行
-            lines = [p.strip() for p in response.strip().split('\n') if p.strip()]
-            try:
-                # 尝试从第一行获取循环次数
-                num_steps = int(lines[0])
-                # 返回指定数量的步骤，跳过第一行
-                return lines[1:num_steps+1]
-            except (ValueError, IndexError):
-                # 如果无法获取有效的循环次数，返回前10个非空行作为步骤
-                return lines[:10]
-    # 如果响应为空或None，返回空列表
-    return []
\ No newline at end of file
+            steps = [line for line in lines if line]
+        # 开头以冒号结尾的短行是引导语（如"好的，步骤如下："）
+        while steps and len(steps[0]) < 40 and steps[0].endswith((":", "：")):
+            steps.pop(0)
+        if count:
+            steps = steps[:count] + [None] * (count - len(steps))
+            for i in range(len(steps)):
+                if steps[i] is None:
+                    problems[i] = "步骤数少于第一行给出的数量"
+        steps = steps[:PLAN_MAX_STEPS]
+        plan_format = "lines"
+    for i, step in enumerate(steps):
+        if step is not None and len(step) < PLAN_STEP_MIN_CHARS:
+            steps[i] = None
+            problems[i] = "步骤内容为空或过短"
+    problems = {i: problem for i, problem in problems.items() if i < len(steps)}
+    dependencies = [None] * len(steps)
+    if with_dependencies:
+        for i, step in enumerate(steps):
+            if step is not None:
+                (steps[i],), (dependencies[i],) = _split_dependencies([step])
+    return ParsedPlan(steps, dependencies, problems, plan_format)
+
+def parse_plan(response, with_dependencies=False, on_event=None):
+    """
+    容错地解析规划AI的回答
+
+    先去掉推理过程，回答中有JSON时按JSON格式解析（兼容被截断的JSON），否则按文本格式解析：
+    第一行的步骤数可以带文字；带编号的步骤可以跨多行，编号之前的说明文字会被忽略，缺少的编号会被标记出来；
+    没有编号时按空行或按行拆分。缺失或明显残缺的步骤在steps中为None，可以只补写这些步骤（见ChainRunner）。
+
+    Args:
+        response (str): 规划AI返回的原始文本
+        with_dependencies (bool): 是否同时解析依赖（JSON的depends_on字段或步骤末尾的依赖标记）
+        on_event (callable): on_event(事件名, 数据字典)，用于通知原始响应(raw_plan)和解析警告(warning)
+
+    Returns:
+        ParsedPlan: 解析结果，回答为空时steps为空列表
+    """
+    emit = on_event or _emit_nothing
+    if not response:
+        return ParsedPlan([], [], {}, "lines")
+    # 通知界面显示原始响应内容（可展开查看）
+    emit("raw_plan", {"response": response})
+    reasoning, answer = split_reasoning(response)
+    if not answer:
+        # 回答被截断在推理过程中，只能从推理过程中尽量找出步骤
+        emit("warning", {"message": "规划回答中只有推理过程，可能被截断，将尝试从中解析步骤"})
+        answer = reasoning
+    parsed = _parse_json_plan(answer, with_dependencies) if _json_candidates(answer) else None
+    if parsed is None or not any(parsed.steps):
+        parsed = _parse_text_plan(answer, with_dependencies)
+    if len(parsed.steps) >= PLAN_MAX_STEPS:
+        emit("warning", {"message": f"规划的步骤过多，只使用前{PLAN_MAX_STEPS}个"})
+    for index, problem in sorted(parsed.problems.items()):
+        emit("warning", {"message": f"规划的第{index + 1}个步骤有问题：{problem}"})
+    return parsed
+
+def parse_plan_repair(response, missing):
+    """
+    解析补写步骤的回答
+
+    Args:
+        response (str): 补写调用的回答，格式见PLAN_REPAIR_PROMPT
+        missing (list): 需要补写的步骤下标（从0开始）
+
+    Returns:
+        dict: {步骤下标: (步骤文本, 依赖下标列表或None)}，只包含成功补写的步骤；
+              回答中没有给出index（或index不在missing中）的步骤按顺序填入还没有补上的位置
+    """
+    if not response:
+        return {}
+    _, answer = split_reasoning(response)
+    items, _ = _load_json_steps(answer or response)
+    repaired = {}
+    unnumbered = []
+    for item in items or []:
+        step, dependencies, problem = _json_step(item)
+        if problem:
+            continue
+        index = item.get("index") if isinstance(item, dict) else None
+        index = int(index) - 1 if isinstance(index, int) or (isinstance(index, str) and index.strip().isdigit()) else None
+        if index in missing and index not in repaired:
+            repaired[index] = (step, dependencies)
+        else:
+            unnumbered.append((step, dependencies))
+    for index, item in zip([i for i in missing if i not in repaired], unnumbered):
+        repaired[index] = item
+    return repaired
+
+def process_qwq_response(response, with_dependencies=False, on_event=None):
+    """
+    把规划AI的回答解析为步骤列表，缺失或格式有问题的步骤直接去掉（需要补写时使用parse_plan）
+
+    Args:
+        response (str): 规划AI返回的原始文本
+        with_dependencies (bool): 是否同时解析每个步骤的依赖
+        on_event (callable): on_event(事件名, 数据字典)，用于通知原始响应(raw_plan)和解析警告(warning)
+
+    Returns:
+        list: 步骤文本列表；with_dependencies为True时返回(步骤列表, 依赖列表)
+    """
+    steps, dependencies = parse_plan(response, with_dependencies, on_event).usable()
+    if with_dependencies:
+        return steps, dependencies
+    return steps
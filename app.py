@@ -1,326 +1,881 @@
+import multiprocessing
+import threading
+import time
+import uuid
+
+# 打包成exe后，OCR进程池以spawn方式启动的工作进程会重新运行这个入口，
+# freeze_support让它们直接执行工作进程的任务后退出，而不是再启动一次界面；未打包时不做任何事
+multiprocessing.freeze_support()
+
 import streamlit as st
-from ai_utils import call_qwq_api, process_qwq_response, MODEL_CONFIGS
-import fitz  # PyMuPDF
-import docx2txt  # 导入docx2txt库用于处理Word文档
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from ai_utils import MODEL_CONFIGS, INPUT_OPTIMIZER_MODEL, PLAN_FORMATS
+from chain_runner import ChainRunner, ChainConfig, MESSAGE_LAYOUTS
+from chain_dag import graph_width, DEFAULT_MAX_WORKERS
+from doc_index import DEFAULT_CONTEXT_TOKENS, DEFAULT_TOP_K
+from response_cache import get_response_cache
+from checkpoint import get_checkpoint_store
+from key_pool import KeyPool, DEFAULT_KEY_RPM, DEFAULT_KEY_TPM
+import model_router
+import latency_tracker
+from telemetry import timeline_rows, to_jsonl, to_prometheus
+from doc_extract import OCR_DPI, OCR_PAGE_TIMEOUT
+from corpus import build_corpus, FILE_KINDS
+from session_store import SessionStore, cleanup_expired_sessions
 
 # 页面配置 - 设置页面标题和宽屏布局
 st.set_page_config(page_title="AI Chain Agent", layout="wide")
 
 # 初始化会话状态变量
-if 'current_step' not in st.session_state:
-    st.session_state.current_step = 0
-if 'prompts' not in st.session_state:
-    st.session_state.prompts = []
-if 'results' not in st.session_state:
-    st.session_state.results = []
-if 'token_usage' not in st.session_state:
-    st.session_state.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-if 'processing_complete' not in st.session_state:
-    st.session_state.processing_complete = False
-if 'chain_input' not in st.session_state:
-    st.session_state.chain_input = ""
+# 链式处理的步骤、结果和用量统计都保存在runner中，会话里只保存界面设置和上传的文档
+# 文档全文、步骤结果和原始响应中较大的部分保存在会话自己的磁盘目录里，会话状态中只保留引用，
+# 会话过期后目录随之删除；新会话创建时顺便清理服务重启前遗留的过期目录
+if 'session_store' not in st.session_state:
+    cleanup_expired_sessions()
+    st.session_state.session_store = SessionStore()
+# 检查点的所有者编号：检查点数据库由所有访问者共用，每个浏览器会话只能看到和继续自己创建的运行
+# 编号只保存在会话状态中，不写进地址栏，否则拿到链接的人就能读取别人的文档和结果；
+# 刷新页面后会话状态丢失时，可以在"未完成的运行"中输入运行编号继续
+if 'checkpoint_owner' not in st.session_state:
+    st.session_state.checkpoint_owner = uuid.uuid4().hex
+if 'runner' not in st.session_state:
+    st.session_state.runner = ChainRunner(ChainConfig(api_keys=[], checkpoint_owner=st.session_state.checkpoint_owner),
+                                          store=st.session_state.session_store)
+if 'api_keys' not in st.session_state:
+    st.session_state.api_keys = []
+if 'api_key_count' not in st.session_state:
+    st.session_state.api_key_count = 2
+if 'key_rpm' not in st.session_state:
+    st.session_state.key_rpm = DEFAULT_KEY_RPM
+if 'key_tpm' not in st.session_state:
+    st.session_state.key_tpm = DEFAULT_KEY_TPM
 if 'selected_model' not in st.session_state:
     st.session_state.selected_model = "Qwen/QwQ-32B"
-if 'current_api' not in st.session_state:
-    st.session_state.current_api = 0
-if 'pdf_text' not in st.session_state:
-    st.session_state.pdf_text = ""
-if 'docx_text' not in st.session_state:
-    st.session_state.docx_text = ""
-
-# 定义PDF文本提取函数
-def extract_text_from_pdf(uploaded_file):
-    text = ""
+# 上传的文档：多个文件合并后的全文（或其磁盘引用）和文档类型名称
+if 'document_text' not in st.session_state:
+    st.session_state.document_text = ""
+if 'document_label' not in st.session_state:
+    st.session_state.document_label = ""
+# 按角色指定的模型{角色: 模型}，没有指定的角色使用上面选择的模型（指令优化默认使用专用的优化模型）
+if 'model_routes' not in st.session_state:
+    st.session_state.model_routes = {"optimizer": INPUT_OPTIMIZER_MODEL}
+if 'auto_route' not in st.session_state:
+    st.session_state.auto_route = False
+# 融合规划：指令优化和步骤规划在同一次调用中完成
+if 'fused_planning' not in st.session_state:
+    st.session_state.fused_planning = False
+# 规划回答的格式：text为每行一个步骤，json为JSON对象
+if 'plan_format' not in st.session_state:
+    st.session_state.plan_format = "text"
+# 提前结束：中间步骤认为任务已经完成时跳过剩下的中间步骤，可以再用小模型确认；
+# 输出预算：中间步骤的最大输出按最近的输出长度设置
+if 'early_stop' not in st.session_state:
+    st.session_state.early_stop = False
+if 'early_stop_check' not in st.session_state:
+    st.session_state.early_stop_check = False
+if 'adaptive_max_tokens' not in st.session_state:
+    st.session_state.adaptive_max_tokens = False
+# 根据观测到的响应时间调整单次请求的超时；对明显变慢的请求用另一个密钥再发一次
+if 'adaptive_timeout' not in st.session_state:
+    st.session_state.adaptive_timeout = True
+if 'hedge' not in st.session_state:
+    st.session_state.hedge = False
+# 整条链的时间上限（分钟），0表示不限制
+if 'chain_deadline_minutes' not in st.session_state:
+    st.session_state.chain_deadline_minutes = 0
+# 用户点击了停止按钮：不再自动继续剩余的步骤，直到点击继续处理或重新提交
+if 'stopped' not in st.session_state:
+    st.session_state.stopped = False
+if 'stream_mode' not in st.session_state:
+    st.session_state.stream_mode = True
+if 'dag_mode' not in st.session_state:
+    st.session_state.dag_mode = False
+if 'max_workers' not in st.session_state:
+    st.session_state.max_workers = DEFAULT_MAX_WORKERS
+if 'compact_context' not in st.session_state:
+    st.session_state.compact_context = False
+if 'message_layout' not in st.session_state:
+    st.session_state.message_layout = "merged"
+if 'strip_reasoning' not in st.session_state:
+    st.session_state.strip_reasoning = True
+if 'doc_retrieval' not in st.session_state:
+    st.session_state.doc_retrieval = True
+if 'doc_context_tokens' not in st.session_state:
+    st.session_state.doc_context_tokens = DEFAULT_CONTEXT_TOKENS
+if 'doc_top_k' not in st.session_state:
+    st.session_state.doc_top_k = DEFAULT_TOP_K
+if 'response_cache' not in st.session_state:
+    st.session_state.response_cache = False
+if 'cache_bypass' not in st.session_state:
+    st.session_state.cache_bypass = False
+# 原始API响应：{调用编号: (步骤名称, 响应数据或其磁盘引用)}，只在用户选择查看时才加载并渲染到页面上
+if 'raw_responses' not in st.session_state:
+    st.session_state.raw_responses = {}
+if 'ocr_dpi' not in st.session_state:
+    st.session_state.ocr_dpi = OCR_DPI
+if 'ocr_page_timeout' not in st.session_state:
+    st.session_state.ocr_page_timeout = OCR_PAGE_TIMEOUT
+
+# 显示文档提取过程中产生的提示信息（如哪些页面使用了OCR）
+def show_extract_notes(notes):
+    for level, message in notes:
+        if level == "warning":
+            st.warning(message)
+        else:
+            st.info(message)
+
+# 导入上传的文件：并行提取，去掉重复的文件和重复的页面/段落，合并成一份带来源标记的文档
+# 提取结果按文件内容哈希缓存，相同文件再次提交时不会重复解析；扫描件的OCR分发到多个进程并行识别
+def ingest_files(uploaded_files):
+    progress = st.progress(0.0, text="正在提取文件...")
+    # 扫描件OCR较慢，在进度条下面显示正在提取的文件各自完成了多少页
+    page_status = st.empty()
+    page_texts = {}
+
+    def on_progress(done, total, name):
+        progress.progress(done / total, text=f"正在提取文件... {done}/{total} {name}")
+        page_texts.pop(name, None)
+        page_status.caption("；".join(page_texts.values()))
+
+    def on_page_progress(name, done, total):
+        page_texts[name] = f"{name}: 已完成 {done}/{total} 页"
+        page_status.caption("；".join(page_texts.values()))
+
     try:
-        # 创建临时文件以供PyMuPDF处理
-        with open("temp.pdf", "wb") as f:
-            f.write(uploaded_file.getvalue())
-        
-        # 尝试使用PyMuPDF直接提取文本
-        pdf_document = fitz.open("temp.pdf")
-        text = ""
-        for page_num in range(pdf_document.page_count):
-            page = pdf_document.load_page(page_num)
-            page_text = page.get_text()
-            
-            # 如果页面文本为空或几乎为空，尝试使用OCR
-            if len(page_text.strip()) < 50:  # 假设少于50个字符的页面可能是扫描件
-                try:
-                    # 导入OCR所需库
-                    import pytesseract
-                    from PIL import Image
-                    
-                    # 将PDF页面渲染为图片
-                    pix = page.get_pixmap()
-                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                    
-                    # 使用pytesseract进行OCR识别
-                    ocr_text = pytesseract.image_to_string(img, lang='chi_sim')  # 'chi_sim'表示简体中文
-                    text += ocr_text + "\n\n"
-                    st.info(f"第{page_num+1}页使用OCR识别")
-                except ImportError:
-                    st.warning("OCR功能需要安装pytesseract和Pillow库。请使用'pip install pytesseract pillow'安装。")
-                    text += page_text
-                except Exception as ocr_error:
-                    st.warning(f"OCR处理出错: {ocr_error}，使用常规文本提取")
-                    text += page_text
+        corpus = build_corpus([(f.name, f.getvalue()) for f in uploaded_files], on_progress=on_progress,
+                              on_page_progress=on_page_progress,
+                              dpi=st.session_state.ocr_dpi, page_timeout=st.session_state.ocr_page_timeout)
+    finally:
+        progress.empty()
+        page_status.empty()
+    for source in corpus.sources:
+        if source["error"]:
+            st.error(f"{source['name']} 处理出错: {source['error']}")
+        elif source["duplicate_of"]:
+            st.info(f"{source['name']} 与 {source['duplicate_of']} 内容相同，已跳过")
+        show_extract_notes((level, f"{source['name']}: {message}") for level, message in source["notes"])
+    return corpus
+
+# 显示每个文件的导入结果和合并后的文档大小
+def show_corpus_summary(summary, sources):
+    st.caption(f"导入 {summary['files']} 个文件（使用 {summary['used_files']} 个，重复 {summary['duplicate_files']} 个，"
+               f"失败 {summary['failed_files']} 个），共 {summary['input_bytes'] / 1024:.0f} KB，"
+               f"合并后 {summary['chars']} 字，去掉重复的页面/段落 {summary['removed_blocks']} 处"
+               f"（{summary['removed_chars']} 字），耗时 {summary['elapsed']:.2f} 秒")
+    if len(sources) > 1:
+        with st.expander("查看各文件的导入情况"):
+            st.dataframe([{
+                "文件": source["name"],
+                "大小(KB)": round(source["bytes"] / 1024, 1),
+                "字数": source["chars"],
+                "去重(字)": source["removed_chars"],
+                "状态": source["error"] or (f"与{source['duplicate_of']}重复" if source["duplicate_of"] else "已使用")
+            } for source in sources], use_container_width=True, hide_index=True)
+
+# 显示开始第一个步骤之前的准备耗时（文档处理与模型调用同时进行，总耗时不是各项之和）
+def show_setup(setup):
+    parts = [f"文档处理 {setup['ingest']:.1f}s（与模型调用同时进行）"]
+    if setup["fused"]:
+        parts.append(f"指令优化与步骤规划（一次调用）{setup['plan']:.1f}s")
+    else:
+        parts.append(f"指令优化 {setup['optimize']:.1f}s")
+        parts.append(f"步骤规划 {setup['plan']:.1f}s")
+    st.caption(f"⏱️ 开始第一步之前的准备耗时 {setup['total']:.1f} 秒：{'，'.join(parts)}")
+
+# 保存上传文档的文本，大文档写到会话目录中，会话状态里只保留引用
+def store_text(text):
+    return st.session_state.session_store.put(text)
+
+# 把上传文档的文本交给runner，内容有变化时会重新构建检索索引
+def sync_document():
+    document = st.session_state.session_store.get(st.session_state.document_text)
+    return st.session_state.runner.set_document(document, st.session_state.document_label)
+
+# 清空上传的文档
+def clear_document():
+    st.session_state.document_text = ""
+    st.session_state.document_label = ""
+
+# 根据侧边栏的设置生成runner的配置
+def build_chain_config():
+    api_keys = [key for key in st.session_state.api_keys if key]
+    return ChainConfig(
+        api_keys=api_keys,
+        key_rpm=st.session_state.key_rpm,
+        key_tpm=st.session_state.key_tpm,
+        model=st.session_state.selected_model,
+        optimizer_model=st.session_state.model_routes.get("optimizer") or st.session_state.selected_model,
+        model_routes=dict(st.session_state.model_routes),
+        auto_route=st.session_state.auto_route,
+        stream=st.session_state.stream_mode,
+        dag_mode=st.session_state.dag_mode,
+        max_workers=st.session_state.max_workers,
+        compact_context=st.session_state.compact_context,
+        strip_reasoning=st.session_state.strip_reasoning,
+        message_layout=st.session_state.message_layout,
+        doc_retrieval=st.session_state.doc_retrieval,
+        doc_context_tokens=st.session_state.doc_context_tokens,
+        doc_top_k=st.session_state.doc_top_k,
+        use_cache=st.session_state.response_cache,
+        cache_bypass=st.session_state.cache_bypass,
+        chain_deadline=st.session_state.chain_deadline_minutes * 60 or None,
+        adaptive_timeout=st.session_state.adaptive_timeout,
+        hedge=st.session_state.hedge,
+        fused_planning=st.session_state.fused_planning,
+        plan_format=st.session_state.plan_format,
+        early_stop=st.session_state.early_stop,
+        early_stop_check=st.session_state.early_stop_check,
+        adaptive_max_tokens=st.session_state.adaptive_max_tokens,
+        checkpoint_owner=st.session_state.checkpoint_owner
+    )
+
+# 把流式输出中已经收到的内容渲染到页面占位符中，接收完毕后不再显示光标
+def render_stream(placeholder, content, reasoning, finished=False):
+    if content:
+        placeholder.markdown(content if finished else content + "▌")
+    elif reasoning:
+        # 还没有正式回答时，只显示思考过程的最后一段，避免页面被长篇推理刷屏
+        placeholder.caption(f"🤔 思考中...{reasoning[-500:]}")
+
+# 生成runner的事件回调，把处理过程显示在页面上
+# 并行模式下回调会在工作线程中执行，需要先绑定当前脚本的运行上下文才能在页面上输出
+# on_waiting在等待步骤完成时定期在脚本线程中调用，页面在这时刷新，停止按钮也才能中断脚本
+def make_event_handler(on_step_done=None, on_waiting=None):
+    script_ctx = get_script_run_ctx()
+    script_thread = threading.current_thread()
+    placeholders = {}
+
+    def handle(event, data):
+        if threading.current_thread() is not script_thread:
+            add_script_run_ctx(threading.current_thread(), script_ctx)
+        if event == "call_start":
+            # 显示当前尝试信息，流式模式下为这次调用准备一个占位符
+            retry_msg = "" if data["attempt"] == 0 else f"（第{data['attempt']}次重试）"
+            hedge_msg = "（对冲请求）" if data.get("hedge") else ""
+            st.info(f"正在使用API {data['key_index'] + 1} 发送请求（{data['step'] or '未命名'}）...{hedge_msg}{retry_msg}")
+            if data["stream"]:
+                placeholders[data["call_id"]] = st.empty()
+        elif event == "status":
+            st.write(f"API响应状态码: {data['status_code']}")
+        elif event == "delta":
+            placeholder = placeholders.get(data["call_id"])
+            if placeholder is not None:
+                render_stream(placeholder, data["content"], data["reasoning"], data["finished"])
+        elif event == "http_error":
+            st.error(f"API {data['key_index'] + 1} 请求失败: HTTP {data['status_code']}")
+        elif event == "retry":
+            if data["reason"] == "server":
+                st.warning(f"API {data['key_index'] + 1} 检测到服务器错误，将在{data['delay']}秒后重试...")
+            elif data["reason"] == "rate_limit":
+                st.warning(f"API {data['key_index'] + 1} 被限流，将改用其他密钥重试（该密钥暂停{data['delay']:.0f}秒）...")
             else:
-                text += page_text
-        
-        pdf_document.close()
-        
-        # 删除临时文件
-        import os
-        os.remove("temp.pdf")
-    except Exception as e:
-        st.error(f"PDF文件处理出错: {e}")
-    return text
-
-# 定义Word文档文本提取函数
-def extract_text_from_docx(uploaded_file):
-    text = ""
-    try:
-        # 创建临时文件以供docx2txt处理
-        with open("temp.docx", "wb") as f:
-            f.write(uploaded_file.getvalue())
-        
-        # 使用docx2txt提取文本
-        text = docx2txt.process("temp.docx")
-        
-        # 删除临时文件
-        import os
-        os.remove("temp.docx")
-    except Exception as e:
-        st.error(f"Word文件处理出错: {e}")
-    return text
+                st.warning(f"网络请求异常，将在{data['delay']}秒后重试...")
+        elif event == "queued":
+            st.caption(f"{data['step'] or '本次调用'}：同时进行的请求已达上限（{data['limit']}个），正在排队...")
+        elif event == "hedge":
+            st.warning(f"{data['step'] or '本次调用'}超过 {data['delay']:.1f} 秒还没有响应，再发送一个对冲请求，采用先响应的一个")
+        elif event == "request_error":
+            st.error(data["message"])
+        elif event == "call_failed":
+            st.error(data["message"])
+            body = data.get("body")
+            if isinstance(body, dict):
+                st.json(body)
+            elif body:
+                st.error("原始响应内容:")
+                st.code(body)
+        elif event == "call_end":
+            # 完整的响应数据可能很大，先保存起来，在"原始API响应"中按需查看
+            response_data = data["response_data"]
+            st.session_state.raw_responses[data["call_id"]] = (data["step"], store_text(response_data))
+            if response_data.get("choices"):
+                st.caption(f"{data['step'] or '未命名'} Finish Reason: {response_data['choices'][0].get('finish_reason', 'unknown')}")
+        elif event == "cache_hit":
+            st.success(f"⚡ {data['step'] or '本次调用'}命中响应缓存，未调用API")
+        elif event == "warning":
+            st.warning(data["message"])
+        elif event == "step_error":
+            st.error(f"{data['step']} 出错: {data['message']}")
+            st.expander("错误详情").code(data["traceback"])
+        elif event == "raw_plan":
+            # 显示原始响应内容（可展开查看）
+            st.expander("原始响应内容").code(data["response"])
+        elif event == "optimized":
+            # 显示优化前后的对比，帮助用户了解指令是如何被优化的
+            with st.expander("查看指令优化前后对比"):
+                st.subheader("原始指令")
+                st.write(data["original"])
+                st.subheader("优化后的指令")
+                st.write(data["optimized"])
+        elif event == "step_done":
+            st.success(f"步骤 {data['index'] + 1} 处理完成")
+            if on_step_done:
+                on_step_done(data["index"], data["done"], data["total"])
+        elif event == "early_stop":
+            st.info(f"步骤 {data['index'] + 1} 之后任务已经可以总结，跳过剩下的 {data['skipped']} 个中间步骤，直接生成最终答复")
+        elif event == "waiting":
+            if on_waiting:
+                on_waiting(data["done"], data["total"])
+
+    return handle
+
+# 清空所有步骤、结果和统计，重新开始，会话目录中只保留仍在使用的文档
+def reset_runner():
+    store = st.session_state.session_store
+    store.clear(keep=[st.session_state.document_text])
+    st.session_state.runner = ChainRunner(build_chain_config(), store=store)
+    st.session_state.raw_responses = {}
+    st.session_state.stopped = False
+
+# 从检查点恢复一次运行
+def resume_run(run_id):
+    runner = st.session_state.runner
+    if not runner.resume(run_id):
+        return False
+    # 把检查点中的文档放回会话，后续步骤继续使用同一份文档
+    st.session_state.document_text = store_text(runner.document_text)
+    st.session_state.document_label = runner.document_label
+    return True
+
+runner = st.session_state.runner
 
 # 侧边栏配置
 with st.sidebar:
     st.title("⚙️ 配置")
-    api_key = st.text_input("API Key 1", type="password")
-    if api_key:
-        st.session_state.api_key = api_key
-    
-    api_key2 = st.text_input("API Key 2", type="password")
-    if api_key2:
-        st.session_state.api_key2 = api_key2
-    
-    st.info(f"当前使用: API {st.session_state.current_api + 1}")
-    
+    # API密钥：可以填写任意多个，每次调用自动选择负载最小的健康密钥
+    api_keys = []
+    for i in range(st.session_state.api_key_count):
+        api_keys.append(st.text_input(f"API Key {i + 1}", type="password"))
+    st.session_state.api_keys = api_keys
+    if st.button("添加API Key"):
+        st.session_state.api_key_count += 1
+        st.rerun()
+
+    # 每个密钥的限额：超出限额的请求在本地排队，而不是发出去被服务器限流
+    with st.expander("密钥限额与使用情况"):
+        st.session_state.key_rpm = st.number_input("每个密钥每分钟请求数(RPM)", 1, 100000, st.session_state.key_rpm, step=10)
+        st.session_state.key_tpm = st.number_input("每个密钥每分钟Token数(TPM)", 1000, 10000000, st.session_state.key_tpm, step=1000)
+        entered_keys = [key for key in api_keys if key]
+        if entered_keys:
+            for key in KeyPool(entered_keys, st.session_state.key_rpm, st.session_state.key_tpm).snapshot():
+                latency = f"{key['latency']:.1f}s" if key["latency"] is not None else "-"
+                status = f"冷却中 {key['cooldown']:.0f}s" if key["cooldown"] > 0 else "正常"
+                st.caption(f"{key['label']} | {status} | 请求 {key['requests']} | Token {key['tokens']} | "
+                           f"失败 {key['failures']}（限流 {key['rate_limited']}）| 平均延迟 {latency} | 进行中 {key['in_flight']}")
+
     model_options = list(MODEL_CONFIGS.keys())
     selected_model = st.selectbox(
         "选择模型",
         model_options,
         index=model_options.index(st.session_state.selected_model)
     )
+    # 按角色选择模型：中间步骤可以换成便宜快速的模型，只在规划和最终总结时使用推理模型
+    # 某个模型多次重试仍然失败时会自动换用其他模型
+    with st.expander("按步骤角色选择模型"):
+        follow_label = "跟随上面选择的模型"
+        for role in model_router.ROLES:
+            options = [follow_label] + model_options
+            if role == "optimizer" and INPUT_OPTIMIZER_MODEL not in options:
+                options.insert(1, INPUT_OPTIMIZER_MODEL)
+            current = st.session_state.model_routes.get(role)
+            choice = st.selectbox(model_router.ROLE_LABELS[role], options,
+                                  index=options.index(current) if current in options else 0, key=f"route_{role}")
+            st.session_state.model_routes[role] = None if choice == follow_label else choice
+        st.session_state.auto_route = st.checkbox(
+            "中间步骤自动选择最快的模型", value=st.session_state.auto_route,
+            help="根据已经观测到的首字延迟、生成速度和本步骤的输入长度，在放得下输入的模型中选预计最快的")
+        model_stats = model_router.snapshot()
+        for item in model_stats:
+            ttft = f"{item['ttft']:.1f}s" if item["ttft"] is not None else "-"
+            speed = f"{item['tokens_per_sec']:.0f} Token/s" if item["tokens_per_sec"] else "-"
+            status = f"冷却中 {item['cooldown']:.0f}s" if item["cooldown"] > 0 else "正常"
+            st.caption(f"{item['model']} | {status} | 调用 {item['calls']} | 失败 {item['failures']} | "
+                       f"首字 {ttft} | {speed}")
+    # 整条链的时间上限：到时后正在进行的调用（包括重试等待）立即放弃，已完成的步骤保留
+    st.session_state.chain_deadline_minutes = st.number_input(
+        "单次处理时间上限(分钟，0为不限制)", 0, 600, st.session_state.chain_deadline_minutes, step=5)
+
+    # 尾延迟控制：按每个模型观测到的响应时间调整超时，偶尔卡住的请求用另一个密钥再发一次
+    with st.expander("超时与对冲请求"):
+        st.session_state.adaptive_timeout = st.checkbox(
+            "自适应超时", value=st.session_state.adaptive_timeout,
+            help="单次请求的超时按该模型平时响应时间的p99计算，卡住的请求更早重试，不超过重试策略的固定超时")
+        st.session_state.hedge = st.checkbox(
+            "对冲慢请求", value=st.session_state.hedge,
+            help=f"请求超过该模型平时的响应时间还没有响应时，用另一个密钥再发一次，采用先响应的一个；"
+                 f"对冲请求最多占全部调用的{latency_tracker.HEDGE_BUDGET:.0%}")
+        latency_stats = latency_tracker.snapshot()
+        for item in latency_stats["models"]:
+            mode_text = "流式" if item["stream"] else "非流式"
+            if item["kind"]:
+                mode_text += f"，{model_router.ROLE_LABELS.get(item['kind'], item['kind'])}"
+            st.caption(f"{item['model']}（{mode_text}）| 样本 {item['samples']} | p50 {item['p50']:.1f}s | "
+                       f"p95 {item['p95']:.1f}s | p99 {item['p99']:.1f}s")
+        if latency_stats["hedges"]:
+            st.caption(f"本进程共 {latency_stats['calls']} 次调用，发出对冲请求 {latency_stats['hedges']} 次")
+
+    # 流式输出开关：开启后AI的回答会边生成边显示
+    st.session_state.stream_mode = st.checkbox("流式输出", value=st.session_state.stream_mode)
+
+    # 融合规划：规划模型在同一次调用中先优化指令再拆分步骤，少一次推理模型的往返
+    st.session_state.fused_planning = st.checkbox(
+        "指令优化与步骤规划合并为一次调用", value=st.session_state.fused_planning,
+        help="由规划模型同时完成指令优化和步骤拆分，不再单独调用指令优化模型，第一步可以更早开始")
+
+    # 规划格式：JSON格式的步骤可以跨行，不依赖第一行的步骤数；两种格式下个别步骤缺失时都只补写这几个步骤
+    plan_format_labels = {"text": "文本（每行一个步骤）", "json": "JSON（结构化，更不容易解析出错）"}
+    st.session_state.plan_format = st.selectbox(
+        "规划回答格式", PLAN_FORMATS, index=PLAN_FORMATS.index(st.session_state.plan_format),
+        format_func=plan_format_labels.get
+    )
+
+    # 提前结束和输出预算：缩短链条，中间步骤不再预留模型的最大输出
+    with st.expander("链条长度与输出预算"):
+        st.session_state.early_stop = st.checkbox(
+            "目标达成后提前总结", value=st.session_state.early_stop,
+            help="每一步完成后先在本地检查剩下步骤的内容是否已经被覆盖，接近完成的步骤也会顺便判断整体任务是否已经完成，完成时跳过剩下的中间步骤，直接生成最终答复（只在顺序执行时生效）")
+        if st.session_state.early_stop:
+            st.session_state.early_stop_check = st.checkbox(
+                "提前总结前用小模型确认", value=st.session_state.early_stop_check,
+                help="跳过步骤之前再由小模型确认一次，多一次很便宜的调用，减少误判")
+        st.session_state.adaptive_max_tokens = st.checkbox(
+            "按历史输出长度设置中间步骤的输出上限", value=st.session_state.adaptive_max_tokens,
+            help="中间步骤的max_tokens按最近同类步骤的输出长度估算，最终总结仍使用模型的最大输出；回答被截断时自动按最大输出重新生成")
+
+    # 并行模式：规划时让AI标出步骤之间的依赖，互不依赖的步骤同时执行
+    st.session_state.dag_mode = st.checkbox("并行执行独立步骤", value=st.session_state.dag_mode)
+    if st.session_state.dag_mode:
+        st.session_state.max_workers = st.slider("最大并行步骤数", 1, 8, st.session_state.max_workers)
+
+    # 上下文压缩：之前步骤的输出超出模型预算时，较早的输出改用摘要，避免提示越来越长
+    st.session_state.compact_context = st.checkbox("压缩历史输出（节省Token）", value=st.session_state.compact_context)
+
+    # 前缀稳定的消息布局：文档和整体任务固定放在最前面，之前的步骤按多轮对话追加，服务端可以复用前缀缓存
+    layout_labels = {"merged": "合并为一条消息", "prefix": "前缀稳定（利于服务端缓存）"}
+    st.session_state.message_layout = st.selectbox(
+        "步骤消息布局", MESSAGE_LAYOUTS, index=MESSAGE_LAYOUTS.index(st.session_state.message_layout),
+        format_func=layout_labels.get
+    )
+
+    # 去掉推理过程：推理模型回答中的<think>思考过程只用于显示，不再交给后续步骤
+    st.session_state.strip_reasoning = st.checkbox("只把正式回答交给后续步骤（去掉推理过程）",
+                                                   value=st.session_state.strip_reasoning)
+
+    # 文档检索：每一步只发送文档中与该步骤相关的片段，而不是整份文档
+    st.session_state.doc_retrieval = st.checkbox("文档检索（只发送相关片段）", value=st.session_state.doc_retrieval)
+    if st.session_state.doc_retrieval:
+        st.session_state.doc_context_tokens = st.number_input("每步文档片段Token预算", 500, 100000,
+                                                              st.session_state.doc_context_tokens, step=500)
+        st.session_state.doc_top_k = st.slider("每步最多片段数", 1, 30, st.session_state.doc_top_k)
+
+    # 文档处理设置：扫描件OCR的渲染分辨率和单页超时时间
+    with st.expander("文档处理设置"):
+        st.session_state.ocr_dpi = st.slider("OCR分辨率(DPI)", 72, 300, st.session_state.ocr_dpi, step=6)
+        st.session_state.ocr_page_timeout = st.number_input("单页OCR超时(秒)", 5, 600, st.session_state.ocr_page_timeout, step=5)
+
+    # 响应缓存：相同的模型、消息和参数直接复用上次的回答，保存在本地磁盘上
+    st.session_state.response_cache = st.checkbox("启用响应缓存", value=st.session_state.response_cache)
+    if st.session_state.response_cache:
+        cache_info = get_response_cache().stats()
+        st.caption(f"缓存条目 {cache_info['entries']} 个，占用 {cache_info['bytes'] / 1024 / 1024:.1f} MB")
+        if st.button("清空响应缓存"):
+            get_response_cache().clear()
+            st.rerun()
+
+    # 未完成的运行：每完成一步都会保存检查点，可以从最后完成的步骤继续
+    with st.expander("未完成的运行"):
+        try:
+            unfinished_runs = get_checkpoint_store().list_runs(limit=10, unfinished_only=True,
+                                                                owner=st.session_state.checkpoint_owner)
+        except Exception as e:
+            unfinished_runs = []
+            st.caption(f"读取检查点出错: {e}")
+        if not unfinished_runs:
+            st.caption("没有未完成的运行")
+        for run in unfinished_runs:
+            st.caption(f"{run['user_prompt'][:30]}… | 已完成 {run['done']}/{run['total']} 步")
+            if run["run_id"] != runner.run_id and st.button("继续这次运行", key=f"resume_{run['run_id']}"):
+                reset_runner()
+                resume_run(run["run_id"])
+                st.rerun()
+        # 页面刷新或服务重启后会话状态会丢失，输入之前记下的运行编号继续，已完成的步骤不会重新执行
+        # 运行编号相当于密码：知道编号的人都能继续这次运行并看到其中的文档和结果，不要分享给别人
+        run_id_input = st.text_input("输入运行编号继续", type="password",
+                                     help="运行编号相当于密码，知道编号的人都能看到这次运行的文档和结果")
+        if run_id_input and st.button("继续", key="resume_by_id"):
+            run_id_input = run_id_input.strip()
+            try:
+                claimed = get_checkpoint_store().claim_run(run_id_input, st.session_state.checkpoint_owner)
+            except Exception as e:
+                claimed = False
+                st.caption(f"读取检查点出错: {e}")
+            if claimed:
+                reset_runner()
+                resume_run(run_id_input)
+                st.rerun()
+            else:
+                st.warning("没有找到这个运行编号")
+
     if selected_model != st.session_state.selected_model:
         st.session_state.selected_model = selected_model
-        if not st.session_state.processing_complete:
-            st.session_state.current_step = 0
-            st.session_state.prompts = []
-            st.session_state.results = []
-            st.session_state.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-            st.session_state.processing_complete = False
-            st.session_state.chain_input = ""
-            st.session_state.docx_text = ""
-            st.session_state.pdf_text = ""
+        if not runner.is_complete:
+            clear_document()
+            reset_runner()
             st.rerun()
 
+# 每次运行都使用侧边栏当前的设置
+runner.config = build_chain_config()
+
+# 显示Token使用统计信息和各步骤的响应延迟
+# section区分页面上显示统计的位置，同一页面显示两次时导出按钮需要不同的key
+def show_token_usage(section):
+    stats = runner.stats
+    st.subheader("💰 Token使用情况")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("输入Token", stats.token_usage["prompt_tokens"])
+    with col2:
+        st.metric("输出Token", stats.token_usage["completion_tokens"])
+    with col3:
+        st.metric("总Token", stats.token_usage["total_tokens"])
+
+    # 服务端前缀缓存命中的输入Token，只有接口在usage中返回时才有
+    if stats.prompt_cache_tokens:
+        prompt_tokens = stats.token_usage["prompt_tokens"]
+        ratio = f"{stats.prompt_cache_tokens / prompt_tokens:.0%}" if prompt_tokens else "-"
+        st.metric("前缀缓存命中Token（占输入）", f"{stats.prompt_cache_tokens}（{ratio}）")
+
+    # 上下文压缩节省的令牌数是按文本长度估算的，仅供参考
+    if stats.saved_tokens:
+        st.metric("上下文压缩节省Token（估算）", stats.saved_tokens)
+
+    # 去掉推理过程节省的输入Token：每一步的推理过程长度 × 被后续步骤使用的次数，同样是估算值
+    if stats.reasoning_stats:
+        st.metric("去掉推理过程节省Token（估算）", stats.reasoning_saved_tokens)
+        with st.expander("查看每一步去掉的推理过程"):
+            for index, item in sorted(stats.reasoning_stats.items()):
+                st.caption(f"步骤 {index + 1}：推理过程约 {item['tokens']} Token，被后续步骤使用 {item['forwarded']} 次，"
+                           f"节省约 {item['tokens'] * item['forwarded']} Token")
+
+    if stats.setup:
+        show_setup(stats.setup)
+    if stats.early_stop:
+        st.caption(f"⏭️ 步骤 {stats.early_stop['after'] + 1} 之后提前总结，跳过了 {stats.early_stop['skipped']} 个中间步骤")
+
+    # 对冲请求：被取消的那个请求的输入Token同样会计费，按胜出请求的输入Token估算
+    hedge_stats = stats.hedge_stats
+    if hedge_stats["hedged"]:
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("对冲请求（对冲胜出）", f"{hedge_stats['hedged']}（{hedge_stats['won']}）")
+        with col2:
+            st.metric("对冲额外输入Token（估算）", hedge_stats["extra_prompt_tokens"])
+
+    # 命中响应缓存的调用没有实际消耗，单独统计
+    if stats.cache_stats["hits"]:
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("缓存命中次数", stats.cache_stats["hits"])
+        with col2:
+            st.metric("缓存节省Token", stats.cache_stats["tokens"])
+
+    # 首字延迟(TTFT)：从发出请求到看到第一个字的时间，流式模式下远小于总耗时
+    # 平均值只统计成功且真正调用了API的请求，失败和命中缓存的调用只出现在时间线和导出的记录中
+    records = list(stats.call_metrics)
+    metrics = [m for m in records if m["status"] == "ok"]
+    if metrics:
+        ttfts = [m["ttft"] for m in metrics if m["ttft"] is not None]
+        speeds = [m["tokens_per_sec"] for m in metrics if m["tokens_per_sec"]]
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("平均首字延迟", f"{sum(ttfts) / len(ttfts):.1f}s" if ttfts else "-")
+        with col2:
+            st.metric("平均总耗时", f"{sum(m['latency'] for m in metrics) / len(metrics):.1f}s")
+        with col3:
+            st.metric("平均生成速度", f"{sum(speeds) / len(speeds):.1f} token/s" if speeds else "-")
+        retries = sum(m["retries"] for m in records)
+        if retries:
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("重试次数", retries)
+            with col2:
+                st.metric("退避等待", f"{sum(m['backoff'] for m in records):.1f}s")
+            with col3:
+                st.metric("排队等待", f"{sum(m['queue_wait'] for m in records):.1f}s")
+    if records:
+        show_call_details(section, records)
+
+# 调用时间线、逐条记录和导出文件：内容随调用次数增长，只在打开开关时生成
+# 放在fragment中，切换开关只重新运行这一部分，不会重跑整个页面
+@st.fragment
+def show_call_details(section, records):
+    if not st.toggle("查看调用时间线", key=f"{section}_timeline"):
+        return
+    with st.container(border=True):
+        # 瀑布图：每个调用一行，分为排队/重试、等待首字、生成三段
+        st.vega_lite_chart({
+            "data": {"values": timeline_rows(records)},
+            "mark": "bar",
+            "encoding": {
+                "y": {"field": "call", "type": "nominal", "sort": None, "title": None},
+                "x": {"field": "start", "type": "quantitative", "title": "秒"},
+                "x2": {"field": "end"},
+                "color": {"field": "phase", "type": "nominal", "title": "阶段"},
+                "tooltip": [{"field": "call"}, {"field": "phase"}, {"field": "start"}, {"field": "end"}]
+            }
+        }, use_container_width=True)
+        for m in records:
+            ttft_text = f"{m['ttft']:.1f}s" if m["ttft"] is not None else "-"
+            mode_text = "流式" if m["stream"] else "非流式"
+            key_text = f"API {m['key_index'] + 1}" if m["key_index"] is not None else "-"
+            speed_text = f"{m['tokens_per_sec']:.1f} token/s" if m["tokens_per_sec"] else "-"
+            st.text(f"{m['step'] or '未命名'} | {m['model']} | {key_text} | {mode_text} | {m['status']} | "
+                    f"排队 {m['queue_wait']:.1f}s | 首字延迟 {ttft_text} | 总耗时 {m['latency']:.1f}s | "
+                    f"重试 {m['retries']} 次 | {speed_text} | {m['finish_reason'] or '-'}")
+        # 导出调用记录和Prometheus格式的指标，供离线分析和监控面板使用
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("导出调用记录(JSONL)", to_jsonl(records), file_name="aigent_calls.jsonl",
+                               mime="application/jsonl", key=f"{section}_export_jsonl")
+        with col2:
+            st.download_button("导出Prometheus指标", to_prometheus(records), file_name="aigent_metrics.prom",
+                               mime="text/plain", key=f"{section}_export_prom")
+
+# 显示一个步骤的结果，推理过程单独放在另一个标签页
+def show_step_result(index):
+    with st.expander(f"步骤 {index + 1} : {runner.prompts[index][:50]}..."):
+        result = runner.results[index]
+        reasoning = runner.reasoning.get(index)
+        if reasoning:
+            # 推理过程单独显示，后续步骤只收到正式回答
+            answer_tab, reasoning_tab = st.tabs(["回答", "推理过程"])
+            with answer_tab:
+                st.write(result)
+            with reasoning_tab:
+                st.text(reasoning)
+        else:
+            st.write(result)
+
+# 原始API响应：完整的响应数据不再随每次调用写进页面，选择某次调用后才加载
+# 放在fragment中，切换选择只重新运行这一部分
+@st.fragment
+def show_raw_responses():
+    responses = st.session_state.raw_responses
+    if not responses:
+        return
+    call_id = st.selectbox("查看原始API响应", list(responses), index=None, placeholder="选择一次调用后加载",
+                           format_func=lambda c: f"#{c} {responses[c][0] or '未命名'}")
+    if call_id is not None:
+        st.json(st.session_state.session_store.get(responses[call_id][1]))
+
 # 主界面标题
 st.title("🤖 怀远の超级AGENT")
 
-# 固定的初始prompt
-FIXED_INITIAL_PROMPT = "接下来，我会给你非常复杂的prompt，你需要经过深度思考，拆分成你所认为需要的步骤，每一行必须代表一个步骤，不可以在一个步骤中间换行，如果需要详细说明请在该行内完成，接下来，你需要返还你所认为的步骤的量个循序渐进的prompt，作为回答的第一行，你的回答第一行必须是总步骤的数字，不可以有任何额外文字，这些prompt必须是普通的大语言模型可以实现的，简单易懂的prompt，我会给按照顺序吧每个prompt给下一个AI，最后，经过你所认为的数量个prompt，我希望得到一个我刚开始发你的prompt所需要达到的要求和效果。你不可以使用markdown，每一个prompt需要时一段话，可以比较长，中间使用一个空行隔开。拆分的每个prompt必须超过100字。每次换行出现必须代表下一个prompt，不能随便换行。你的回答第一行是一个数字，第二行开始开始就必须是第一个prompt，不可以有额外内容。收到这些prompt的全部是AI，所以很多电脑的工具无法使用，请你确保你给出的方案都是AI可以用的。确保你最后的结果是用户想要的，比如代码，网站，结论等。不要使用：或者类似符号，直接输出1. 2. 3.作为prompt。返还的第一行必须是一个数字不能包含其他内容，这个数字必须是你给出的需要的次数。每一行必须代表一个步骤，不可以在一个步骤中间换行，如果需要详细说明请在该行内完成，如果你换行了系统会认为是下一步，而不是这一步的解释说明。请确保换行是下一步，而不是解释说明，同一步在一行内"
-
 # 显示最终处理结果（移到顶部）
-if st.session_state.processing_complete and st.session_state.results:
+if runner.is_complete:
     st.subheader("✨ 最终结果")
     # 显示最后一个结果（总结结果）
-    if len(st.session_state.results) > 0:
-        with st.container():
-            st.markdown("### 最终输出")
-            st.write(st.session_state.results[-1])
-    
+    with st.container():
+        st.markdown("### 最终输出")
+        st.write(runner.ordered_results[-1])
+        final_reasoning = runner.reasoning.get(len(runner.prompts) - 1)
+        if final_reasoning:
+            with st.expander("查看推理过程"):
+                st.text(final_reasoning)
+
     # 显示Token使用统计信息
-    st.subheader("💰 Token使用情况")
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.metric("输入Token", st.session_state.token_usage["prompt_tokens"])
-    with col2:
-        st.metric("输出Token", st.session_state.token_usage["completion_tokens"])
-    with col3:
-        st.metric("总Token", st.session_state.token_usage["total_tokens"])
+    show_token_usage("final")
 
 # 输入区域 - 使用表单收集用户输入
 with st.form("input_form"):
     # 主要prompt输入框
     user_prompt = st.text_area("输入你的Prompt", height=100)
-    
-    # 添加文件上传组件
-    col1, col2 = st.columns(2)
-    with col1:
-        uploaded_pdf = st.file_uploader("上传PDF文件", type=["pdf"])
-    with col2:
-        uploaded_docx = st.file_uploader("上传Word文件", type=["docx"])
-    
+
+    # 文件上传组件：可以同时上传多个PDF、Word和纯文本文件，合并成一份文档使用
+    uploaded_files = st.file_uploader("上传文档（PDF、Word、纯文本，可多选）",
+                                      type=[extension[1:] for extension in FILE_KINDS], accept_multiple_files=True)
+
+    # 开启响应缓存时，可以选择本次运行不读取缓存，重新采样得到新的回答
+    bypass_cache = st.checkbox("本次重新采样（不使用缓存的回答）")
+
     # 提交按钮
     submitted = st.form_submit_button("开始处理")
 
+# 停止按钮：处理过程中点击时，当前脚本在下一次刷新页面（最迟一秒）时被中断，正在进行的调用随即取消；
+# 回调中再直接取消一次runner，之后不再自动继续剩余的步骤
+def stop_runner():
+    st.session_state.stopped = True
+    st.session_state.runner.cancel()
+
+if submitted or (runner.prompts and not runner.is_complete and not st.session_state.stopped):
+    st.button("⏹ 停止处理", key="stop_run", on_click=stop_runner)
+
 # 处理用户提交的表单
 if submitted:
     # 检查是否已设置API密钥
-    if not hasattr(st.session_state, 'api_key'):
+    if not runner.config.api_keys:
         st.error("请先输入API Key")
     else:
-        # 处理上传的PDF文件
-        if uploaded_pdf is not None:
-            with st.spinner("正在处理PDF文件..."):
-                pdf_text = extract_text_from_pdf(uploaded_pdf)
-                if pdf_text:
-                    st.session_state.pdf_text = pdf_text
-                    st.success("PDF文件处理成功！")
-                else:
-                    st.error("PDF文件处理失败")
-        
-        # 处理上传的Word文件
-        if uploaded_docx is not None:
-            with st.spinner("正在处理Word文件..."):
-                docx_text = extract_text_from_docx(uploaded_docx)
-                if docx_text:
-                    st.session_state.docx_text = docx_text
-                    st.success("Word文件处理成功！")
-                else:
-                    st.error("Word文件处理失败")
-        
-        # 处理用户输入的prompt
+        # 记录本次运行是否跳过响应缓存，后续每一步都按这个设置执行
+        st.session_state.cache_bypass = bypass_cache
+        runner.config.cache_bypass = bypass_cache
+        runner.on_event = make_event_handler()
+        # 新的运行：清除之前的停止状态，时间上限从现在开始计算
+        st.session_state.stopped = False
+        runner.begin()
+
+        # 上传的文件在工作线程中提取并建立检索索引，与指令优化和步骤规划同时进行，后续每一步直接检索
+        # 工作线程需要绑定当前脚本的运行上下文才能在页面上显示提取进度
+        corpora = []
+        script_ctx = get_script_run_ctx()
+
+        def load_document():
+            add_script_run_ctx(threading.current_thread(), script_ctx)
+            if uploaded_files:
+                corpus = ingest_files(uploaded_files)
+                corpora.append(corpus)
+                if corpus.text:
+                    st.session_state.document_text = store_text(corpus.text)
+                    st.session_state.document_label = corpus.label
+            # 没有上传新文件或没有提取到文本时，继续使用之前的文档
+            return st.session_state.session_store.get(st.session_state.document_text), st.session_state.document_label
+
         if user_prompt:
-            # 首先使用DeepSeek-R1-Distill-Qwen-32B优化用户输入的指令
-            with st.spinner("正在优化用户指令..."):
-                from ai_utils import optimize_user_input
-                optimized_prompt = optimize_user_input(user_prompt)
-                
-                # 显示优化后的提示信息
-                st.success("指令优化完成！")
-                
-            # 使用优化后的指令调用主AI处理流程
-            with st.spinner(f"正在获取{st.session_state.selected_model}的响应..."):
-                response = call_qwq_api(optimized_prompt, FIXED_INITIAL_PROMPT)
-                if response:
-                    # 获取处理步骤
-                    prompts = process_qwq_response(response)
-                    # 添加一个额外的总结步骤
-                    prompts.append("请根据之前所有AI的输出，总结并给出最终的完整答复。你的回答应该是对整个任务的最终解决方案。如果用户叫你写小说，就不要返还框架，返还你写的小说，同理，如果用户的prompt是别的，也请回答用户想要的而非框架")
-                    st.session_state.prompts = prompts
-                    st.session_state.current_step = 1
-                    st.session_state.results = []
-                    # 将PDF或Word文本添加到用户的prompt中，确保每个AI都能获取到完整内容
-                    if st.session_state.pdf_text:
-                        # 将PDF文本添加到优化后的prompt中，而不是作为chain_input
-                        optimized_prompt = f"以下是上传的PDF文档内容：\n\n{st.session_state.pdf_text}\n\n基于以上内容，请回答：\n{optimized_prompt}"
-                        # 同时保留在chain_input中，以便向后兼容
-                        st.session_state.chain_input = st.session_state.pdf_text
-                    elif st.session_state.docx_text:
-                        # 将Word文本添加到优化后的prompt中
-                        optimized_prompt = f"以下是上传的Word文档内容：\n\n{st.session_state.docx_text}\n\n基于以上内容，请回答：\n{optimized_prompt}"
-                        # 同时保留在chain_input中
-                        st.session_state.chain_input = st.session_state.docx_text
-                else:
-                    st.error("无法获取有效的API响应，请检查API密钥和网络连接后重试")
+            spinner_text = ("正在优化指令并规划步骤（一次调用）..." if runner.config.fused_planning
+                            else f"正在优化指令并获取{st.session_state.selected_model}的规划...")
+            if uploaded_files:
+                spinner_text += "同时处理上传的文件"
+            # 并行模式下规划AI同时给出每个步骤的依赖
+            with st.spinner(spinner_text):
+                prompts = runner.prepare(user_prompt, load_document)
+        else:
+            with st.spinner("正在处理上传的文件..."):
+                runner.set_document(*load_document())
+            prompts = None
+
+        for corpus in corpora:
+            if corpus.text:
+                st.success("文件处理成功！")
+                show_corpus_summary(corpus.summary(), corpus.sources)
+                doc_index = runner.doc_index
+                if doc_index is not None:
+                    st.info(f"文档共约 {doc_index.total_tokens} 个Token，已切分为 {len(doc_index.chunks)} 个片段")
+            else:
+                st.error("文件处理失败，没有提取到任何文本")
+
+        if user_prompt:
+            if prompts is None:
+                st.error("无法获取有效的API响应，请检查API密钥和网络连接后重试")
+            else:
+                show_setup(runner.stats.setup)
 
 # 显示处理进度和结果
-if st.session_state.prompts:
+if runner.prompts:
     # 显示已生成的所有prompts列表
     st.subheader("📝 步骤")
-    for i, prompt in enumerate(st.session_state.prompts, 1):
-        st.text(f"{i}. {prompt}")
-    
+    for i, prompt in enumerate(runner.prompts, 1):
+        if runner.dependencies:
+            deps = runner.dependencies[i - 1]
+            deps_text = "、".join(str(d + 1) for d in deps) if deps else "无"
+            st.text(f"{i}. {prompt}  [依赖: {deps_text}]")
+        else:
+            st.text(f"{i}. {prompt}")
+    if runner.skipped_steps:
+        with st.expander(f"提前总结时跳过的 {len(runner.skipped_steps)} 个中间步骤"):
+            for prompt in runner.skipped_steps:
+                st.text(prompt)
+    if runner.dependencies:
+        st.caption(f"并行模式：依赖图宽度为 {graph_width(runner.dependencies)}，最多同时执行 {runner.config.max_workers} 个步骤")
+
+    if runner.run_id:
+        st.caption(f"运行编号 {runner.run_id}：每完成一步都会保存，页面刷新或中断后可以在侧边栏输入这个编号，"
+                   "从最后完成的步骤继续。编号相当于密码，请不要分享给别人")
+
     # 创建可爱的进度条
     progress_placeholder = st.empty()
     progress_text = "🌟 处理进度"
-    current_progress = st.session_state.current_step / len(st.session_state.prompts) if not st.session_state.processing_complete else 1.0
+    total_steps = len(runner.prompts)
     progress_bar = progress_placeholder.progress(0)
-    progress_bar.progress(current_progress, text=progress_text)
-    
-    # 处理所有prompt，直到完成
-    if not st.session_state.processing_complete and st.session_state.current_step <= len(st.session_state.prompts):
-        # 显示当前处理进度
-        with st.spinner(f"✨ 正在处理第 {st.session_state.current_step} 个步骤 (共{len(st.session_state.prompts)}个)..."):
-            # 获取当前需要处理的prompt
-            current_prompt = st.session_state.prompts[st.session_state.current_step - 1]
-            
-            # 准备链式输入：使用所有之前AI的输出或初始输入
-            chain_input = ""
-            all_previous_outputs = []
-            
-            if st.session_state.current_step > 1 and len(st.session_state.results) > 0:
-                # 收集所有之前的AI输出
-                all_previous_outputs = st.session_state.results.copy()
-                # 确保每个步骤都能获取到PDF或Word文档内容
-                if st.session_state.pdf_text:
-                    current_prompt = f"以下是上传的PDF文档内容：\n\n{st.session_state.pdf_text}\n\n基于以上内容和之前AI的输出，请继续：\n{current_prompt}"
-                elif st.session_state.docx_text:
-                    current_prompt = f"以下是上传的Word文档内容：\n\n{st.session_state.docx_text}\n\n基于以上内容和之前AI的输出，请继续：\n{current_prompt}"
-            elif st.session_state.current_step == 1 and st.session_state.chain_input:
-                # 如果是第一个prompt且有初始输入，使用初始输入
-                chain_input = st.session_state.chain_input
-            
-            # 调用API处理当前prompt，传递所有之前的输出
-            result = call_qwq_api(current_prompt, chain_input=chain_input, all_previous_outputs=all_previous_outputs)
-            if result:
-                # 保存处理结果
-                st.session_state.results.append(result)
-                # 更新进度条
-                progress_bar.progress(st.session_state.current_step / len(st.session_state.prompts))
-                st.session_state.current_step += 1
-                
-                # 检查是否处理完所有prompt
-                if st.session_state.current_step > len(st.session_state.prompts):
-                    st.session_state.processing_complete = True
-                    progress_bar.progress(1.0)
-                    st.success("所有步骤处理完成！")
-                
-                # 如果还有prompt需要处理，重新运行应用继续处理
-                if not st.session_state.processing_complete:
-                    st.rerun()
-            else:
-                # API调用失败时的处理
-                st.error("处理当前步骤t时出错，请检查API连接和密钥是否正确")
-                # 不增加步骤，允许用户重试或重置
-    
+    progress_bar.progress(len(runner.results) / total_steps, text=progress_text)
+
+    # 中间处理结果：先显示之前已经完成的步骤，本次运行中每完成一步只追加这一步，不会重新渲染整个结果区
+    # 总结步骤的结果作为最终输出单独显示
+    results_area = st.container()
+    shown_steps = set()
+
+    # 提前结束时步骤列表会在运行中缩短，总结步骤的下标按当前的步骤列表计算
+    def add_step_result(index):
+        if index in shown_steps or index == len(runner.prompts) - 1:
+            return
+        with results_area:
+            if not shown_steps:
+                st.subheader("🎯 中间处理结果")
+            shown_steps.add(index)
+            show_step_result(index)
+
+    for index in sorted(runner.results):
+        add_step_result(index)
+
+    def on_step_done(index, done, total):
+        progress_bar.progress(done / total, text=progress_text)
+        add_step_result(index)
+
+    # 在一次运行中执行所有剩余的步骤，并行模式下互不依赖的步骤同时调用AI
+    # 失败时已完成的步骤保留在runner中，下次运行时从失败的步骤继续
+    if not runner.is_complete and not runner.config.api_keys:
+        # 从检查点恢复后还没有输入密钥
+        st.warning("请先输入API Key，然后继续处理剩余的步骤")
+    elif not runner.is_complete and st.session_state.stopped:
+        st.info(f"已停止处理，已完成 {len(runner.results)}/{total_steps} 个步骤")
+        if st.button("继续处理"):
+            st.session_state.stopped = False
+            st.rerun()
+    elif not runner.is_complete:
+        sync_document()
+        started_at = time.time()
+
+        def on_waiting(done, total):
+            progress_bar.progress(done / total, text=f"{progress_text}（已用时 {time.time() - started_at:.0f} 秒）")
+
+        runner.on_event = make_event_handler(on_step_done, on_waiting)
+        # 提交后紧接着执行时沿用提交时开始计算的时间上限，继续之前的运行时重新计算
+        if not submitted:
+            runner.begin()
+        remaining = total_steps - len(runner.results)
+        if runner.dependencies:
+            spinner_text = f"✨ 正在并行处理剩余的 {remaining} 个步骤 (最多同时{runner.config.max_workers}个)..."
+        else:
+            spinner_text = f"✨ 正在处理剩余的 {remaining} 个步骤 (共{total_steps}个)..."
+        with st.spinner(spinner_text):
+            failed_steps = runner.run_steps()
+
+        if failed_steps and runner.aborted:
+            st.warning("已超过处理时间上限，剩余的步骤已放弃，已完成的步骤会在重试时保留")
+        elif failed_steps:
+            failed_text = "、".join(str(i + 1) for i in sorted(failed_steps))
+            st.error(f"步骤 {failed_text} 处理失败，请检查API连接和密钥是否正确，已完成的步骤会在重试时保留")
+        else:
+            progress_bar.progress(1.0)
+            st.success("所有步骤处理完成！")
+
     # 显示处理结果
-    if st.session_state.results:
-        # 展示每个prompt的处理结果（除了最后一个）
-        st.subheader("🎯 中间处理结果")
-        for i, result in enumerate(st.session_state.results[:-1], 1):
-            with st.expander(f"步骤 {i} : {st.session_state.prompts[i-1][:50]}..."):
-                st.write(result)
-        
+    results = runner.ordered_results
+    if results:
         # 特别展示最终结果
-        if len(st.session_state.results) == len(st.session_state.prompts):
+        if len(results) == len(runner.prompts):
             st.markdown("---")
             with st.container():
                 st.markdown("### ✨ 最终输出")
                 st.markdown("<div style='padding: 20px; border-radius: 10px; border: 2px solid #ff69b4; background-color: #fff5f7;'>", unsafe_allow_html=True)
-                st.write(st.session_state.results[-1])
+                st.write(results[-1])
                 st.markdown("</div>", unsafe_allow_html=True)
-        
+
         # 显示Token使用统计信息
-        st.subheader("💰 Token使用情况")
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            st.metric("输入Token", st.session_state.token_usage["prompt_tokens"])
-        with col2:
-            st.metric("输出Token", st.session_state.token_usage["completion_tokens"])
-        with col3:
-            st.metric("总Token", st.session_state.token_usage["total_tokens"])
-        
+        show_token_usage("results")
+        show_raw_responses()
+
         # 重置按钮：清空所有状态并重新开始
         if st.button("重置处理"):
-            st.session_state.current_step = 0
-            st.session_state.prompts = []
-            st.session_state.results = []
-            st.session_state.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-            st.session_state.processing_complete = False
-            st.session_state.chain_input = ""
-            st.session_state.docx_text = ""
-            st.rerun()
\ No newline at end of file
+            clear_document()
+            reset_runner()
+            st.rerun()
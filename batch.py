@@ -0,0 +1,351 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ai_utils import MODEL_CONFIGS, PLAN_FORMATS
+from chain_runner import ChainRunner, ChainConfig
+from chain_dag import DEFAULT_MAX_WORKERS
+from corpus import build_corpus
+from http_client import RateLimiter
+from key_pool import KeyPool, DEFAULT_KEY_RPM, DEFAULT_KEY_TPM
+from model_router import ROLES
+from telemetry import to_jsonl, to_prometheus
+
+# 批量处理 - 从JSONL文件读取任务，同时运行多条完整的处理链（优化 -> 规划 -> 各步骤 -> 总结）
+#
+# 输入文件每行一个任务：
+#   {"id": "job-1", "prompt": "写一份报告", "document": "资料/报告.pdf", "model": "Qwen/QwQ-32B"}
+# id可省略（默认使用行号），document和model可选，document支持pdf、docx和纯文本文件，相对路径以输入文件所在目录为准。
+# document也可以是多个文件路径组成的列表，这些文件会合并成一份文档（去掉重复的文件和重复的页面/段落）。
+#
+# 输出文件每完成一个任务追加一行，包含结果和该任务的令牌用量。
+# 再次使用同一个输出文件运行时，已经成功的任务会被跳过，只运行未完成和失败的任务；
+# 失败的任务会从检查点中最后完成的步骤继续，不会重新调用优化、规划和已完成的步骤。
+#
+# 用法：python batch.py jobs.jsonl results.jsonl --concurrency 8 --rpm 120
+
+# 默认同时运行的处理链条数
+DEFAULT_CONCURRENCY = 4
+
+# 从环境变量读取API密钥时使用的变量名，多个密钥用英文逗号分隔
+API_KEYS_ENV = "AIGENT_API_KEYS"
+
+# 输出到终端的锁，避免多个线程的提示信息混在同一行
+_print_lock = threading.Lock()
+
+def log(message):
+    with _print_lock:
+        print(message, file=sys.stderr, flush=True)
+
+def load_jobs(path):
+    """
+    读取任务文件
+
+    Args:
+        path (str): JSONL任务文件路径
+
+    Returns:
+        list: 任务字典列表，每个任务都带有字符串形式的id
+
+    Raises:
+        ValueError: 某一行不是合法的JSON、缺少prompt或id重复时抛出
+    """
+    jobs = []
+    seen = set()
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"任务文件第{line_number}行不是合法的JSON: {e}")
+            if not isinstance(job, dict) or not job.get("prompt"):
+                raise ValueError(f"任务文件第{line_number}行缺少prompt")
+            job["id"] = str(job.get("id", line_number))
+            if job["id"] in seen:
+                raise ValueError(f"任务文件第{line_number}行的id重复: {job['id']}")
+            seen.add(job["id"])
+            jobs.append(job)
+    return jobs
+
+def load_finished_ids(path):
+    """
+    读取已有的输出文件，找出已经成功完成的任务
+
+    Args:
+        path (str): JSONL输出文件路径，不存在时视为没有完成的任务
+
+    Returns:
+        set: 成功完成的任务id
+    """
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 上次运行被中断时最后一行可能不完整，忽略即可
+                continue
+            # 同一个任务可能有多条记录（失败后重试），以最后一条为准
+            if record.get("status") == "ok":
+                finished.add(record["id"])
+            else:
+                finished.discard(record.get("id"))
+    return finished
+
+def read_document(paths):
+    """
+    读取任务附带的文档
+
+    Args:
+        paths (str或list): 文档路径或路径列表，pdf和docx会提取文本，其他文件按纯文本读取；多个文件合并成一份文档
+
+    Returns:
+        tuple: (文档文本, 文档类型名称)
+
+    Raises:
+        ValueError: 所有文件都无法读取时抛出
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        with open(path, "rb") as f:
+            files.append((path, f.read()))
+    corpus = build_corpus(files, default_kind="txt")
+    for source in corpus.sources:
+        for level, message in source["notes"]:
+            if level == "warning":
+                log(f"{source['name']}: {message}")
+        if source["error"]:
+            log(f"{source['name']}: {source['error']}")
+    if not corpus.text and any(source["error"] for source in corpus.sources):
+        raise ValueError("文档无法读取: " + "; ".join(s["error"] for s in corpus.sources if s["error"]))
+    return corpus.text, corpus.label
+
+def job_run_id(job, output_path):
+    """
+    任务对应的检查点运行编号：同一个输出文件中内容相同的任务总是得到相同的编号，修改了任务内容则重新开始
+
+    Args:
+        job (dict): 任务
+        output_path (str): 输出文件路径
+
+    Returns:
+        str: 运行编号
+    """
+    identity = json.dumps([os.path.abspath(output_path), job["id"], job["prompt"], job.get("document"), job.get("model")],
+                          ensure_ascii=False)
+    return "batch-" + hashlib.sha256(identity.encode("utf-8")).hexdigest()[:16]
+
+def run_job(job, base_config, base_dir, run_id=None):
+    """
+    运行一个任务的完整处理链
+
+    Args:
+        job (dict): 任务
+        base_config (dict): ChainConfig的公共参数
+        base_dir (str): 解析文档相对路径时使用的目录
+        run_id (str): 检查点运行编号，检查点中已有这次运行时从最后完成的步骤继续
+
+    Returns:
+        dict: 写入输出文件的记录
+    """
+    started_at = time.time()
+    record = {"id": job["id"], "prompt": job["prompt"]}
+    errors = []
+
+    def on_event(event, data):
+        # 批量模式下只记录失败和警告，不输出流式内容
+        if event in ("call_failed", "request_error", "warning", "step_error"):
+            message = f"{data.get('step') or ''} {data['message']}".strip()
+            errors.append(message)
+            log(f"[{job['id']}] {message}")
+            if event == "step_error":
+                log(data["traceback"])
+
+    try:
+        config = ChainConfig(**{**base_config, "model": job.get("model") or base_config["model"]})
+        # 文档在runner的工作线程中读取，与指令优化和步骤规划同时进行；从检查点继续时不再读取
+        load_document = None
+        if job.get("document"):
+            paths = job["document"] if isinstance(job["document"], list) else [job["document"]]
+            load_document = lambda: read_document([os.path.join(base_dir, path) for path in paths])
+        result = ChainRunner(config, on_event=on_event).run(job["prompt"], run_id=run_id, load_document=load_document)
+    except Exception as e:
+        record.update({"status": "error", "error": f"{type(e).__name__}: {e}", "elapsed": time.time() - started_at})
+        return record
+
+    record.update({
+        "status": "ok" if result.complete else "failed",
+        "run_id": result.run_id,
+        "optimized_prompt": result.optimized_prompt,
+        "prompts": result.prompts,
+        "results": result.results,
+        "final_output": result.final_output,
+        "failed_steps": [i + 1 for i in result.failed_steps],
+        "usage": {key: value for key, value in result.usage.items() if key != "call_metrics"},
+        "calls": len(result.usage["call_metrics"]),
+        "elapsed": time.time() - started_at
+    })
+    # 调用记录不写进结果文件，由run_batch按需写入单独的记录文件
+    record["_call_records"] = [{"job_id": job["id"], **call} for call in result.usage["call_metrics"]]
+    if not result.complete:
+        record["error"] = errors[-1] if errors else ("步骤规划失败" if not result.prompts else "步骤执行失败")
+    return record
+
+def run_batch(input_path, output_path, base_config, concurrency=DEFAULT_CONCURRENCY, trace_path=None, metrics_path=None):
+    """
+    运行任务文件中所有尚未成功完成的任务，每完成一个就追加写入输出文件
+
+    Args:
+        input_path (str): JSONL任务文件
+        output_path (str): JSONL输出文件，已存在时在末尾追加
+        base_config (dict): ChainConfig的公共参数
+        concurrency (int): 同时运行的处理链条数
+        trace_path (str): 每次API调用的记录（JSONL）追加写入的文件，为None时不写
+        metrics_path (str): 本次运行的Prometheus格式指标文件，每完成一个任务更新一次，为None时不写
+
+    Returns:
+        dict: 本次运行的统计（总数、跳过、成功、失败、令牌用量）
+    """
+    jobs = load_jobs(input_path)
+    finished = load_finished_ids(output_path)
+    pending = [job for job in jobs if job["id"] not in finished]
+    summary = {"total": len(jobs), "skipped": len(jobs) - len(pending), "ok": 0, "failed": 0, "total_tokens": 0}
+    log(f"共 {len(jobs)} 个任务，已完成 {summary['skipped']} 个，本次运行 {len(pending)} 个")
+    if not pending:
+        return summary
+
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    started_at = time.time()
+    call_records = []
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        futures = [executor.submit(run_job, job, base_config, base_dir, job_run_id(job, output_path)) for job in pending]
+        # 每完成一个任务立即写入并刷新到磁盘，中途中断后可以从输出文件继续
+        with open(output_path, "a", encoding="utf-8") as output:
+            for done, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                job_calls = record.pop("_call_records", [])
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                call_records.extend(job_calls)
+                if trace_path:
+                    with open(trace_path, "a", encoding="utf-8") as trace:
+                        trace.write(to_jsonl(job_calls))
+                if metrics_path:
+                    # 先写临时文件再替换，避免监控程序读到写了一半的文件
+                    with open(metrics_path + ".tmp", "w", encoding="utf-8") as metrics:
+                        metrics.write(to_prometheus(call_records))
+                    os.replace(metrics_path + ".tmp", metrics_path)
+                tokens = record.get("usage", {}).get("token_usage", {}).get("total_tokens", 0)
+                summary["total_tokens"] += tokens
+                if record["status"] == "ok":
+                    summary["ok"] += 1
+                else:
+                    summary["failed"] += 1
+                log(f"[{record['id']}] {record['status']} ({done}/{len(pending)}) {tokens} tokens, {record['elapsed']:.1f}s")
+    finally:
+        # 被中断时不再开始新的任务
+        executor.shutdown(wait=False, cancel_futures=True)
+    summary["elapsed"] = time.time() - started_at
+    return summary
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="从JSONL文件批量运行AI处理链")
+    parser.add_argument("input", help="任务文件（JSONL，每行包含prompt，可选id、document、model）")
+    parser.add_argument("output", help="结果文件（JSONL），已存在时跳过其中成功的任务并在末尾追加")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="同时运行的处理链条数")
+    parser.add_argument("--rpm", type=float, default=0, help="所有处理链合计每分钟最多发送的请求数，0表示不限制")
+    parser.add_argument("--api-key", action="append", dest="api_keys",
+                        help=f"API密钥，可以重复指定多个；不指定时从环境变量{API_KEYS_ENV}读取（逗号分隔）")
+    parser.add_argument("--key-rpm", type=int, default=DEFAULT_KEY_RPM, help="每个API密钥每分钟最多的请求数")
+    parser.add_argument("--key-tpm", type=int, default=DEFAULT_KEY_TPM, help="每个API密钥每分钟最多的令牌数")
+    parser.add_argument("--model", default="Qwen/QwQ-32B", choices=list(MODEL_CONFIGS), help="默认使用的模型")
+    parser.add_argument("--route", action="append", default=[], metavar="角色=模型",
+                        help=f"为某个角色指定模型，可以重复指定，角色为{'/'.join(ROLES)}，如 --route step=Pro/deepseek-ai/DeepSeek-V3")
+    parser.add_argument("--auto-route", action="store_true", help="根据观测到的速度和输入长度为中间步骤自动选择模型")
+    parser.add_argument("--hedge", action="store_true", help="请求明显比平时慢时用另一个密钥再发一次，采用先响应的一个")
+    parser.add_argument("--fixed-timeout", action="store_true", help="始终使用重试策略中的固定超时，不根据观测到的响应时间调整")
+    parser.add_argument("--early-stop", action="store_true", help="中间步骤认为任务已经完成时跳过剩下的中间步骤（顺序模式）")
+    parser.add_argument("--early-stop-check", action="store_true", help="提前结束之前再用小模型确认一次")
+    parser.add_argument("--token-budget", action="store_true", help="中间步骤的max_tokens按最近同类步骤的输出长度估算")
+    parser.add_argument("--plan-format", default="text", choices=list(PLAN_FORMATS),
+                        help="规划回答的格式，json格式的步骤可以跨行，不依赖第一行的步骤数")
+    parser.add_argument("--fused-plan", action="store_true", help="指令优化与步骤规划合并为一次模型调用")
+    parser.add_argument("--deadline", type=float, default=0, help="每条链最多运行的秒数，到时后放弃正在进行的调用，0表示不限制")
+    parser.add_argument("--dag", action="store_true", help="并行执行每条链中互不依赖的步骤")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_MAX_WORKERS, help="每条链最多同时执行的步骤数")
+    parser.add_argument("--compact-context", action="store_true", help="压缩历史输出（节省Token）")
+    parser.add_argument("--no-retrieval", action="store_true", help="每一步都发送整份文档，而不是只发送相关片段")
+    parser.add_argument("--cache", action="store_true", help="启用响应缓存")
+    parser.add_argument("--no-checkpoints", action="store_true", help="不保存检查点，失败的任务重新运行时从头开始")
+    parser.add_argument("--trace-file", help="把每次API调用的记录（排队、首字延迟、重试、令牌用量等）追加写入这个JSONL文件")
+    parser.add_argument("--metrics-file", help="把本次运行的Prometheus格式指标写入这个文件")
+    args = parser.parse_args(argv)
+    routes = {}
+    for item in args.route:
+        role, _, model = item.partition("=")
+        if role not in ROLES or not model:
+            parser.error(f"无效的--route参数: {item}")
+        routes[role] = model
+    args.route = routes
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    api_keys = args.api_keys or [key.strip() for key in os.environ.get(API_KEYS_ENV, "").split(",") if key.strip()]
+    if not api_keys:
+        log(f"请通过--api-key或环境变量{API_KEYS_ENV}提供API密钥")
+        return 2
+    base_config = {
+        "api_keys": api_keys,
+        "key_rpm": args.key_rpm,
+        "key_tpm": args.key_tpm,
+        "model": args.model,
+        "model_routes": args.route,
+        "auto_route": args.auto_route,
+        "chain_deadline": args.deadline or None,
+        "fused_planning": args.fused_plan,
+        "plan_format": args.plan_format,
+        "early_stop": args.early_stop,
+        "early_stop_check": args.early_stop_check,
+        "adaptive_max_tokens": args.token_budget,
+        "hedge": args.hedge,
+        "adaptive_timeout": not args.fixed_timeout,
+        "stream": False,
+        "dag_mode": args.dag,
+        "max_workers": args.max_workers,
+        "compact_context": args.compact_context,
+        "doc_retrieval": not args.no_retrieval,
+        "use_cache": args.cache,
+        "checkpoints": not args.no_checkpoints,
+        "rate_limiter": RateLimiter(args.rpm)
+    }
+    try:
+        summary = run_batch(args.input, args.output, base_config, args.concurrency, args.trace_file, args.metrics_file)
+    except (OSError, ValueError) as e:
+        log(str(e))
+        return 2
+    except KeyboardInterrupt:
+        log("已中断，再次运行相同的命令可以继续未完成的任务")
+        return 130
+    log(f"完成：成功 {summary['ok']} 个，失败 {summary['failed']} 个，跳过 {summary['skipped']} 个，"
+        f"共使用 {summary['total_tokens']} 个Token")
+    for key in KeyPool(api_keys, args.key_rpm, args.key_tpm).snapshot():
+        latency = f"{key['latency']:.1f}s" if key["latency"] is not None else "-"
+        log(f"{key['label']}: 请求 {key['requests']} 次，Token {key['tokens']}，失败 {key['failures']} 次"
+            f"（限流 {key['rate_limited']} 次），平均延迟 {latency}")
+    return 1 if summary["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
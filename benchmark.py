@@ -0,0 +1,275 @@
+import argparse
+import itertools
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import ai_utils
+from chain_runner import ChainRunner, ChainConfig
+from mock_server import MockServer, MockConfig, parse_distribution
+
+# 基准测试 - 用本地模拟服务器（mock_server）代替真实接口，完整运行"优化 -> 规划 -> 各步骤 -> 总结"的处理链，
+# 在不同的步骤数、文档大小、并发链数和运行模式下测量编排本身的开销：
+# 总耗时、请求数、上下行字节数、每一步的提示令牌数随步骤增长的情况、模拟的服务端前缀缓存命中率，
+# 以及每次调用在服务器处理之外多花的时间。
+#
+# 用法：python benchmark.py --steps 3,6,10 --doc-sizes 0,20000 --concurrency 1,4 --modes seq,dag,seq+compact
+#       python benchmark.py --latency uniform:0.2,0.8 --error-429 0.05 --json bench.json
+#       python benchmark.py --stall 0.05 --stall-seconds 5 --modes seq,seq+hedge
+#       python benchmark.py --done-rate 0.5 --modes seq,seq+early,seq+early+check
+#       python benchmark.py --malformed-steps 2 --modes seq,seq+json,dag+json
+
+# 运行模式中可以组合的开关，用"+"连接，如"dag+compact"；"seq"表示全部关闭（顺序执行）
+MODE_FLAGS = {
+    "dag": "dag_mode",
+    "compact": "compact_context",
+    "stream": "stream",
+    "fulldoc": "doc_retrieval",
+    "keepthink": "strip_reasoning",
+    "prefix": "message_layout",
+    "checkpoint": "checkpoints",
+    "hedge": "hedge",
+    "fused": "fused_planning",
+    "early": "early_stop",
+    "check": "early_stop_check",
+    "budget": "adaptive_max_tokens",
+    "json": "plan_format"
+}
+
+# 测试用的指令
+BENCH_PROMPT = "请写一份关于城市公共交通发展的分析报告，包括现状、问题和改进建议"
+
+# 生成测试文档用的词汇，让BM25检索有可区分的段落
+_DOC_WORDS = ("公交", "地铁", "客流", "票价", "线路", "换乘", "站点", "通勤", "拥堵", "补贴", "能耗", "调度",
+              "准点率", "运力", "规划", "市民", "满意度", "数据", "高峰", "夜间")
+
+def make_document(chars, seed=0):
+    """
+    生成指定长度的测试文档，由随机词汇组成的段落构成
+
+    Args:
+        chars (int): 文档的大致字数，0表示不使用文档
+        seed (int): 随机种子，相同的参数总是生成相同的文档
+
+    Returns:
+        str: 文档文本
+    """
+    if chars <= 0:
+        return ""
+    rng = random.Random(seed)
+    paragraphs = []
+    total = 0
+    while total < chars:
+        paragraph = f"第{len(paragraphs) + 1}段：" + "，".join(rng.choice(_DOC_WORDS) for _ in range(60)) + "。"
+        paragraphs.append(paragraph)
+        total += len(paragraph) + 2
+    return "\n\n".join(paragraphs)[:chars]
+
+def parse_mode(mode):
+    """
+    Args:
+        mode (str): 运行模式，如"seq"、"dag"、"dag+compact+stream"
+
+    Returns:
+        dict: 对应的ChainConfig参数
+
+    Raises:
+        ValueError: 包含未知的开关时抛出
+    """
+    # 默认不保存检查点，避免测试运行写满检查点数据库；加上checkpoint开关可以测量保存检查点的开销
+    options = {"dag_mode": False, "compact_context": False, "stream": False, "doc_retrieval": True,
+               "strip_reasoning": True, "checkpoints": False}
+    for flag in mode.split("+"):
+        if flag == "seq":
+            continue
+        if flag not in MODE_FLAGS:
+            raise ValueError(f"未知的运行模式: {flag}，可用: seq、{'、'.join(MODE_FLAGS)}")
+        # fulldoc表示关闭检索、每一步发送整份文档，keepthink表示把推理过程也交给后续步骤
+        if flag == "prefix":
+            # prefix表示使用前缀稳定的消息布局
+            options["message_layout"] = "prefix"
+        elif flag == "json":
+            # json表示规划回答使用JSON格式
+            options["plan_format"] = "json"
+        else:
+            options[MODE_FLAGS[flag]] = flag not in ("fulldoc", "keepthink")
+    return options
+
+def _step_prompt_tokens(records):
+    # 每个执行步骤（不含优化、规划和摘要调用）成功调用的平均提示令牌数，按步骤顺序排列
+    by_step = {}
+    for record in records:
+        step = record.get("step") or ""
+        if record.get("status") == "ok" and step.startswith("步骤 ") and step[3:].isdigit():
+            by_step.setdefault(int(step[3:]), []).append(record["prompt_tokens"])
+    return [sum(values) / len(values) for _, values in sorted(by_step.items())]
+
+def _percentile(values, q):
+    # 最近秩法的分位数，没有数据时为None
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+
+def run_scenario(server, steps, doc_chars, concurrency, mode, model, max_workers):
+    """
+    运行一个场景：同时运行concurrency条完整的处理链，并汇总服务器和客户端两侧的统计
+
+    Returns:
+        dict: 场景的测量结果
+    """
+    server.config.plan_steps = steps
+    server.stats.reset()
+    server.prefix_cache.clear()
+    document = make_document(doc_chars)
+    # 每个场景使用新的密钥名，避免上一个场景的冷却和限额影响本场景
+    scenario_id = f"{steps}-{doc_chars}-{concurrency}-{mode}-{time.time_ns()}"
+    config = ChainConfig(api_keys=[f"bench-{scenario_id}-{i}" for i in range(2)], model=model, optimizer_model=model,
+                         max_workers=max_workers, **parse_mode(mode))
+    runners = [ChainRunner(config) for _ in range(concurrency)]
+
+    started_at = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda runner: runner.run(BENCH_PROMPT, document, "TXT"), runners))
+    wall_time = time.time() - started_at
+
+    server_stats = server.stats.snapshot()
+    records = [record for runner in runners for record in runner.stats.call_metrics]
+    step_tokens = _step_prompt_tokens(records)
+    client_time = sum(record["latency"] or 0.0 for record in records)
+    latencies = [record["latency"] for record in records if record.get("status") == "ok"]
+    setup_times = [runner.stats.setup["total"] for runner in runners if runner.stats.setup]
+    return {
+        "steps": steps,
+        "doc_chars": doc_chars,
+        "concurrency": concurrency,
+        "mode": mode,
+        "chains_ok": sum(1 for result in results if result.complete),
+        "wall_time": wall_time,
+        # 从开始到可以执行第一个步骤的平均准备时间（读取文档、优化指令和规划）
+        "setup_time": sum(setup_times) / len(setup_times) if setup_times else None,
+        "calls": len(records),
+        "requests": server_stats["requests"],
+        "rate_limited": server_stats["statuses"].get(429, 0),
+        "server_errors": sum(count for status, count in server_stats["statuses"].items() if status >= 500),
+        "bytes_sent": server_stats["bytes_received"],
+        "bytes_received": server_stats["bytes_sent"],
+        "prompt_tokens": sum(server_stats["prompt_tokens"]),
+        # 模拟的服务端前缀缓存命中的输入令牌数
+        "cached_tokens": sum(record.get("cached_tokens") or 0 for record in records if record.get("status") == "ok"),
+        "step_prompt_tokens": step_tokens,
+        # 最后一步与第一步的提示令牌之比，反映上下文随步骤的增长
+        "prompt_growth": step_tokens[-1] / step_tokens[0] if len(step_tokens) > 1 and step_tokens[0] else None,
+        # 客户端调用总耗时中超出服务器处理时间的部分（排队、退避、序列化、连接等），按调用平均
+        "overhead_per_call": (client_time - server_stats["service_time"]) / len(records) if records else None,
+        # 成功调用的耗时分位数，以及发出对冲请求的调用数和对冲请求胜出的次数
+        "p50_latency": _percentile(latencies, 0.5),
+        "p99_latency": _percentile(latencies, 0.99),
+        "hedged": sum(1 for record in records if record.get("hedged")),
+        "hedge_won": sum(1 for record in records if record.get("hedge_won")),
+        # 提前结束跳过的中间步骤数（所有链合计）
+        "skipped_steps": sum(len(runner.skipped_steps) for runner in runners),
+        # 每条链实际执行的步骤数（含总结步骤），规划有缺陷且没能补写时会少于规划的步骤数+1
+        "planned_steps": [len(runner.prompts) for runner in runners]
+    }
+
+def format_table(rows):
+    headers = ["步骤", "文档字数", "并发", "模式", "成功链", "耗时(s)", "准备(s)", "请求", "429/5xx",
+               "上行KB", "下行KB", "提示令牌", "缓存命中", "首步→末步令牌", "增长倍数", "每次额外(ms)",
+               "p50/p99(s)", "对冲/胜出", "跳过步骤", "实际步骤"]
+    lines = []
+    for row in rows:
+        step_tokens = row["step_prompt_tokens"]
+        lines.append([
+            str(row["steps"]), str(row["doc_chars"]), str(row["concurrency"]), row["mode"],
+            f"{row['chains_ok']}/{row['concurrency']}", f"{row['wall_time']:.2f}",
+            f"{row['setup_time']:.2f}" if row["setup_time"] is not None else "-", str(row["requests"]),
+            f"{row['rate_limited']}/{row['server_errors']}",
+            f"{row['bytes_sent'] / 1024:.1f}", f"{row['bytes_received'] / 1024:.1f}", str(row["prompt_tokens"]),
+            f"{row['cached_tokens'] / row['prompt_tokens']:.0%}" if row["prompt_tokens"] else "-",
+            f"{step_tokens[0]:.0f}→{step_tokens[-1]:.0f}" if step_tokens else "-",
+            f"{row['prompt_growth']:.1f}x" if row["prompt_growth"] else "-",
+            f"{row['overhead_per_call'] * 1000:.0f}" if row["overhead_per_call"] is not None else "-",
+            f"{row['p50_latency']:.2f}/{row['p99_latency']:.2f}" if row["p50_latency"] is not None else "-",
+            f"{row['hedged']}/{row['hedge_won']}", str(row["skipped_steps"]),
+            "/".join(str(n) for n in sorted(set(row["planned_steps"])))
+        ])
+    widths = [max(len(headers[i]), *(len(line[i]) for line in lines)) if lines else len(headers[i])
+              for i in range(len(headers))]
+    output = ["  ".join(header.ljust(width) for header, width in zip(headers, widths))]
+    output.extend("  ".join(cell.ljust(width) for cell, width in zip(line, widths)) for line in lines)
+    return "\n".join(output)
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="用本地模拟服务器测量处理链的编排开销")
+    parser.add_argument("--steps", type=_int_list, default=[3, 6], help="规划返回的步骤数，逗号分隔")
+    parser.add_argument("--doc-sizes", type=_int_list, default=[0, 20000], help="测试文档的字数，逗号分隔，0表示无文档")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 4], help="同时运行的处理链条数，逗号分隔")
+    parser.add_argument("--modes", default="seq,dag,seq+compact",
+                        help=f"运行模式，逗号分隔；每个模式是seq或用+连接的开关：{'、'.join(MODE_FLAGS)}")
+    parser.add_argument("--model", default="Qwen/QwQ-32B", choices=list(ai_utils.MODEL_CONFIGS), help="使用的模型配置")
+    parser.add_argument("--max-workers", type=int, default=4, help="并行模式下每条链最多同时执行的步骤数")
+    parser.add_argument("--latency", default="fixed:0.05", help="模拟服务器首字前的延迟分布，如uniform:0.1,0.5")
+    parser.add_argument("--stream-tps", type=float, default=2000, help="模拟服务器每秒生成的令牌数，0表示不限速")
+    parser.add_argument("--completion-chars", type=int, default=400, help="模拟服务器每个回答的字数")
+    parser.add_argument("--reasoning-chars", type=int, default=0, help="模拟推理模型：每个回答前附带的<think>推理过程字数")
+    parser.add_argument("--error-429", type=float, default=0.0, help="返回429的概率")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="返回503的概率")
+    parser.add_argument("--retry-after", type=int, default=1, help="429响应中的Retry-After秒数")
+    parser.add_argument("--stall", type=float, default=0.0, help="请求卡住（首字前额外等待）的概率，用于测试对冲请求")
+    parser.add_argument("--stall-seconds", type=float, default=5.0, help="卡住时额外等待的秒数")
+    parser.add_argument("--done-rate", type=float, default=0.0,
+                        help="开启提前结束（early）时，模拟的步骤回答声明任务已经完成的概率")
+    parser.add_argument("--malformed-steps", type=int, default=0,
+                        help="模拟有缺陷的规划：从第2步开始这么多个步骤缺失，用于测量只补写缺失步骤的开销")
+    parser.add_argument("--retry-delay", type=float, help="覆盖重试的基础退避时间（秒），注入错误时可以调小以缩短测试")
+    parser.add_argument("--seed", type=int, default=0, help="错误注入和延迟采样的随机种子")
+    parser.add_argument("--json", dest="json_file", help="把所有场景的结果写入这个JSON文件")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        parse_distribution(args.latency)
+        modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+        for mode in modes:
+            parse_mode(mode)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 2
+    random.seed(args.seed)
+    if args.retry_delay is not None:
+        # 只影响本进程：重试策略是模块级的字典，处理链在调用时读取
+        ai_utils.STEP_RETRY_POLICY["base_retry_delay"] = args.retry_delay
+        ai_utils.OPTIMIZER_RETRY_POLICY["base_retry_delay"] = args.retry_delay
+
+    mock_config = MockConfig(args.latency, args.stream_tps, args.error_429, args.error_5xx, args.retry_after,
+                             args.completion_chars, reasoning_chars=args.reasoning_chars, stall=args.stall,
+                             stall_seconds=args.stall_seconds, done_rate=args.done_rate,
+                             malformed_steps=args.malformed_steps)
+    rows = []
+    with MockServer(mock_config) as server:
+        original_url = ai_utils.API_URL
+        ai_utils.API_URL = server.url
+        try:
+            for steps, doc_chars, concurrency, mode in itertools.product(args.steps, args.doc_sizes,
+                                                                        args.concurrency, modes):
+                print(f"运行场景：{steps}步，文档{doc_chars}字，并发{concurrency}，模式{mode}", file=sys.stderr, flush=True)
+                rows.append(run_scenario(server, steps, doc_chars, concurrency, mode, args.model, args.max_workers))
+        except KeyboardInterrupt:
+            print("已中断，只输出已完成的场景", file=sys.stderr)
+        finally:
+            ai_utils.API_URL = original_url
+
+    print(format_table(rows))
+    if args.json_file:
+        with open(args.json_file, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+    return 0 if all(row["chains_ok"] == row["concurrency"] for row in rows) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
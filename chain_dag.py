@@ -0,0 +1,120 @@
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# 默认并行度 - 同一时间最多有几个步骤在调用AI
+# 数值太大容易触发API的限流，4个左右比较稳妥
+DEFAULT_MAX_WORKERS = 4
+
+def normalize_dependencies(num_steps, dependencies):
+    """
+    整理步骤之间的依赖关系，保证依赖图无环且每个步骤都有依赖列表
+
+    只允许依赖排在前面的步骤，指向自身或后面步骤的依赖会被丢弃，
+    这样依赖图天然无环。没有给出依赖信息的步骤视为依赖前面所有步骤（即按顺序执行）。
+
+    Args:
+        num_steps (int): 步骤总数
+        dependencies (list): 每个步骤依赖的步骤下标列表（从0开始），可以为None或长度不足
+
+    Returns:
+        list: 长度为num_steps的列表，每一项是排好序的前置步骤下标
+    """
+    dependencies = dependencies or []
+    normalized = []
+    for i in range(num_steps):
+        deps = dependencies[i] if i < len(dependencies) else None
+        if deps is None:
+            normalized.append(list(range(i)))
+        else:
+            normalized.append(sorted({d for d in deps if 0 <= d < i}))
+    return normalized
+
+def graph_width(dependencies):
+    """
+    计算依赖图的宽度（同一层中最多有几个步骤可以同时执行）
+
+    Args:
+        dependencies (list): normalize_dependencies返回的依赖列表
+
+    Returns:
+        int: 依赖图的最大层宽，用于预估并行带来的加速
+    """
+    levels = []
+    for deps in dependencies:
+        levels.append(max((levels[d] for d in deps), default=-1) + 1)
+    return max((levels.count(level) for level in set(levels)), default=0)
+
+def run_dag(num_steps, dependencies, run_step, max_workers=DEFAULT_MAX_WORKERS, completed=None, on_step_done=None,
+            on_wait=None, wait_interval=1.0, on_abort=None, on_error=None):
+    """
+    按依赖关系并行执行各个步骤
+
+    所有前置步骤都完成的步骤会被立即提交到线程池执行，互不依赖的步骤同时进行。
+    任何一个步骤失败后不再提交新步骤，等正在执行的步骤结束后返回，已完成的结果可用于下次继续执行。
+
+    Args:
+        num_steps (int): 步骤总数
+        dependencies (list): normalize_dependencies返回的依赖列表
+        run_step (callable): run_step(index, dep_outputs)执行单个步骤，
+                             dep_outputs是{前置步骤下标: 输出}，返回结果文本，失败时返回None
+        max_workers (int): 线程池大小，即最大并行步骤数
+        completed (dict): 之前已经完成的步骤结果{下标: 输出}，这些步骤不会重新执行
+        on_step_done (callable): on_step_done(index, result)在调用线程中于每个步骤完成后调用
+        on_wait (callable): on_wait()在调用线程中每等待wait_interval秒还没有步骤完成时调用，
+                            可以用来刷新界面或在调用线程中抛出异常中断执行
+        wait_interval (float): 调用on_wait的间隔（秒）
+        on_abort (callable): on_abort()在调用线程因异常中断时、等待正在执行的步骤结束之前调用，用来让它们尽快结束
+        on_error (callable): on_error(index, exception)在调用线程中于run_step抛出异常时调用，这个步骤按失败处理；
+                             为None时把异常和调用栈打印到标准错误，不会悄悄丢掉
+
+    Returns:
+        tuple: (results, failed)，results是{下标: 输出}，failed是失败步骤的下标列表
+    """
+    results = dict(completed or {})
+    failed = []
+    running = {}
+
+    def ready_steps():
+        # 找出尚未执行、且所有前置步骤都已完成的步骤
+        return [
+            i for i in range(num_steps)
+            if i not in results and i not in running.values() and i not in failed
+            and all(d in results for d in dependencies[i])
+        ]
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        try:
+            while True:
+                if not failed:
+                    for i in ready_steps():
+                        dep_outputs = {d: results[d] for d in dependencies[i]}
+                        running[executor.submit(run_step, i, dep_outputs)] = i
+                if not running:
+                    break
+
+                # 等待任意一个步骤完成，然后检查是否有新的步骤可以开始
+                done, _ = wait(list(running), timeout=wait_interval if on_wait else None, return_when=FIRST_COMPLETED)
+                if not done:
+                    on_wait()
+                for future in done:
+                    i = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = None
+                        if on_error:
+                            on_error(i, e)
+                        else:
+                            traceback.print_exception(type(e), e, e.__traceback__)
+                    if result:
+                        results[i] = result
+                        if on_step_done:
+                            on_step_done(i, result)
+                    else:
+                        failed.append(i)
+        except BaseException:
+            # 退出with时要等正在执行的步骤结束，先通知它们放弃
+            if on_abort:
+                on_abort()
+            raise
+    return results, failed
@@ -0,0 +1,1032 @@
+import asyncio
+import hashlib
+import itertools
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from ai_utils import (achat_completion, parse_plan, parse_plan_repair, split_reasoning, split_fused_plan, MODEL_CONFIGS,
+                      OPTIMIZER_SYSTEM_PROMPT, FUSED_PLAN_INSTRUCTION, INPUT_OPTIMIZER_MODEL, SUMMARY_MODEL, SUMMARY_PROMPT, STEP_RETRY_POLICY, OPTIMIZER_RETRY_POLICY,
+                      JSON_PLAN_INSTRUCTION, JSON_PLAN_DEPENDENCY_INSTRUCTION, PLAN_REPAIR_MODEL, PLAN_REPAIR_MAX_TOKENS,
+                      PLAN_REPAIR_PROMPT, PLAN_REPAIR_DEPENDENCY_PROMPT)
+from chain_dag import run_dag, normalize_dependencies, DEFAULT_MAX_WORKERS
+from context_builder import SummaryCache, build_context, estimate_tokens, SUMMARY_MAX_TOKENS
+from doc_index import get_document_index, tokenize, DEFAULT_CONTEXT_TOKENS, DEFAULT_TOP_K
+from response_cache import get_response_cache
+from checkpoint import get_checkpoint_store, new_run_id
+from key_pool import KeyPool, DEFAULT_KEY_RPM, DEFAULT_KEY_TPM
+from telemetry import cached_call_record, cached_prompt_tokens
+from session_store import SpilledDict
+import model_router
+
+# 固定的初始prompt
+FIXED_INITIAL_PROMPT = "接下来，我会给你非常复杂的prompt，你需要经过深度思考，拆分成你所认为需要的步骤，每一行必须代表一个步骤，不可以在一个步骤中间换行，如果需要详细说明请在该行内完成，接下来，你需要返还你所认为的步骤的量个循序渐进的prompt，作为回答的第一行，你的回答第一行必须是总步骤的数字，不可以有任何额外文字，这些prompt必须是普通的大语言模型可以实现的，简单易懂的prompt，我会给按照顺序吧每个prompt给下一个AI，最后，经过你所认为的数量个prompt，我希望得到一个我刚开始发你的prompt所需要达到的要求和效果。你不可以使用markdown，每一个prompt需要时一段话，可以比较长，中间使用一个空行隔开。拆分的每个prompt必须超过100字。每次换行出现必须代表下一个prompt，不能随便换行。你的回答第一行是一个数字，第二行开始开始就必须是第一个prompt，不可以有额外内容。收到这些prompt的全部是AI，所以很多电脑的工具无法使用，请你确保你给出的方案都是AI可以用的。确保你最后的结果是用户想要的，比如代码，网站，结论等。不要使用：或者类似符号，直接输出1. 2. 3.作为prompt。返还的第一行必须是一个数字不能包含其他内容，这个数字必须是你给出的需要的次数。每一行必须代表一个步骤，不可以在一个步骤中间换行，如果需要详细说明请在该行内完成，如果你换行了系统会认为是下一步，而不是这一步的解释说明。请确保换行是下一步，而不是解释说明，同一步在一行内"
+
+# 并行模式下追加到规划prompt后面的要求 - 让规划AI标出每个步骤依赖哪些前面的步骤
+DAG_PLAN_INSTRUCTION = "另外，请在每一个步骤的行末用方括号标出这个步骤需要用到哪些前面步骤的输出，格式为[依赖 1 3]，数字是前面步骤的序号，如果这个步骤不需要任何前面步骤的输出就写[依赖 无]。只依赖真正需要的步骤，互不依赖的步骤会被同时执行。依赖标记必须写在同一行的末尾，不要单独成行"
+
+# 前缀稳定布局下各步骤共用的系统提示，后面接整体任务和文档内容
+PREFIX_SYSTEM_PROMPT = "你是多步骤协作任务中的一个AI。下面先给出整体任务和参考文档，之后的对话会按顺序给出每一步的任务以及之前的AI对这些任务的输出。请基于这些内容，只完成最后给出的这一步任务。"
+
+# 消息布局：merged把之前步骤的输出和文档合并进一条用户消息（默认）；
+# prefix把文档和固定指令放在开头不变的系统消息中，之前步骤按多轮对话追加，便于服务端复用前缀缓存
+MESSAGE_LAYOUTS = ("merged", "prefix")
+
+# 规划结果之后额外追加的总结步骤
+FINAL_STEP_PROMPT = "请根据之前所有AI的输出，总结并给出最终的完整答复。你的回答应该是对整个任务的最终解决方案。如果用户叫你写小说，就不要返还框架，返还你写的小说，同理，如果用户的prompt是别的，也请回答用户想要的而非框架"
+
+# 提前结束 - 顺序模式下每一步完成后先在本地检查剩下的中间步骤的关键词是否已经被之前的输出覆盖，
+# 并让接近完成的中间步骤顺便判断整体任务是否已经可以直接总结，可以时在回答最后写上EARLY_STOP_MARK，
+# 之后跳过剩下的中间步骤直接执行总结步骤
+EARLY_STOP_MARK = "【可以总结】"
+EARLY_STOP_INSTRUCTION = "（补充要求：整体任务是：{task}\n之后还有这些步骤没有执行：\n{remaining}\n如果完成这一步之后，整体任务需要的内容已经齐备，剩下的步骤只会重复已有的内容或者已经不再需要，请在回答的最后单独一行写“" + EARLY_STOP_MARK + "”，否则不要写这个标记。）"
+# 前缀稳定布局下的同一要求，只在系统消息中写一次并列出完整的规划，每一步的请求仍是上一步请求的严格延伸
+EARLY_STOP_SYSTEM_INSTRUCTION = "整体规划的全部步骤如下：\n{plan}\n如果完成当前这一步之后，整体任务需要的内容已经齐备，后面还没有执行的中间步骤只会重复已有的内容或者已经不再需要，请在这一步回答的最后单独一行写“" + EARLY_STOP_MARK + "”，否则不要写这个标记。最后的总结步骤不需要写这个标记。"
+
+# 本地检查：剩下的中间步骤的词项（见doc_index.tokenize）有这么大比例出现在已完成的输出中时，不需要模型标记也可以提前结束；
+# 非前缀布局下，已完成的输出达到EARLY_STOP_HINT_COVERAGE之后才在步骤任务后面追加EARLY_STOP_INSTRUCTION，
+# 离完成还远的步骤不必为这段说明（包含整体任务和剩下的步骤）多付输入令牌
+EARLY_STOP_COVERAGE = 0.8
+EARLY_STOP_HINT_COVERAGE = 0.5
+
+# 去掉标记后的回答少于这么多个字符时不提前结束，太短的回答不可能已经完成整体任务
+EARLY_STOP_MIN_CHARS = 200
+
+# 提前结束前用小模型再确认一次时的系统提示，以及交给它的已完成输出的总字数上限
+EARLY_STOP_CHECK_PROMPT = "你负责判断一个多步骤任务是否已经可以结束。用户会给出整体任务、已经完成的步骤的输出和剩下还没有执行的步骤。如果已有的输出已经包含完成整体任务所需的全部内容，剩下的步骤不会带来新的必要内容，只回答“是”；否则只回答“否”。不要输出其他内容。"
+EARLY_STOP_CHECK_CHARS = 8000
+
+@dataclass
+class ChainConfig:
+    """
+    一次链式处理的配置，对应界面侧边栏中的各项设置
+    """
+    api_keys: list
+    # 每个密钥每分钟最多的请求数和令牌数
+    key_rpm: int = DEFAULT_KEY_RPM
+    key_tpm: int = DEFAULT_KEY_TPM
+    # 默认模型，没有在model_routes中单独指定的角色都使用它
+    model: str = "Qwen/QwQ-32B"
+    optimizer_model: str = INPUT_OPTIMIZER_MODEL
+    # 按角色指定模型{角色: 模型}，角色见model_router.ROLES，其中optimizer默认使用optimizer_model
+    model_routes: dict = None
+    # 是否根据观测到的速度和输入长度为中间步骤自动选择模型
+    auto_route: bool = False
+    # 调用失败后换用的模型列表，为None时先换回默认模型，再按MODEL_CONFIGS的顺序尝试
+    fallback_models: list = None
+    stream: bool = False
+    dag_mode: bool = False
+    max_workers: int = DEFAULT_MAX_WORKERS
+    compact_context: bool = False
+    # 步骤请求的消息布局，见MESSAGE_LAYOUTS
+    message_layout: str = "merged"
+    # 是否把每一步回答中的推理过程（<think>...</think>）去掉，只把正式回答交给后续步骤，推理过程仍保留用于显示
+    strip_reasoning: bool = True
+    doc_retrieval: bool = True
+    doc_context_tokens: int = DEFAULT_CONTEXT_TOKENS
+    doc_top_k: int = DEFAULT_TOP_K
+    use_cache: bool = False
+    cache_bypass: bool = False
+    # 多条链共用的全局速率限制（http_client.RateLimiter），为None时不限制
+    rate_limiter: object = None
+    # 是否把规划和每个完成的步骤保存到检查点数据库，之后可以用run_id继续
+    checkpoints: bool = True
+    # 检查点的所有者（网页上每个浏览器会话一个编号），只能继续自己创建的运行；为None时不检查（命令行批处理）
+    checkpoint_owner: str = None
+    # 融合规划：指令优化和步骤规划在同一次规划模型调用中完成，少一次推理模型的往返
+    fused_planning: bool = False
+    # 规划回答的格式，见ai_utils.PLAN_FORMATS；个别步骤缺失或残缺时只补写这几个步骤
+    plan_format: str = "text"
+    # 是否根据观测到的响应时间缩短单次请求的超时，以及是否对明显变慢的请求发出对冲请求（见latency_tracker）
+    adaptive_timeout: bool = True
+    hedge: bool = False
+    # 整条链（从begin开始）最多运行的秒数，到时后正在进行的调用立即放弃，为None时不限制
+    chain_deadline: float = None
+    # 提前结束（只在顺序模式下生效）：中间步骤认为整体任务已经可以总结时跳过剩下的中间步骤，
+    # early_stop_check开启时跳过之前还要由小模型确认一次
+    early_stop: bool = False
+    early_stop_check: bool = False
+    # 是否按同一角色最近的输出长度为中间步骤设置max_tokens（见model_router.output_budget），不再每一步都预留模型的最大输出
+    adaptive_max_tokens: bool = False
+
+@dataclass
+class ChainResult:
+    """
+    一次完整运行的结果
+    """
+    optimized_prompt: str
+    prompts: list
+    results: list
+    complete: bool
+    failed_steps: list
+    usage: dict
+    run_id: str = None
+
+    @property
+    def final_output(self):
+        return self.results[-1] if self.complete and self.results else None
+
+class UsageStats:
+    """
+    令牌用量、缓存命中和调用延迟的统计，可以被多个线程同时更新
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        self.saved_tokens = 0
+        # 输入令牌中命中服务端前缀缓存的部分（接口返回了才有）
+        self.prompt_cache_tokens = 0
+        self.cache_stats = {"hits": 0, "tokens": 0}
+        # 每个步骤去掉的推理过程：{步骤下标: {"tokens": 估算的令牌数, "forwarded": 被后续步骤使用的次数}}
+        self.reasoning_stats = {}
+        self.call_metrics = []
+        # 开始第一个步骤之前的准备耗时，见ChainRunner.prepare
+        self.setup = {}
+        # 提前结束的情况：{"after": 在哪个步骤之后结束, "skipped": 跳过的中间步骤数}
+        self.early_stop = {}
+
+    def add_usage(self, usage):
+        # usage是接口返回的usage字段，包含prompt_tokens/completion_tokens/total_tokens
+        with self._lock:
+            for name in self.token_usage:
+                self.token_usage[name] += usage.get(name, 0)
+            self.prompt_cache_tokens += cached_prompt_tokens(usage)
+
+    def add_saved_tokens(self, saved_tokens):
+        # 上下文压缩节省的令牌数（估算值）
+        with self._lock:
+            self.saved_tokens += saved_tokens
+
+    def add_cache_hit(self, usage):
+        # 命中响应缓存的令牌用量单独统计，不计入实际的token_usage
+        with self._lock:
+            self.cache_stats["hits"] += 1
+            self.cache_stats["tokens"] += usage.get("total_tokens", 0)
+
+    def add_reasoning_stripped(self, index, tokens):
+        with self._lock:
+            self.reasoning_stats[index] = {"tokens": tokens, "forwarded": 0}
+
+    def add_reasoning_forwarded(self, index):
+        # 去掉了推理过程的输出每被后续步骤使用一次，就少发送一次这些令牌
+        with self._lock:
+            if index in self.reasoning_stats:
+                self.reasoning_stats[index]["forwarded"] += 1
+
+    @property
+    def reasoning_saved_tokens(self):
+        # 去掉推理过程节省的输入令牌数（估算值）
+        with self._lock:
+            return sum(item["tokens"] * item["forwarded"] for item in self.reasoning_stats.values())
+
+    def set_setup(self, setup):
+        with self._lock:
+            self.setup = dict(setup)
+
+    def set_early_stop(self, early_stop):
+        with self._lock:
+            self.early_stop = dict(early_stop)
+
+    def record_call(self, record):
+        # 保存单次调用的完整记录（字段见telemetry模块），包括失败和命中缓存的调用
+        with self._lock:
+            self.call_metrics.append(record)
+
+    @property
+    def hedge_stats(self):
+        # 对冲请求的次数、对冲请求胜出的次数和额外消耗的输入令牌（按胜出请求的输入令牌数估算，不含被取消请求已生成的部分）
+        with self._lock:
+            hedged = [record for record in self.call_metrics if record.get("hedged")]
+        return {
+            "hedged": len(hedged),
+            "won": sum(1 for record in hedged if record["hedge_won"]),
+            "extra_prompt_tokens": sum(record["prompt_tokens"] for record in hedged)
+        }
+
+    def to_dict(self):
+        hedge_stats = self.hedge_stats
+        with self._lock:
+            return {
+                "token_usage": dict(self.token_usage),
+                "saved_tokens": self.saved_tokens,
+                "prompt_cache_tokens": self.prompt_cache_tokens,
+                "cache_stats": dict(self.cache_stats),
+                "reasoning_stats": {index: dict(item) for index, item in self.reasoning_stats.items()},
+                "reasoning_saved_tokens": sum(item["tokens"] * item["forwarded"] for item in self.reasoning_stats.values()),
+                "hedge_stats": hedge_stats,
+                "setup": dict(self.setup),
+                "early_stop": dict(self.early_stop),
+                "call_metrics": list(self.call_metrics)
+            }
+
+class ChainRunner:
+    """
+    不依赖界面的链式处理引擎：优化指令 -> 规划步骤 -> 逐步（或按依赖并行）执行
+
+    所有过程信息通过on_event(事件名, 数据字典)通知调用方，可以在Streamlit页面、脚本或工作线程中使用。
+    除了ai_utils.chat_completion发出的请求事件外，还会发出：
+    cache_hit / warning / optimized / raw_plan / setup_done / resumed / step_start / step_done / step_failed / step_error /
+    waiting / early_stop。
+    并行模式下事件会在工作线程中发出。
+
+    cancel()可以在任何线程中调用，正在进行的调用（包括重试前的退避和排队）会很快结束并以失败返回；
+    再次执行前调用begin()清除取消状态并重新计算整条链的截止时间。
+
+    传入store（session_store.SessionStore）时，文档全文、步骤结果和推理过程中较大的部分保存在磁盘上，
+    对象本身只保留引用；检索索引在进程内按文档内容共享。
+    """
+
+    def __init__(self, config, on_event=None, stats=None, summary_cache=None, store=None):
+        self.config = config
+        self.on_event = on_event
+        self.stats = stats or UsageStats()
+        self.summary_cache = summary_cache or SummaryCache()
+        self.store = store
+        self.prompts = []
+        self.dependencies = []
+        # 提前结束时跳过的中间步骤
+        self.skipped_steps = []
+        self.results = self._new_mapping()
+        # 每个步骤的推理过程，只用于显示，不会交给后续步骤
+        self.reasoning = self._new_mapping()
+        self.user_prompt = ""
+        self.optimized_prompt = ""
+        self.run_id = None
+        self._document = ""
+        self._document_hash = ""
+        self.document_label = ""
+        self._call_ids = itertools.count(1)
+        self.cancel_event = threading.Event()
+        # 整条链的截止时间（time.monotonic()的值），由begin()根据config.chain_deadline设置
+        self.deadline = None
+
+    def begin(self):
+        """开始（或继续）一次执行：清除之前的取消状态，重新计算整条链的截止时间"""
+        self.cancel_event.clear()
+        self.deadline = time.monotonic() + self.config.chain_deadline if self.config.chain_deadline else None
+
+    def cancel(self):
+        """放弃正在进行的调用，之后的调用也会立即失败，直到再次调用begin()"""
+        self.cancel_event.set()
+
+    @property
+    def aborted(self):
+        # 已被取消或超过整条链的截止时间
+        return self.cancel_event.is_set() or (self.deadline is not None and time.monotonic() >= self.deadline)
+
+    def _new_mapping(self, initial=None):
+        # 步骤编号 -> 文本，有store时大文本保存在磁盘上
+        if self.store is not None:
+            return SpilledDict(self.store, initial)
+        return dict(initial or {})
+
+    @property
+    def document_text(self):
+        if self.store is not None:
+            return self.store.get(self._document)
+        return self._document
+
+    @property
+    def doc_index(self):
+        # 文档的检索索引，没有文档时为None
+        if not self._document_hash:
+            return None
+        return get_document_index(self._document_hash, lambda: self.document_text)
+
+    @property
+    def router(self):
+        routes = {"optimizer": self.config.optimizer_model}
+        routes.update({role: model for role, model in (self.config.model_routes or {}).items() if model})
+        return model_router.ModelRouter(self.config.model, routes, self.config.auto_route, self.config.fallback_models)
+
+    @property
+    def key_pool(self):
+        # 同一个密钥的限额和健康状况在进程内共享，这里只是按当前配置组合出密钥池
+        return KeyPool(self.config.api_keys, self.config.key_rpm, self.config.key_tpm)
+
+    def emit(self, event, data):
+        if self.on_event is not None:
+            self.on_event(event, data)
+
+    def set_document(self, text, label=""):
+        """
+        设置上传文档的文本，并在内容变化时重新构建检索索引
+
+        Args:
+            text (str): 文档全文，为空表示没有文档
+            label (str): 文档类型名称，如"PDF"、"Word"，用于提示文字
+
+        Returns:
+            DocumentIndex: 文档的检索索引，没有文档时返回None
+        """
+        text = text or ""
+        self._document_hash = hashlib.sha256(text.encode("utf-8")).hexdigest() if text else ""
+        self._document = self.store.put(text) if self.store is not None else text
+        self.document_label = label
+        return self.doc_index
+
+    def document_context(self, query):
+        """
+        获取某个步骤要用到的文档内容
+        检索模式下只取出与该步骤最相关的片段（文档不大时仍是全文），否则每一步都使用全文
+        """
+        if not self._document_hash:
+            return ""
+        if not self.config.doc_retrieval:
+            return self.document_text
+        return self.doc_index.context_for(query, self.config.doc_context_tokens, self.config.doc_top_k)
+
+    def _cache_lookup(self, payload, step_name):
+        # 只有开启了响应缓存、且本次运行没有选择重新采样时才会读取缓存
+        if not self.config.use_cache or self.config.cache_bypass:
+            return None
+        try:
+            response_data = get_response_cache().get(payload)
+        except sqlite3.Error as e:
+            self.emit("warning", {"message": f"读取响应缓存出错，将直接调用API: {str(e)}"})
+            return None
+        if response_data is None:
+            return None
+        self.stats.add_cache_hit(response_data.get("usage") or {})
+        self.emit("cache_hit", {"step": step_name})
+        return response_data
+
+    def _cache_store(self, payload, response_data):
+        # 开启缓存时，重新采样的结果也会覆盖旧的缓存
+        if not self.config.use_cache:
+            return
+        # 只缓存有实际内容的完整回答，格式异常的响应不写入
+        choices = response_data.get("choices") or []
+        if not choices or not (choices[0].get("message") or {}).get("content"):
+            return
+        try:
+            get_response_cache().put(payload, response_data)
+        except sqlite3.Error as e:
+            self.emit("warning", {"message": f"写入响应缓存出错: {str(e)}"})
+
+    def complete(self, payload, step_name="", retry_policy=STEP_RETRY_POLICY, with_reasoning=False, role=None):
+        """
+        acomplete的同步版本，参数和返回值相同
+        """
+        return asyncio.run(self.acomplete(payload, step_name, retry_policy, with_reasoning, role))
+
+    async def acomplete(self, payload, step_name="", retry_policy=STEP_RETRY_POLICY, with_reasoning=False, role=None):
+        """
+        发送一次请求（优先使用响应缓存），并记录令牌用量和延迟
+
+        Args:
+            payload (dict): 发给API的请求参数
+            step_name (str): 调用所属的步骤名称，如"指令优化"、"步骤 1"
+            retry_policy (dict): 重试策略，见ai_utils.STEP_RETRY_POLICY
+            with_reasoning (bool): 是否同时返回接口单独给出的推理过程(reasoning_content)
+            role (str): 调用的角色（model_router.ROLES），指定时由路由决定使用的模型，
+                        多次重试仍然失败后换用其他模型；为None时只使用payload中的模型。
+                        开启adaptive_max_tokens时按角色的输出预算发送，回答因此被截断时按模型的最大输出重新生成
+
+        Returns:
+            str: AI的回答内容，失败时返回None；with_reasoning为True时返回(回答内容, 推理过程)
+        """
+        if role is None:
+            return await self._acomplete_once(payload, step_name, retry_policy, with_reasoning)
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in payload["messages"])
+        models = self.router.candidates(role, prompt_tokens)
+        for i, model in enumerate(models):
+            if i:
+                self.emit("warning", {"message": f"{step_name or '本次调用'}使用{models[i - 1]}多次失败，改用{model}重试"})
+            # 换用的模型输出上限更小时，按它的上限发送
+            max_tokens = min(payload["max_tokens"], MODEL_CONFIGS.get(model, {}).get("max_tokens", payload["max_tokens"]))
+            budget = model_router.output_budget(role, model, max_tokens) if self.config.adaptive_max_tokens else max_tokens
+            traces = []
+            result = await self._acomplete_once(dict(payload, model=model, max_tokens=budget), step_name,
+                                                retry_policy, with_reasoning, role, traces)
+            if result is not None and budget < max_tokens and traces and traces[-1].get("finish_reason") == "length":
+                self.emit("warning", {"message": f"{step_name or '本次调用'}的回答超出了{budget}个令牌的输出预算，按模型的最大输出重新生成"})
+                result = await self._acomplete_once(dict(payload, model=model, max_tokens=max_tokens), step_name,
+                                                    retry_policy, with_reasoning, role)
+            # 被取消或超时的调用换用其他模型也没有意义
+            if result is not None or self.aborted:
+                return result
+        return None
+
+    async def _acomplete_once(self, payload, step_name, retry_policy, with_reasoning, role=None, traces=None):
+        # 响应缓存：模型、消息和采样参数完全相同的调用直接返回上次的回答
+        # traces不为None时，本次调用的记录会追加到其中，用于判断回答是否被截断
+        call_id = next(self._call_ids)
+        cached_data = self._cache_lookup(payload, step_name)
+        if cached_data is not None:
+            record = cached_call_record(call_id, step_name, payload, cached_data)
+            self.stats.record_call(record)
+            if traces is not None:
+                traces.append(record)
+            message = cached_data["choices"][0]["message"]
+            return (message["content"], message.get("reasoning_content") or "") if with_reasoning else message["content"]
+
+        def on_event(event, data):
+            # 每次调用结束（无论成败）都会收到完整的调用记录，同时用来更新模型的速度和健康统计
+            if event == "call_trace":
+                record = data["record"]
+                self.stats.record_call(record)
+                model_router.observe(record)
+                if record["status"] == "ok":
+                    model_router.observe_output(role, record["model"], record["completion_tokens"],
+                                                record["finish_reason"] == "length")
+                if traces is not None:
+                    traces.append(record)
+            self.emit(event, data)
+
+        result = await achat_completion(payload, self.key_pool, on_event=on_event, call_id=call_id, step_name=step_name,
+                                        rate_limiter=self.config.rate_limiter, deadline=self.deadline,
+                                        cancel_event=self.cancel_event, adaptive_timeout=self.config.adaptive_timeout,
+                                        hedge=self.config.hedge, call_kind=role or "", **retry_policy)
+        if result is None:
+            return None
+        response_data = result["response_data"]
+        # 把成功的回答写入响应缓存，下次相同的调用可以直接复用
+        self._cache_store(payload, response_data)
+        # 更新令牌使用统计
+        if "usage" in response_data:
+            self.stats.add_usage(response_data["usage"])
+        if with_reasoning:
+            return result["content"], response_data["choices"][0]["message"].get("reasoning_content") or ""
+        return result["content"]
+
+    def call_model(self, prompt, initial_prompt="", chain_input="", all_previous_outputs=None, step_name="",
+                   previous_output_steps=None, model=None, max_tokens=None, compact_context=None, stream=None,
+                   with_reasoning=False, role=None):
+        """
+        acall_model的同步版本，参数和返回值相同
+        """
+        return asyncio.run(self.acall_model(
+            prompt, initial_prompt, chain_input, all_previous_outputs, step_name, previous_output_steps, model,
+            max_tokens, compact_context, stream, with_reasoning, role))
+
+    async def acall_model(self, prompt, initial_prompt="", chain_input="", all_previous_outputs=None, step_name="",
+                          previous_output_steps=None, model=None, max_tokens=None, compact_context=None, stream=None,
+                          with_reasoning=False, role=None):
+        """
+        组织消息并调用模型，之前步骤的输出和链式输入会拼进用户消息中
+
+        Args:
+            prompt (str): 当前的任务
+            initial_prompt (str): 系统提示
+            chain_input (str): 前一个AI的输出或初始输入（如文档内容）
+            all_previous_outputs (list): 之前所有（或前置）步骤的输出
+            step_name (str): 调用所属的步骤名称
+            previous_output_steps (list): 每个输出对应的步骤编号，默认按顺序编号
+            model (str): 使用的模型，默认使用配置中的模型
+            max_tokens (int): 最大输出长度，默认使用模型配置
+            compact_context (bool): 是否压缩之前的输出，默认跟随配置
+            stream (bool): 是否流式输出，默认跟随配置
+            with_reasoning (bool): 是否同时返回接口单独给出的推理过程
+            role (str): 调用的角色，见complete
+
+        Returns:
+            str: AI的回答内容，失败时返回None；with_reasoning为True时返回(回答内容, 推理过程)
+        """
+        stream = self.config.stream if stream is None else stream
+        compact_context = self.config.compact_context if compact_context is None else compact_context
+        model = model or (self.router.model_for(role) if role else self.config.model)
+
+        # 构建API请求消息列表
+        messages = []
+        # 如果提供了初始提示，将其作为系统消息添加到列表中
+        # 系统消息用于设定AI的行为规则、角色和限制
+        if initial_prompt:
+            messages.append({"role": "system", "content": initial_prompt})
+
+        # 处理链式输入：如果存在前一个AI的输出，将其与当前prompt组合
+        # 这允许多个AI模型协作完成复杂任务，前一个AI的输出可以作为下一个AI的输入
+        if all_previous_outputs:
+            # previous_output_steps给出每个输出对应的步骤编号（并行执行时只传入前置步骤的输出），默认按顺序编号
+            step_numbers = previous_output_steps or range(1, len(all_previous_outputs) + 1)
+            # 压缩上下文时会同步调用摘要模型，放到线程里执行，不阻塞事件循环
+            entries = await asyncio.to_thread(self._previous_entries, step_numbers, all_previous_outputs, model,
+                                              compact_context)
+            previous_outputs_text = "\n\n".join([
+                f"第{n}个AI的输出{'（摘要）' if is_summary else ''}：\n{output}" for n, output, is_summary in entries
+            ])
+            prompt = f"之前所有AI的输出：\n{previous_outputs_text}\n\n你的任务：\n{prompt}"
+        elif chain_input:
+            # 只提供了单个chain_input时，只考虑前一个AI的输出
+            prompt = f"前一个AI的输出：\n{chain_input}\n\n你的任务：\n{prompt}"
+
+        # 添加用户消息到列表中
+        messages.append({"role": "user", "content": prompt})
+        payload = self._build_payload(messages, model, max_tokens, stream)
+        return await self.acomplete(payload, step_name, with_reasoning=with_reasoning, role=role)
+
+    def _previous_entries(self, step_numbers, outputs, model, compact_context):
+        # 返回[(步骤编号, 内容, 是否为摘要)]
+        if not compact_context:
+            return [(n, output, False) for n, output in zip(step_numbers, outputs)]
+        # 上下文压缩：在模型的令牌预算内保留最近的输出原文，较早的输出替换为摘要
+        # 避免第N步重复发送前面N-1步的全部原文，导致令牌用量随步骤数平方增长
+        entries, saved_tokens = build_context(
+            list(zip(step_numbers, outputs)),
+            MODEL_CONFIGS.get(model, {}).get("context_budget", 12000),
+            self.summary_cache,
+            self.summarize
+        )
+        self.stats.add_saved_tokens(saved_tokens)
+        return entries
+
+    def _build_payload(self, messages, model, max_tokens=None, stream=None):
+        # 构建API请求参数
+        # 这些参数控制AI生成回答的方式，如温度（创造性）、最大长度等
+        stream = self.config.stream if stream is None else stream
+        return {
+            "model": model,  # 使用指定的AI模型，默认是配置中的模型
+            "messages": messages,  # 包含系统提示和用户问题的消息列表
+            "stream": stream,  # 是否使用流式输出（False时等待完整回答后一次性返回）
+            "max_tokens": max_tokens or MODEL_CONFIGS.get(model, {}).get("max_tokens", 4096),  # 设置回答的最大长度
+            "stop": None,  # 不设置特定的停止词
+            "temperature": 0.7,  # 温度参数，控制回答的随机性/创造性，0.7是适中的值
+            "top_p": 0.7,  # 控制词汇选择的多样性，与temperature配合使用
+            "top_k": 50,  # 每一步只考虑概率最高的前50个词
+            "frequency_penalty": 0.5,  # 降低重复词汇的概率，避免AI重复自己
+            "n": 1,  # 只生成一个回答
+            "response_format": {"type": "text"}  # 指定回答格式为纯文本
+        }
+
+    def summarize(self, text):
+        """
+        使用摘要模型把一个步骤的输出压缩成要点摘要，调用失败时返回None（由调用方退回到截断原文）
+        """
+        return self.call_model(text, SUMMARY_PROMPT, stream=False, step_name="上下文摘要",
+                               model=SUMMARY_MODEL, max_tokens=SUMMARY_MAX_TOKENS * 2, compact_context=False)
+
+    def optimize(self, user_prompt):
+        """
+        aoptimize的同步版本，参数和返回值相同
+        """
+        return asyncio.run(self.aoptimize(user_prompt))
+
+    async def aoptimize(self, user_prompt):
+        """
+        优化用户输入的指令
+
+        Args:
+            user_prompt (str): 用户原始输入的指令或问题文本
+
+        Returns:
+            str: 优化后的指令文本，如果优化失败则返回原始输入
+        """
+        self.user_prompt = user_prompt
+        # 构建API请求参数，包含系统提示和用户原始指令
+        payload = {
+            "model": self.router.model_for("optimizer"),
+            "messages": [
+                {"role": "system", "content": OPTIMIZER_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt + OPTIMIZER_SYSTEM_PROMPT}
+            ],
+            "stream": self.config.stream,  # 是否使用流式输出
+            "max_tokens": 4096,  # 设置回答的最大长度
+            "stop": None,  # 不设置特定的停止词
+            "temperature": 0.7,  # 温度参数，控制回答的随机性
+            "top_p": 0.7,  # 控制词汇选择的多样性
+            "top_k": 50,  # 每一步只考虑概率最高的前50个词
+            "frequency_penalty": 0.5,  # 降低重复词汇的概率
+            "n": 1  # 只生成一个回答
+        }
+        optimized_prompt = await self.acomplete(payload, "指令优化", OPTIMIZER_RETRY_POLICY, role="optimizer")
+        if optimized_prompt and self.config.strip_reasoning:
+            # 优化后的指令会交给规划AI，同样只保留正式回答
+            optimized_prompt = split_reasoning(optimized_prompt)[1] or optimized_prompt
+        if not optimized_prompt:
+            # 确保即使优化失败，用户的请求仍然能够被处理
+            self.emit("warning", {"message": "指令优化失败，将使用原始指令继续处理"})
+            return user_prompt
+        self.emit("optimized", {"original": user_prompt, "optimized": optimized_prompt})
+        return optimized_prompt
+
+    def plan(self, optimized_prompt, run_id=None):
+        """
+        让规划AI把任务拆分成步骤，并追加一个总结步骤；之前的步骤结果会被清空
+        开启检查点时，规划会以新的运行编号（或指定的run_id）保存下来
+
+        Args:
+            optimized_prompt (str): 优化后的指令
+            run_id (str): 保存检查点使用的运行编号，默认生成新的编号
+
+        Returns:
+            list: 步骤prompt列表，规划失败时返回None
+        """
+        return self._apply_plan(self._request_plan(optimized_prompt), optimized_prompt, run_id)
+
+    def _planner_prompt(self):
+        # 并行模式下额外要求规划AI标出步骤之间的依赖关系，json格式下依赖写在depends_on字段中
+        if self.config.plan_format == "json":
+            instruction = JSON_PLAN_INSTRUCTION + (JSON_PLAN_DEPENDENCY_INSTRUCTION if self.config.dag_mode else "")
+            return f"{FIXED_INITIAL_PROMPT}\n\n{instruction}"
+        return FIXED_INITIAL_PROMPT + DAG_PLAN_INSTRUCTION if self.config.dag_mode else FIXED_INITIAL_PROMPT
+
+    def _request_plan(self, optimized_prompt):
+        return self.call_model(optimized_prompt, self._planner_prompt(), step_name="步骤规划", role="planner")
+
+    def _request_fused_plan(self, user_prompt):
+        # 融合规划：一次调用同时给出优化后的指令和步骤，返回(优化后的指令, 去掉优化部分后的规划回答)
+        self.user_prompt = user_prompt
+        system = f"{self._planner_prompt()}\n\n{FUSED_PLAN_INSTRUCTION}\n\n{OPTIMIZER_SYSTEM_PROMPT}"
+        response = self.call_model(user_prompt, system, step_name="指令优化与步骤规划", role="planner")
+        if not response:
+            return user_prompt, None
+        optimized_prompt, plan_response = split_fused_plan(response)
+        if optimized_prompt is None:
+            self.emit("warning", {"message": "融合规划的回答中没有找到优化后的指令，将使用原始指令"})
+            return user_prompt, plan_response
+        self.emit("optimized", {"original": user_prompt, "optimized": optimized_prompt})
+        return optimized_prompt, plan_response
+
+    def _repair_plan(self, parsed, optimized_prompt):
+        """
+        只补写规划中缺失或残缺的步骤，不重新规划整个任务；补写失败的步骤会被去掉
+
+        Args:
+            parsed (ai_utils.ParsedPlan): 规划的解析结果，补写的步骤直接填入其中
+            optimized_prompt (str): 优化后的指令
+        """
+        missing = parsed.missing
+        steps_text = "\n".join(f"{i + 1}. {step if step is not None else '（待补写）'}" for i, step in enumerate(parsed.steps))
+        numbers = "、".join(str(i + 1) for i in missing)
+        system = PLAN_REPAIR_PROMPT + (PLAN_REPAIR_DEPENDENCY_PROMPT if self.config.dag_mode else "")
+        response = self.call_model(f"整体任务：\n{optimized_prompt}\n\n目前的步骤：\n{steps_text}\n\n请补写第{numbers}步。",
+                                   system, stream=False, step_name="步骤修复", model=PLAN_REPAIR_MODEL,
+                                   max_tokens=PLAN_REPAIR_MAX_TOKENS, compact_context=False)
+        for index, (step, dependencies) in parse_plan_repair(response, missing).items():
+            parsed.fill(index, step, dependencies if self.config.dag_mode else None)
+        still_missing = parsed.missing
+        if len(still_missing) < len(missing):
+            self.emit("warning", {"message": f"已补写规划中的 {len(missing) - len(still_missing)} 个步骤"})
+        if still_missing:
+            self.emit("warning", {"message": f"第{'、'.join(str(i + 1) for i in still_missing)}步无法补写，将跳过这些步骤"})
+
+    def _apply_plan(self, response, optimized_prompt, run_id=None):
+        # 解析规划回答并保存为当前运行的步骤，回答为空时返回None
+        # 只有部分步骤缺失或残缺时先补写这几个步骤，全部无法解析时不补写（没有可以参照的步骤）
+        if not response:
+            return None
+        parsed = parse_plan(response, with_dependencies=self.config.dag_mode, on_event=self.emit)
+        if parsed.missing and len(parsed.missing) < len(parsed.steps):
+            self._repair_plan(parsed, optimized_prompt)
+        prompts, dependencies = parsed.usable()
+        prompts.append(FINAL_STEP_PROMPT)
+        self.optimized_prompt = optimized_prompt
+        self.prompts = prompts
+        self.skipped_steps = []
+        self.results = self._new_mapping()
+        self.reasoning = self._new_mapping()
+        # 总结步骤没有依赖标记，会依赖前面所有步骤；顺序模式下不保存依赖
+        self.dependencies = normalize_dependencies(len(prompts), dependencies) if self.config.dag_mode else []
+        self.run_id = run_id or new_run_id()
+        self._checkpoint("save_plan", self.run_id, self.user_prompt, optimized_prompt, prompts, self.dependencies,
+                         self.document_text, self.document_label,
+                         {"model": self.config.model, "model_routes": self.config.model_routes, "dag_mode": self.config.dag_mode,
+                          "compact_context": self.config.compact_context, "fused_planning": self.config.fused_planning,
+                          "early_stop": self.config.early_stop, "plan_format": self.config.plan_format},
+                         self.config.checkpoint_owner or "")
+        return prompts
+
+    def prepare(self, user_prompt, load_document=None, run_id=None):
+        """
+        开始执行步骤之前的准备：读取文档、优化指令、规划步骤
+
+        文档的读取和检索索引的构建在工作线程中进行，与指令优化和规划的模型调用同时进行，
+        保存规划（检查点中包含文档）之前才等待文档准备好。开启融合规划时，优化和规划只需要一次模型调用。
+        各阶段的耗时保存在stats.setup中，并通过setup_done事件通知。
+
+        Args:
+            user_prompt (str): 用户输入的指令
+            load_document (callable): load_document()返回(文档文本, 文档类型名称)，在工作线程中调用；
+                                      为None时使用已经设置的文档
+            run_id (str): 保存检查点使用的运行编号，默认生成新的编号
+
+        Returns:
+            list: 步骤prompt列表，规划失败时返回None
+        """
+        started_at = time.monotonic()
+        setup = {"fused": self.config.fused_planning, "ingest": 0.0, "optimize": None, "plan": 0.0}
+
+        def ingest():
+            ingest_started_at = time.monotonic()
+            if load_document is not None:
+                self.set_document(*load_document())
+            else:
+                # 只构建检索索引，已经建好时直接返回
+                self.doc_index
+            setup["ingest"] = time.monotonic() - ingest_started_at
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            ingestion = executor.submit(ingest)
+            call_started_at = time.monotonic()
+            if self.config.fused_planning:
+                optimized_prompt, response = self._request_fused_plan(user_prompt)
+            else:
+                optimized_prompt = self.optimize(user_prompt)
+                setup["optimize"] = time.monotonic() - call_started_at
+                call_started_at = time.monotonic()
+                response = self._request_plan(optimized_prompt)
+            setup["plan"] = time.monotonic() - call_started_at
+            # 文档读取出错时异常在这里抛出
+            ingestion.result()
+        self.optimized_prompt = optimized_prompt
+        prompts = self._apply_plan(response, optimized_prompt, run_id)
+        setup["total"] = time.monotonic() - started_at
+        self.stats.set_setup(setup)
+        self.emit("setup_done", dict(setup))
+        return prompts
+
+    def _checkpoint(self, method, *args):
+        # 检查点只是为了出错后能继续，写入失败时提示一下，不影响本次运行
+        if not self.config.checkpoints:
+            return
+        try:
+            getattr(get_checkpoint_store(), method)(*args)
+        except sqlite3.Error as e:
+            self.emit("warning", {"message": f"保存检查点出错，本次运行中断后将无法继续: {str(e)}"})
+
+    def resume(self, run_id):
+        """
+        从检查点恢复一次运行：恢复指令、规划、依赖关系、文档和已完成的步骤，
+        之后调用run_steps只会执行剩下的步骤，不会重新调用优化、规划和已完成的步骤
+
+        Args:
+            run_id (str): 运行编号
+
+        Returns:
+            bool: 是否找到了这次运行
+        """
+        try:
+            data = get_checkpoint_store().load_run(run_id, owner=self.config.checkpoint_owner)
+        except sqlite3.Error as e:
+            self.emit("warning", {"message": f"读取检查点出错: {str(e)}"})
+            return False
+        if data is None:
+            return False
+        self.run_id = run_id
+        self.user_prompt = data["user_prompt"]
+        self.optimized_prompt = data["optimized_prompt"]
+        self.prompts = data["prompts"]
+        # 提前结束时跳过的步骤，前缀稳定布局的系统消息仍要列出完整的规划
+        self.skipped_steps = data["skipped_steps"]
+        if self.skipped_steps:
+            self.stats.set_early_stop({"after": len(self.prompts) - 2, "skipped": len(self.skipped_steps)})
+        self.dependencies = data["dependencies"]
+        self.results = self._new_mapping(data["results"])
+        self.reasoning = self._new_mapping(data["reasoning"])
+        self.set_document(data["document_text"], data["document_label"])
+        self.emit("resumed", {"run_id": run_id, "done": len(self.results), "total": len(self.prompts)})
+        return True
+
+    def _prefix_step_messages(self, index, dep_outputs, model):
+        """
+        前缀稳定的消息布局：文档和整体任务放在固定的系统消息中，之前步骤的任务和输出按步骤顺序追加为多轮对话，
+        顺序执行时每一步的请求都是上一步请求的严格延伸，服务端的前缀缓存（KV缓存）可以复用之前计算过的部分
+        """
+        # 检索模式下按整体任务检索文档片段，保证每一步的系统消息完全相同
+        document_context = self.document_context(self.optimized_prompt)
+        system = f"{PREFIX_SYSTEM_PROMPT}\n\n整体任务：\n{self.optimized_prompt}"
+        # 提前结束后步骤列表会缩短，这里仍列出原来的完整规划，总结步骤的系统消息与之前的步骤相同
+        plan = self.prompts[:-1] + self.skipped_steps + self.prompts[-1:]
+        if self.config.early_stop and not self.dependencies and len(plan) > 2:
+            system += "\n\n" + EARLY_STOP_SYSTEM_INSTRUCTION.format(
+                plan="\n".join(f"{n}. {prompt}" for n, prompt in enumerate(plan, 1)))
+        if document_context:
+            system += f"\n\n以下是上传的{self.document_label}文档内容：\n\n{document_context}"
+        messages = [{"role": "system", "content": system}]
+        dep_indices = sorted(dep_outputs)
+        entries = self._previous_entries([d + 1 for d in dep_indices], [dep_outputs[d] for d in dep_indices],
+                                         model, self.config.compact_context)
+        for n, output, is_summary in entries:
+            messages.append({"role": "user", "content": f"第{n}步的任务：\n{self.prompts[n - 1]}"})
+            messages.append({"role": "assistant", "content": f"（摘要）{output}" if is_summary else output})
+        messages.append({"role": "user", "content": f"第{index + 1}步的任务：\n{self.prompts[index]}"})
+        return messages
+
+    def _run_step(self, index, dep_outputs):
+        current_prompt = self.prompts[index]
+        step_name = f"步骤 {index + 1}"
+        # 最后的总结步骤和中间步骤可以使用不同的模型
+        role = "final" if index == len(self.prompts) - 1 else "step"
+        model = self.router.model_for(role)
+        self.emit("step_start", {"index": index, "total": len(self.prompts)})
+        for d in dep_outputs:
+            self.stats.add_reasoning_forwarded(d)
+        early_stop_note = ""
+        # 前缀稳定布局下提前结束的要求写在系统消息中（见_prefix_step_messages），不追加到这一步的任务后面
+        if (self._early_stop_applies(index) and self.config.message_layout != "prefix"
+                and self._remaining_coverage(index, index) >= EARLY_STOP_HINT_COVERAGE):
+            remaining = "\n".join(f"{n}. {prompt}" for n, prompt in enumerate(self.prompts[index + 1:-1], index + 2))
+            early_stop_note = "\n\n" + EARLY_STOP_INSTRUCTION.format(task=self.optimized_prompt, remaining=remaining)
+        if self.config.message_layout == "prefix":
+            messages = self._prefix_step_messages(index, dep_outputs, model)
+            payload = self._build_payload(messages, model)
+            output = self.complete(payload, step_name, with_reasoning=True, role=role)
+        elif dep_outputs:
+            # 把前置步骤的输出交给当前步骤，同时确保能获取到文档内容（检索模式下只取相关片段）
+            # 检索只用这一步自己的任务，不带提前结束的说明，否则会检索到后面步骤相关的片段
+            document_context = self.document_context(current_prompt)
+            current_prompt += early_stop_note
+            if document_context:
+                current_prompt = f"以下是上传的{self.document_label}文档内容：\n\n{document_context}\n\n基于以上内容和之前AI的输出，请继续：\n{current_prompt}"
+            dep_indices = sorted(dep_outputs)
+            output = self.call_model(current_prompt, all_previous_outputs=[dep_outputs[d] for d in dep_indices],
+                                     previous_output_steps=[d + 1 for d in dep_indices], step_name=step_name,
+                                     model=model, with_reasoning=True, role=role)
+        else:
+            # 第一步或没有前置步骤时，直接使用初始输入（文档内容）
+            output = self.call_model(current_prompt + early_stop_note, chain_input=self.document_context(current_prompt),
+                                     step_name=step_name, model=model, with_reasoning=True, role=role)
+        return self._answer_part(index, output)
+
+    def _answer_part(self, index, output):
+        # 把步骤输出分成推理过程和正式回答，只有正式回答会作为这一步的结果交给后续步骤
+        if output is None:
+            return None
+        content, reasoning = output
+        answer = content
+        if self.config.strip_reasoning:
+            inline_reasoning, answer = split_reasoning(content)
+            if inline_reasoning:
+                self.stats.add_reasoning_stripped(index, estimate_tokens(inline_reasoning))
+                reasoning = f"{reasoning}\n\n{inline_reasoning}".strip()
+            if content and not answer:
+                # 回答被截断在推理过程中，没有正式回答时只能转发完整输出
+                self.emit("warning", {"message": f"步骤 {index + 1} 的回答中只有推理过程，将把完整输出交给后续步骤"})
+                answer = content
+        if reasoning:
+            self.reasoning[index] = reasoning
+        return answer
+
+    def _early_stop_applies(self, index):
+        # 顺序模式下，后面至少还有一个中间步骤可以跳过时，才让这一步判断是否可以提前结束
+        return self.config.early_stop and not self.dependencies and index < len(self.prompts) - 2
+
+    def _take_early_stop_mark(self, index, result):
+        # 去掉回答中的提前结束标记，返回(回答, 是否建议提前结束)
+        if EARLY_STOP_MARK not in result:
+            return result, False
+        answer = result.replace(EARLY_STOP_MARK, "").strip() or result
+        return answer, self._early_stop_applies(index) and len(answer) >= EARLY_STOP_MIN_CHARS
+
+    def _remaining_coverage(self, index, done):
+        # 第index步之后剩下的中间步骤的词项中，出现在前done个步骤的输出中的比例
+        terms = set(tokenize("\n".join(self.prompts[index + 1:-1])))
+        if not terms:
+            return 0.0
+        covered = set()
+        for i in range(done):
+            covered.update(tokenize(self.results.get(i, "")))
+        return len(terms & covered) / len(terms)
+
+    def _locally_finished(self, index, result):
+        # 不调用模型的提前结束检查：回答足够长，且剩下的中间步骤的词项大多已经出现在已完成的输出中
+        return (self._early_stop_applies(index) and len(result) >= EARLY_STOP_MIN_CHARS
+                and self._remaining_coverage(index, index + 1) >= EARLY_STOP_COVERAGE)
+
+    def _confirm_early_stop(self, index):
+        # 由小模型确认整体任务已经可以总结，没有开启确认时直接同意，确认调用失败时不提前结束
+        if not self.config.early_stop_check:
+            return True
+        outputs = [self.results[i] for i in range(index + 1)]
+        share = EARLY_STOP_CHECK_CHARS // len(outputs)
+        outputs_text = "\n\n".join(f"第{i + 1}步的输出：\n{output[:share]}" for i, output in enumerate(outputs))
+        remaining = "\n".join(f"{n}. {prompt}" for n, prompt in enumerate(self.prompts[index + 1:-1], index + 2))
+        answer = self.call_model(f"整体任务：\n{self.optimized_prompt}\n\n{outputs_text}\n\n剩下的步骤：\n{remaining}",
+                                 EARLY_STOP_CHECK_PROMPT, stream=False, step_name="完成度检查",
+                                 model=SUMMARY_MODEL, max_tokens=16, compact_context=False)
+        return bool(answer) and answer.strip().startswith("是")
+
+    def _skip_to_final(self, index):
+        # 跳过剩下的中间步骤，下一步直接执行总结步骤；已完成步骤的编号不变，检查点中的步骤列表同步缩短
+        self.skipped_steps = self.prompts[index + 1:-1]
+        self.prompts = self.prompts[:index + 1] + self.prompts[-1:]
+        self.stats.set_early_stop({"after": index, "skipped": len(self.skipped_steps)})
+        if self.run_id:
+            self._checkpoint("save_prompts", self.run_id, self.prompts, self.skipped_steps)
+        self.emit("early_stop", {"index": index, "skipped": len(self.skipped_steps), "total": len(self.prompts)})
+
+    def _on_step_done(self, index, result):
+        self.results[index] = result
+        # 每完成一步就保存，中断后从这里继续
+        if self.run_id:
+            self._checkpoint("save_step", self.run_id, index, result, self.reasoning.get(index, ""))
+        self.emit("step_done", {"index": index, "result": result, "done": len(self.results), "total": len(self.prompts)})
+
+    def _on_step_error(self, index, error):
+        # 并行模式下步骤中抛出的异常不会传到调用方，把异常和调用栈作为事件发出，便于排查
+        self.emit("step_error", {"index": index, "step": f"步骤 {index + 1}", "message": f"{type(error).__name__}: {error}",
+                                 "traceback": "".join(traceback.format_exception(type(error), error, error.__traceback__))})
+
+    def run_steps(self):
+        """
+        执行所有尚未完成的步骤
+
+        并行模式下按依赖关系同时执行互不依赖的步骤，否则按顺序执行，每一步使用之前所有步骤的输出。
+        失败后再次调用时，已完成的步骤不会重新执行。等待步骤完成期间每秒发出一次waiting事件，
+        顺序模式下每个步骤也在工作线程中执行，调用线程只负责等待和发出事件。
+        顺序模式下开启提前结束时，某一步之后可能跳过剩下的中间步骤，prompts会相应缩短。
+        调用线程中抛出的异常（包括事件回调中抛出的）会先取消正在进行的调用再向上传递。
+
+        Returns:
+            list: 失败步骤的下标列表，全部成功时为空
+        """
+        try:
+            if self.dependencies:
+                _, failed = run_dag(len(self.prompts), self.dependencies, self._run_step,
+                                    max_workers=self.config.max_workers, completed=self.results,
+                                    on_step_done=self._on_step_done, on_abort=self.cancel, on_error=self._on_step_error,
+                                    on_wait=lambda: self.emit("waiting", {"done": len(self.results),
+                                                                          "total": len(self.prompts)}))
+            else:
+                failed = []
+                index = len(self.results)
+                while index < len(self.prompts):
+                    result = self._wait_for(self._run_step, index, {i: self.results[i] for i in range(index)})
+                    if not result:
+                        failed.append(index)
+                        break
+                    result, finished = self._take_early_stop_mark(index, result)
+                    self._on_step_done(index, result)
+                    finished = finished or self._locally_finished(index, result)
+                    if finished and self._wait_for(self._confirm_early_stop, index):
+                        self._skip_to_final(index)
+                    index += 1
+        except BaseException:
+            self.cancel()
+            raise
+        for index in failed:
+            self.emit("step_failed", {"index": index})
+        if self.run_id:
+            self._checkpoint("set_status", self.run_id, "failed" if failed else "complete")
+        return failed
+
+    def _wait_for(self, func, *args):
+        # 在工作线程中执行一次阻塞的调用，调用线程每秒发出一次waiting事件，与并行模式一致：
+        # 事件回调中抛出的异常（如界面的停止按钮中断脚本）会先取消正在进行的调用，不必等HTTP请求或退避结束
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(func, *args)
+            try:
+                while not wait([future], timeout=1.0).done:
+                    self.emit("waiting", {"done": len(self.results), "total": len(self.prompts)})
+            except BaseException:
+                # 退出with时要等工作线程结束，先通知它放弃
+                self.cancel()
+                raise
+            return future.result()
+
+    @property
+    def ordered_results(self):
+        # 从第一步开始连续完成的结果
+        ordered = []
+        for i in range(len(self.prompts)):
+            if i not in self.results:
+                break
+            ordered.append(self.results[i])
+        return ordered
+
+    @property
+    def is_complete(self):
+        return bool(self.prompts) and len(self.results) == len(self.prompts)
+
+    def run(self, user_prompt, document_text="", document_label="", run_id=None, load_document=None):
+        """
+        完整执行一次：优化指令、规划步骤并执行所有步骤（准备阶段见prepare）
+
+        指定了run_id且检查点中已有这次运行时，直接从最后完成的步骤继续（忽略user_prompt和文档参数）；
+        否则按新运行处理，并用run_id保存检查点。
+
+        Args:
+            user_prompt (str): 用户输入的指令
+            document_text (str): 上传文档的文本
+            document_label (str): 文档类型名称
+            run_id (str): 运行编号，用于继续之前中断的运行
+            load_document (callable): 代替document_text和document_label，返回(文档文本, 文档类型名称)，
+                                      在工作线程中与指令优化同时执行
+
+        Returns:
+            ChainResult: 运行结果，规划失败时prompts为空
+        """
+        started_at = time.time()
+        self.begin()
+        if run_id and self.config.checkpoints and self.resume(run_id):
+            optimized_prompt = self.optimized_prompt
+            failed = self.run_steps()
+        else:
+            if load_document is None:
+                def load_document():
+                    return document_text, document_label
+            prompts = self.prepare(user_prompt, load_document, run_id)
+            optimized_prompt = self.optimized_prompt
+            if prompts is None:
+                failed = None
+            else:
+                failed = self.run_steps()
+        usage = self.stats.to_dict()
+        usage["elapsed"] = time.time() - started_at
+        if failed is None:
+            return ChainResult(optimized_prompt, [], [], False, [], usage)
+        return ChainResult(optimized_prompt, list(self.prompts), self.ordered_results,
+                           self.is_complete, failed, usage, self.run_id)
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+
+# 运行检查点 - 把每次运行的规划和每个完成的步骤保存到本地数据库，
+# 刷新页面、重启服务或某一步失败后，可以从最后完成的步骤继续，不必重新调用优化、规划和之前的步骤
+# AIGENT_CHECKPOINT_DIR: 检查点数据库所在目录
+# AIGENT_CHECKPOINT_TTL: 检查点的保存时间（秒），超过后在下次写入时删除，0表示永久保存
+CHECKPOINT_DIR = os.environ.get("AIGENT_CHECKPOINT_DIR", ".aigent_checkpoints")
+CHECKPOINT_TTL = int(os.environ.get("AIGENT_CHECKPOINT_TTL", str(30 * 24 * 3600)))
+
+# 运行状态：planned已规划还没有执行，running执行中，failed有步骤失败，complete全部完成
+RUN_STATUSES = ("planned", "running", "failed", "complete")
+
+def new_run_id():
+    """
+    Returns:
+        str: 新的运行编号，知道编号就能继续这次运行并读取其中的文档和结果，所以使用完整的随机UUID
+    """
+    return uuid.uuid4().hex
+
+class CheckpointStore:
+    """
+    基于SQLite的运行检查点
+
+    runs表保存每次运行的指令、规划、依赖关系和文档（压缩后的全文和内容哈希），
+    steps表保存每个完成的步骤的结果。每次操作都使用独立的数据库连接，可以被多个线程和Streamlit会话同时使用。
+    """
+
+    def __init__(self, path, ttl=CHECKPOINT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "run_id TEXT PRIMARY KEY, status TEXT NOT NULL, user_prompt TEXT NOT NULL, "
+                "optimized_prompt TEXT NOT NULL, prompts TEXT NOT NULL, dependencies TEXT NOT NULL, "
+                "document_label TEXT NOT NULL, document_hash TEXT NOT NULL, document BLOB, "
+                "settings TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT NOT NULL DEFAULT '', "
+                "skipped_steps TEXT NOT NULL DEFAULT '[]')"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS steps ("
+                "run_id TEXT NOT NULL, step_index INTEGER NOT NULL, result TEXT NOT NULL, finished_at REAL NOT NULL, "
+                "reasoning TEXT NOT NULL DEFAULT '', PRIMARY KEY (run_id, step_index))"
+            )
+            # 旧版本创建的数据库没有reasoning列
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(steps)").fetchall()]
+            if "reasoning" not in columns:
+                conn.execute("ALTER TABLE steps ADD COLUMN reasoning TEXT NOT NULL DEFAULT ''")
+            # 旧版本创建的数据库没有owner列，之前保存的运行没有所有者，网页上不会再列出
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(runs)").fetchall()]
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE runs ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            # 旧版本创建的数据库没有skipped_steps列
+            if "skipped_steps" not in columns:
+                conn.execute("ALTER TABLE runs ADD COLUMN skipped_steps TEXT NOT NULL DEFAULT '[]'")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_runs_updated ON runs(updated_at)")
+
+    @contextmanager
+    def _connect(self):
+        # sqlite3自带的with只负责提交事务不会关闭连接，这里提交后顺便关闭
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def save_plan(self, run_id, user_prompt, optimized_prompt, prompts, dependencies, document_text="",
+                  document_label="", settings=None, owner=""):
+        """
+        保存一次运行的规划，同一个run_id再次保存时会清空之前的步骤结果
+
+        Args:
+            run_id (str): 运行编号
+            user_prompt (str): 用户输入的原始指令
+            optimized_prompt (str): 优化后的指令
+            prompts (list): 步骤prompt列表
+            dependencies (list): 每个步骤依赖的步骤下标，顺序模式下为空列表
+            document_text (str): 文档全文
+            document_label (str): 文档类型名称
+            settings (dict): 运行时的主要设置（模型、模式等），只用于显示
+            owner (str): 创建这次运行的会话编号，读取和列出运行时只返回同一所有者的运行
+        """
+        document_hash = hashlib.sha256(document_text.encode("utf-8")).hexdigest() if document_text else ""
+        document = zlib.compress(document_text.encode("utf-8")) if document_text else None
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM steps WHERE run_id = ?", (run_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO runs (run_id, status, user_prompt, optimized_prompt, prompts, dependencies, "
+                "document_label, document_hash, document, settings, created_at, updated_at, owner) "
+                "VALUES (?, 'planned', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, user_prompt, optimized_prompt, json.dumps(prompts, ensure_ascii=False),
+                 json.dumps(dependencies), document_label, document_hash, document,
+                 json.dumps(settings or {}, ensure_ascii=False), now, now, owner)
+            )
+            if self.ttl:
+                # 顺便清理过期的运行
+                expired = [row[0] for row in conn.execute("SELECT run_id FROM runs WHERE updated_at < ?",
+                                                          (now - self.ttl,)).fetchall()]
+                for old_run_id in expired:
+                    conn.execute("DELETE FROM steps WHERE run_id = ?", (old_run_id,))
+                    conn.execute("DELETE FROM runs WHERE run_id = ?", (old_run_id,))
+
+    def save_prompts(self, run_id, prompts, skipped_steps=None):
+        """
+        更新一次运行的步骤列表（提前结束时跳过了剩下的中间步骤），已保存的步骤结果不变
+
+        Args:
+            run_id (str): 运行编号
+            prompts (list): 新的步骤prompt列表
+            skipped_steps (list): 被跳过的中间步骤的prompt，恢复运行时用来还原完整的规划
+        """
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE runs SET prompts = ?, skipped_steps = ?, updated_at = ? WHERE run_id = ?",
+                         (json.dumps(prompts, ensure_ascii=False), json.dumps(skipped_steps or [], ensure_ascii=False),
+                          time.time(), run_id))
+
+    def save_step(self, run_id, index, result, reasoning=""):
+        """
+        保存一个完成的步骤，运行状态变为running
+
+        Args:
+            run_id (str): 运行编号
+            index (int): 步骤下标
+            result (str): 步骤的输出（交给后续步骤的正式回答）
+            reasoning (str): 步骤的推理过程，只用于显示
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO steps (run_id, step_index, result, finished_at, reasoning) "
+                         "VALUES (?, ?, ?, ?, ?)", (run_id, index, result, now, reasoning))
+            conn.execute("UPDATE runs SET status = 'running', updated_at = ? WHERE run_id = ?", (now, run_id))
+
+    def set_status(self, run_id, status):
+        """
+        Args:
+            run_id (str): 运行编号
+            status (str): RUN_STATUSES中的一个
+        """
+        if status not in RUN_STATUSES:
+            raise ValueError(f"未知的运行状态: {status}")
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE runs SET status = ?, updated_at = ? WHERE run_id = ?", (status, time.time(), run_id))
+
+    def load_run(self, run_id, owner=None):
+        """
+        读取一次运行的规划和已完成的步骤
+
+        Args:
+            run_id (str): 运行编号
+            owner (str): 只读取这个所有者的运行，为None时不检查所有者（命令行批处理）
+
+        Returns:
+            dict: 包含user_prompt、optimized_prompt、prompts、skipped_steps、dependencies、document_text、
+                  document_label、settings、status、results（步骤下标 -> 输出）和reasoning（步骤下标 -> 推理过程），
+                  不存在或属于其他所有者时返回None
+        """
+        condition, params = ("AND owner = ?", (run_id, owner)) if owner is not None else ("", (run_id,))
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT status, user_prompt, optimized_prompt, prompts, dependencies, document_label, document, "
+                f"settings, skipped_steps FROM runs WHERE run_id = ? {condition}", params
+            ).fetchone()
+            if row is None:
+                return None
+            steps = conn.execute("SELECT step_index, result, reasoning FROM steps WHERE run_id = ?", (run_id,)).fetchall()
+        status, user_prompt, optimized_prompt, prompts, dependencies, document_label, document, settings, skipped_steps = row
+        return {
+            "run_id": run_id,
+            "status": status,
+            "user_prompt": user_prompt,
+            "optimized_prompt": optimized_prompt,
+            "prompts": json.loads(prompts),
+            "skipped_steps": json.loads(skipped_steps),
+            "dependencies": json.loads(dependencies),
+            "document_text": zlib.decompress(document).decode("utf-8") if document else "",
+            "document_label": document_label,
+            "settings": json.loads(settings),
+            "results": {index: result for index, result, _ in steps},
+            "reasoning": {index: reasoning for index, _, reasoning in steps if reasoning}
+        }
+
+    def claim_run(self, run_id, owner):
+        """
+        把一次运行转给新的所有者（网页上输入运行编号继续运行时，编号本身就是凭据）
+
+        Args:
+            run_id (str): 运行编号
+            owner (str): 新的所有者
+
+        Returns:
+            bool: 是否找到了这次运行
+        """
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute("UPDATE runs SET owner = ?, updated_at = ? WHERE run_id = ?", (owner, time.time(), run_id))
+        return cursor.rowcount > 0
+
+    def list_runs(self, limit=20, unfinished_only=False, owner=None):
+        """
+        列出最近的运行
+
+        Args:
+            limit (int): 最多返回的条数
+            unfinished_only (bool): 是否只列出还没有全部完成的运行
+            owner (str): 只列出这个所有者的运行，为None时列出所有运行
+
+        Returns:
+            list: 每次运行的摘要（run_id、status、user_prompt、total、done、updated_at），最近更新的在前
+        """
+        conditions, params = [], []
+        if unfinished_only:
+            conditions.append("r.status != 'complete'")
+        if owner is not None:
+            conditions.append("r.owner = ?")
+            params.append(owner)
+        condition = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT r.run_id, r.status, r.user_prompt, r.prompts, r.updated_at, "
+                "(SELECT COUNT(*) FROM steps s WHERE s.run_id = r.run_id) "
+                f"FROM runs r {condition} ORDER BY r.updated_at DESC LIMIT ?", (*params, limit)
+            ).fetchall()
+        return [{
+            "run_id": run_id,
+            "status": status,
+            "user_prompt": user_prompt,
+            "total": len(json.loads(prompts)),
+            "done": done,
+            "updated_at": updated_at
+        } for run_id, status, user_prompt, prompts, updated_at, done in rows]
+
+    def delete_run(self, run_id):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM steps WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+
+# 进程内共享的检查点存储
+_store = None
+_store_lock = threading.Lock()
+
+def get_checkpoint_store():
+    """
+    获取进程内共享的检查点存储，第一次调用时创建数据库
+
+    Returns:
+        CheckpointStore: 检查点存储
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = CheckpointStore(os.path.join(CHECKPOINT_DIR, "runs.sqlite3"))
+    return _store
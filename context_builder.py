@@ -0,0 +1,155 @@
+import hashlib
+import re
+import threading
+
+# 摘要长度 - 较早步骤的输出被压缩成摘要时，每份摘要的目标令牌数
+SUMMARY_MAX_TOKENS = 300
+
+# 默认完整保留最近几个步骤的输出，更早的输出才会被替换为摘要
+DEFAULT_KEEP_RECENT = 2
+
+# 截断处追加的省略标记
+TRUNCATION_MARK = "……（后略）"
+
+# 中日韩文字的匹配规则，用于估算令牌数
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+def estimate_tokens(text):
+    """
+    粗略估算一段文本的令牌数
+
+    不依赖分词器：每个汉字（含全角标点）按1个令牌计，其他字符按4个字符1个令牌计。
+    对中文偏保守（实际通常更少），用来控制预算足够了。
+
+    Args:
+        text (str): 需要估算的文本
+
+    Returns:
+        int: 估算的令牌数
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    把文本截断到max_tokens个令牌以内，截断处加上省略标记（标记也计入预算）
+
+    Args:
+        text (str): 原始文本
+        max_tokens (int): 允许的最大令牌数
+
+    Returns:
+        str: 截断后的文本，原文没有超出时原样返回
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_tokens = max(0, max_tokens - estimate_tokens(TRUNCATION_MARK))
+    # 二分查找能放进预算的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low].rstrip() + TRUNCATION_MARK
+
+class SummaryCache:
+    """
+    步骤输出的摘要缓存，按输出内容的哈希保存
+
+    每个结果只会生成一次摘要，后面的步骤直接复用，多个线程同时请求同一份摘要时只有一个会真正生成。
+    """
+
+    def __init__(self):
+        self._summaries = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @staticmethod
+    def _key(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def get(self, text, summarize):
+        """
+        获取一段输出的摘要，没有缓存时调用summarize生成
+
+        Args:
+            text (str): 步骤的原始输出
+            summarize (callable): summarize(text)生成摘要，失败时返回None或空字符串
+
+        Returns:
+            str: 摘要文本；生成失败时退回到截断后的原文，截断的结果不会缓存
+        """
+        key = self._key(text)
+        with self._lock:
+            if key in self._summaries:
+                return self._summaries[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # 等锁期间可能已经被其他线程生成好了
+            if key in self._summaries:
+                return self._summaries[key]
+            summary = (summarize(text) if summarize else None) or ""
+            with self._lock:
+                self._key_locks.pop(key, None)
+                if not summary.strip():
+                    # 生成失败（如摘要请求超时）时不缓存，之后的步骤还会重新尝试生成摘要
+                    return truncate_to_tokens(text, SUMMARY_MAX_TOKENS)
+                # 摘要本身也要控制长度，避免摘要模型不听话写得太长
+                summary = truncate_to_tokens(summary.strip(), SUMMARY_MAX_TOKENS * 2)
+                self._summaries[key] = summary
+            return summary
+
+    def __len__(self):
+        return len(self._summaries)
+
+def build_context(outputs, budget, summary_cache, summarize=None, keep_recent=DEFAULT_KEEP_RECENT):
+    """
+    在令牌预算内组织之前步骤的输出
+
+    依次尝试：
+    1. 全部原文放得下就原样使用；
+    2. 从最早的输出开始替换为摘要，最近keep_recent个输出保留原文，直到放进预算；
+    3. 仍然超出时从最早的摘要开始丢弃；
+    4. 最后还超出（最近的输出本身就很长）时按比例截断保留的原文。
+
+    Args:
+        outputs (list): [(步骤编号, 输出文本), ...]，按步骤顺序排列
+        budget (int): 之前输出部分允许占用的令牌数
+        summary_cache (SummaryCache): 摘要缓存
+        summarize (callable): summarize(text)调用模型生成摘要，为None时使用截断原文作为摘要
+        keep_recent (int): 至少保留原文的最近输出个数
+
+    Returns:
+        tuple: (entries, saved_tokens)，entries是[(步骤编号, 文本, 是否为摘要), ...]，
+               saved_tokens是相比全部原文估算节省的令牌数
+    """
+    original_tokens = sum(estimate_tokens(text) for _, text in outputs)
+    entries = [[step, text, False] for step, text in outputs]
+
+    def total():
+        return sum(estimate_tokens(text) for _, text, _ in entries)
+
+    if original_tokens > budget:
+        # 较早的输出逐个替换为摘要，只摘要必要的个数
+        for entry in entries[:max(0, len(entries) - keep_recent)]:
+            if total() <= budget:
+                break
+            entry[1] = summary_cache.get(entry[1], summarize)
+            entry[2] = True
+
+        # 摘要之后仍然超出，从最早的摘要开始丢弃
+        while total() > budget and entries and entries[0][2]:
+            entries.pop(0)
+
+        # 最近的输出本身就超出预算时，把预算平均分给保留的原文
+        if total() > budget and entries:
+            per_entry = max(1, budget // len(entries))
+            for entry in entries:
+                entry[1] = truncate_to_tokens(entry[1], per_entry)
+
+    saved_tokens = max(0, original_tokens - total())
+    return [tuple(entry) for entry in entries], saved_tokens
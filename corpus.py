@@ -0,0 +1,212 @@
+import hashlib
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from doc_extract import extract_document, content_hash
+from doc_index import SOURCE_HEADER
+
+# 多文件导入 - 把一次上传的多个PDF、Word和纯文本文件并行提取，去掉重复的文件和重复的页面/段落，
+# 合并成一份带来源标记的文档交给runner，各个步骤检索时可以看到每个片段来自哪个文件
+
+# 同时提取的文件数
+# PDF的文字层提取很快，扫描件的OCR在doc_extract中另外使用进程池（所有文件共用OCR名额），这里的线程主要用来让多个文件的等待重叠
+INGEST_WORKERS = 4
+
+# 提取过程中汇报各文件页面进度的间隔（秒）
+PAGE_PROGRESS_INTERVAL = 0.5
+
+# 文件扩展名 -> 提取类型
+FILE_KINDS = {
+    ".pdf": "pdf",
+    ".docx": "docx",
+    ".txt": "txt",
+    ".md": "txt"
+}
+
+# 提取类型 -> 文档类型名称（用于提示文字）
+KIND_LABELS = {
+    "pdf": "PDF",
+    "docx": "Word",
+    "txt": "文本"
+}
+
+# 重复出现的页面或段落至少有这么多个字符才会被去除
+# 太短的内容（如"目录"、页码、小标题）在不同文件中重复出现是正常的，不算样板内容
+BOILERPLATE_MIN_CHARS = 40
+
+# 页面（换页符）和段落（空行）边界，分隔符本身保留在结果中
+_BLOCK_SPLIT_PATTERN = re.compile(r"(\f|\n[ \t]*\n)")
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def file_kind(name):
+    """
+    Args:
+        name (str): 文件名
+
+    Returns:
+        str: 提取类型（"pdf"、"docx"、"txt"），不支持的文件返回None
+    """
+    return FILE_KINDS.get(os.path.splitext(name)[1].lower())
+
+def _block_hash(block):
+    # 忽略空白差异，不同文件中排版略有不同的同一段内容也能识别出来
+    return hashlib.sha256(_WHITESPACE_PATTERN.sub("", block).encode("utf-8")).hexdigest()
+
+def _remove_repeated_blocks(text, seen):
+    # 去掉已经在前面（本文件或之前的文件）出现过的页面和段落，返回(去重后的文本, 去掉的块数, 去掉的字符数)
+    parts = _BLOCK_SPLIT_PATTERN.split(text)
+    kept = []
+    removed_blocks = 0
+    removed_chars = 0
+    # parts为[块, 分隔符, 块, 分隔符, ...]，去掉重复的块时连同它后面的分隔符一起去掉
+    for i in range(0, len(parts), 2):
+        block = parts[i]
+        separator = parts[i + 1] if i + 1 < len(parts) else ""
+        if len(block.strip()) >= BOILERPLATE_MIN_CHARS:
+            key = _block_hash(block)
+            if key in seen:
+                removed_blocks += 1
+                removed_chars += len(block)
+                continue
+            seen.add(key)
+        kept.append(block + separator)
+    return "".join(kept), removed_blocks, removed_chars
+
+class Corpus:
+    """
+    一次运行使用的文档集合：合并后的全文和每个来源文件的信息
+
+    sources中每一项包含：name文件名、kind提取类型、hash文件内容哈希、bytes文件大小、
+    chars去重后的字符数、removed_blocks/removed_chars去掉的重复页面和段落、
+    duplicate_of（与之前某个文件内容相同时为那个文件名，该文件不会被使用）、error提取失败的原因、notes提取提示
+    """
+
+    def __init__(self, sources, text, elapsed=0.0):
+        self.sources = sources
+        self.text = text
+        self.elapsed = elapsed
+
+    @property
+    def used_sources(self):
+        # 实际合并进文档的文件
+        return [s for s in self.sources if not s["duplicate_of"] and not s["error"] and s["chars"]]
+
+    @property
+    def label(self):
+        # 只有一个文件时使用它的类型名称，否则显示文件数
+        used = self.used_sources
+        if len(used) == 1:
+            return KIND_LABELS[used[0]["kind"]]
+        return f"{len(used)}个文件"
+
+    def summary(self):
+        """
+        Returns:
+            dict: 导入统计：文件数、使用的文件数、重复文件数、失败文件数、输入字节数、
+                  合并后字符数、去掉的重复页面/段落数和字符数、耗时（秒）
+        """
+        return {
+            "files": len(self.sources),
+            "used_files": len(self.used_sources),
+            "duplicate_files": sum(1 for s in self.sources if s["duplicate_of"]),
+            "failed_files": sum(1 for s in self.sources if s["error"]),
+            "input_bytes": sum(s["bytes"] for s in self.sources),
+            "chars": len(self.text),
+            "removed_blocks": sum(s["removed_blocks"] for s in self.sources),
+            "removed_chars": sum(s["removed_chars"] for s in self.sources),
+            "elapsed": self.elapsed
+        }
+
+def build_corpus(files, on_progress=None, max_workers=INGEST_WORKERS, default_kind=None, on_page_progress=None,
+                 **options):
+    """
+    并行提取多个文件并合并成一份文档
+
+    内容完全相同的文件只使用第一个；在前面的文件（或同一文件的前面）已经出现过的较长页面和段落
+    （如每份报告都有的免责声明页）会被去掉。只有一个文件时不加来源标记，与单独上传该文件的结果相同。
+
+    Args:
+        files (list): [(文件名, 文件内容bytes), ...]，合并时按这个顺序排列
+        on_progress (callable): on_progress(已完成文件数, 总文件数, 文件名)，在调用线程中每完成一个文件调用一次
+        max_workers (int): 同时提取的文件数
+        default_kind (str): 扩展名不在FILE_KINDS中的文件使用的提取类型，为None时这些文件记为不支持
+        on_page_progress (callable): on_page_progress(文件名, 已完成页数, 总页数)，在调用线程中每隔
+                                     PAGE_PROGRESS_INTERVAL秒为进度有变化、还没提取完的文件调用，用来显示扫描件的OCR进度
+        **options: 传给doc_extract.extract_document的PDF参数（dpi、page_timeout）
+
+    Returns:
+        Corpus: 合并后的文档集合
+    """
+    started_at = time.time()
+    sources = []
+    first_by_hash = {}
+    for name, data in files:
+        file_hash = content_hash(data)
+        kind = file_kind(name) or default_kind
+        sources.append({
+            "name": name,
+            "kind": kind,
+            "hash": file_hash,
+            "bytes": len(data),
+            "chars": 0,
+            "removed_blocks": 0,
+            "removed_chars": 0,
+            "duplicate_of": first_by_hash.get(file_hash),
+            "error": None if kind else "不支持的文件类型",
+            "notes": []
+        })
+        first_by_hash.setdefault(file_hash, name)
+
+    # 只提取需要的文件：重复的文件和不支持的文件直接跳过
+    pending = {i: data for i, (_, data) in enumerate(files) if not sources[i]["duplicate_of"] and not sources[i]["error"]}
+    texts = {}
+    done = len(files) - len(pending)
+    # 文件下标 -> (已完成页数, 总页数)，由提取线程更新，调用线程定期汇报
+    page_progress = {}
+    reported = {}
+
+    def extract(i, data):
+        def report(done_pages, total_pages):
+            page_progress[i] = (done_pages, total_pages)
+        kind = sources[i]["kind"]
+        return extract_document(data, kind, on_progress=report, **(options if kind == "pdf" else {}))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending) or 1))) as executor:
+        futures = {executor.submit(extract, i, data): i for i, data in pending.items()}
+        while futures:
+            finished, _ = wait(list(futures), timeout=PAGE_PROGRESS_INTERVAL if on_page_progress else None,
+                               return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = futures.pop(future)
+                try:
+                    texts[i], sources[i]["notes"] = future.result()
+                except Exception as e:
+                    # 单个文件损坏不影响其他文件
+                    sources[i]["error"] = str(e)
+                done += 1
+                if on_progress:
+                    on_progress(done, len(files), sources[i]["name"])
+            if on_page_progress:
+                for i in sorted(futures.values()):
+                    pages = page_progress.get(i)
+                    if pages is not None and pages != reported.get(i):
+                        reported[i] = pages
+                        on_page_progress(sources[i]["name"], *pages)
+
+    # 按上传顺序去重和合并，结果与提取完成的先后无关
+    seen_blocks = set()
+    sections = []
+    for i, source in enumerate(sources):
+        if i not in texts:
+            continue
+        text, source["removed_blocks"], source["removed_chars"] = _remove_repeated_blocks(texts[i], seen_blocks)
+        text = text.strip()
+        source["chars"] = len(text)
+        if text:
+            sections.append((source["name"], text))
+    if len(sections) == 1:
+        text = sections[0][1]
+    else:
+        text = "\n\n".join(f"{SOURCE_HEADER.format(name)}\n{body}" for name, body in sections)
+    return Corpus(sources, text, time.time() - started_at)
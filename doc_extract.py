@@ -0,0 +1,297 @@
+import hashlib
+import io
+import math
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import fitz  # PyMuPDF
+import docx2txt  # 导入docx2txt库用于处理Word文档
+
+# 提取结果缓存的容量 - 按文件内容哈希缓存提取出的文本，所有会话共享
+# 同一个文件被重复提交或被其他用户再次上传时直接使用缓存，不再重新解析和OCR
+EXTRACT_CACHE_MAX_ENTRIES = 32
+EXTRACT_CACHE_MAX_CHARS = 50_000_000
+
+# 少于这个字符数的PDF页面被认为是扫描件，需要OCR识别
+OCR_MIN_PAGE_CHARS = 50
+
+# OCR相关配置
+# OCR_DPI: 扫描页渲染成图片时的分辨率，越高识别越准但越慢
+# OCR_PAGE_TIMEOUT: 单页OCR的最长时间（秒），超时的页面会被跳过，不会拖住整份文档
+# OCR_LANG: tesseract的识别语言，'chi_sim'表示简体中文
+OCR_DPI = 150
+OCR_PAGE_TIMEOUT = 60
+OCR_LANG = "chi_sim"
+
+# 需要OCR的页数达到这个数量时才使用进程池并行识别
+# 有文字层的页面提取很快（每页几毫秒），直接在当前进程处理；只有OCR慢到值得启动进程
+PARALLEL_MIN_OCR_PAGES = 2
+
+# PDF页面之间的分隔符
+PAGE_BREAK = "\f"
+
+# 进程池大小，默认等于CPU核心数
+EXTRACT_WORKERS = os.cpu_count() or 1
+
+# OCR超时后结束卡住的工作进程时，每个进程最多等待它退出的秒数
+WORKER_EXIT_TIMEOUT = 5
+
+# 所有同时进行的提取共用的OCR名额：多个扫描件同时OCR时（如一次上传多个PDF），
+# 各自的进程池加上在当前进程中识别的页面，总共最多占用EXTRACT_WORKERS个CPU核心
+_ocr_slots = threading.Semaphore(EXTRACT_WORKERS)
+
+def _acquire_ocr_slots(wanted):
+    # 先等到至少一个名额，再不等待地尽量多拿，返回拿到的名额数
+    _ocr_slots.acquire()
+    granted = 1
+    while granted < wanted and _ocr_slots.acquire(blocking=False):
+        granted += 1
+    return granted
+
+def _release_ocr_slots(count):
+    for _ in range(count):
+        _ocr_slots.release()
+
+class ExtractCache:
+    """
+    按内容哈希保存文档提取结果的LRU缓存，同时限制条目数和总字符数
+    """
+
+    def __init__(self, max_entries=EXTRACT_CACHE_MAX_ENTRIES, max_chars=EXTRACT_CACHE_MAX_CHARS):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._items = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            # 最近使用的条目移到末尾，淘汰时从头部开始
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        text, _ = value
+        with self._lock:
+            if key in self._items:
+                self._chars -= len(self._items.pop(key)[0])
+            self._items[key] = value
+            self._chars += len(text)
+            while self._items and (len(self._items) > self.max_entries or self._chars > self.max_chars):
+                _, (old_text, _) = self._items.popitem(last=False)
+                self._chars -= len(old_text)
+
+    def __len__(self):
+        return len(self._items)
+
+# 进程内共享的提取结果缓存
+_extract_cache = ExtractCache()
+
+def content_hash(data):
+    """
+    Args:
+        data (bytes): 文件内容
+
+    Returns:
+        str: 文件内容的SHA-256哈希
+    """
+    return hashlib.sha256(data).hexdigest()
+
+def _ocr_page(pdf_document, page_num, dpi, page_timeout):
+    # 对文字过少的页面（扫描件）做OCR识别，返回(页码, 文本, 提示信息)，失败时文本为None
+    notes = []
+    try:
+        # 导入OCR所需库
+        import pytesseract
+        from PIL import Image
+
+        # 按指定分辨率将PDF页面渲染为图片
+        page = pdf_document.load_page(page_num)
+        pix = page.get_pixmap(dpi=dpi)
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+        # 使用pytesseract进行OCR识别，超时后tesseract进程会被结束并抛出RuntimeError
+        ocr_text = pytesseract.image_to_string(img, lang=OCR_LANG, timeout=page_timeout)
+        notes.append(("info", f"第{page_num+1}页使用OCR识别"))
+        return page_num, ocr_text + "\n\n", notes
+    except ImportError:
+        notes.append(("warning", "OCR功能需要安装pytesseract和Pillow库。请使用'pip install pytesseract pillow'安装。"))
+    except RuntimeError as ocr_error:
+        notes.append(("warning", f"第{page_num+1}页OCR超时或出错: {ocr_error}，使用常规文本提取"))
+    except Exception as ocr_error:
+        notes.append(("warning", f"OCR处理出错: {ocr_error}，使用常规文本提取"))
+    return page_num, None, notes
+
+# 工作进程中打开的PDF文档，每个进程只在启动时打开一次
+_worker_document = None
+
+def _init_worker(data):
+    global _worker_document
+    # 每个工作进程里的tesseract只用单线程，避免和其他进程抢CPU
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    _worker_document = fitz.open(stream=data, filetype="pdf")
+
+def _ocr_page_in_worker(page_num, dpi, page_timeout):
+    return _ocr_page(_worker_document, page_num, dpi, page_timeout)
+
+def _extract_pdf(data, dpi=OCR_DPI, page_timeout=OCR_PAGE_TIMEOUT, on_progress=None):
+    # 直接从内存中打开PDF，不再写临时文件
+    # 第一遍在当前进程中提取所有页面的文字层（每页只需几毫秒），同时找出需要OCR的扫描页
+    pdf_document = fitz.open(stream=data, filetype="pdf")
+    page_count = pdf_document.page_count
+    pages = {}
+    page_notes = {}
+    ocr_pages = []
+    try:
+        for page_num in range(page_count):
+            pages[page_num] = pdf_document.load_page(page_num).get_text()
+            # 如果页面文本为空或几乎为空，需要使用OCR
+            if len(pages[page_num].strip()) < OCR_MIN_PAGE_CHARS:
+                ocr_pages.append(page_num)
+        done = page_count - len(ocr_pages)
+        if on_progress and done:
+            on_progress(done, page_count)
+
+        if len(ocr_pages) < PARALLEL_MIN_OCR_PAGES or EXTRACT_WORKERS <= 1:
+            # 扫描页很少时直接在当前进程中识别，省去启动进程的开销，识别时同样占用一个OCR名额
+            if not ocr_pages:
+                return _assemble_pages(page_count, pages, page_notes, [])
+            _acquire_ocr_slots(1)
+            try:
+                for page_num in ocr_pages:
+                    _record_ocr_result(pages, page_notes, *_ocr_page(pdf_document, page_num, dpi, page_timeout))
+                    done += 1
+                    if on_progress:
+                        on_progress(done, page_count)
+            finally:
+                _release_ocr_slots(1)
+            return _assemble_pages(page_count, pages, page_notes, [])
+    finally:
+        pdf_document.close()
+
+    # 扫描页较多时分发到进程池，每页一个任务，完成后按页码顺序重新拼接
+    # 进程数受共用的OCR名额限制，其他文件正在OCR时只拿到剩下的名额（至少一个）
+    workers = _acquire_ocr_slots(min(EXTRACT_WORKERS, len(ocr_pages)))
+    try:
+        # 兜底超时：tesseract自身的超时失效时，整份文档最多等待这么久
+        overall_timeout = page_timeout * math.ceil(len(ocr_pages) / workers) + 30
+        # 使用spawn方式启动进程，避免在Streamlit的多线程环境中fork导致死锁
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_worker, initargs=(data,))
+        futures = {executor.submit(_ocr_page_in_worker, page_num, dpi, page_timeout): page_num for page_num in ocr_pages}
+        remaining = set(ocr_pages)
+        extra_notes = []
+        pool_broken = False
+        try:
+            for future in as_completed(futures, timeout=overall_timeout):
+                page_num = futures[future]
+                try:
+                    _record_ocr_result(pages, page_notes, *future.result())
+                except BrokenProcessPool:
+                    # 工作进程无法启动或意外退出（例如打包环境不支持多进程），剩余页面改为在当前进程处理
+                    pool_broken = True
+                    continue
+                except Exception as page_error:
+                    # 单个页面出错不影响其他页面，保留文字层的内容
+                    page_notes[page_num] = [("warning", f"第{page_num+1}页OCR出错: {page_error}，使用常规文本提取")]
+                remaining.discard(page_num)
+                if on_progress:
+                    on_progress(page_count - len(remaining), page_count)
+        except FuturesTimeoutError:
+            extra_notes.append(("warning", f"第{'、'.join(str(i + 1) for i in sorted(remaining))}页OCR超时，使用常规文本提取"))
+            # 卡住的页面还占着工作进程，先结束这些进程，之后归还的OCR名额才和实际运行的进程数一致
+            _terminate_workers(executor)
+        finally:
+            # 不等待卡住的页面，直接取消尚未开始的任务
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if pool_broken:
+            pdf_document = fitz.open(stream=data, filetype="pdf")
+            try:
+                for page_num in sorted(remaining):
+                    _record_ocr_result(pages, page_notes, *_ocr_page(pdf_document, page_num, dpi, page_timeout))
+                    remaining.discard(page_num)
+                    if on_progress:
+                        on_progress(page_count - len(remaining), page_count)
+            finally:
+                pdf_document.close()
+        return _assemble_pages(page_count, pages, page_notes, extra_notes)
+    finally:
+        _release_ocr_slots(workers)
+
+def _terminate_workers(executor):
+    # shutdown(wait=False)不会结束正在运行的任务，这里直接结束进程池中的所有工作进程并等待它们退出
+    processes = list((executor._processes or {}).values())
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(WORKER_EXIT_TIMEOUT)
+        if process.is_alive():
+            process.kill()
+            process.join(WORKER_EXIT_TIMEOUT)
+
+def _record_ocr_result(pages, page_notes, page_num, ocr_text, notes):
+    # OCR成功时用识别结果替换文字层的内容，失败时保留文字层
+    if ocr_text is not None:
+        pages[page_num] = ocr_text
+    page_notes[page_num] = notes
+
+def _assemble_pages(page_count, pages, page_notes, extra_notes):
+    # 按页码顺序拼接文本和提示信息，重复的提示（如每页都缺少OCR库）只保留一条
+    # 页面之间用换页符分隔，和pdftotext的输出一致，之后可以按页去除重复的页面
+    text = PAGE_BREAK.join(pages.get(i, "") for i in range(page_count))
+    notes = [note for i in range(page_count) for note in page_notes.get(i, [])] + extra_notes
+    return text, list(dict.fromkeys(notes))
+
+def _extract_docx(data, on_progress=None):
+    # docx文件本质上是zip包，docx2txt可以直接从内存中的文件对象读取
+    text = docx2txt.process(io.BytesIO(data))
+    if on_progress:
+        on_progress(1, 1)
+    return text, []
+
+def _extract_txt(data, on_progress=None):
+    # 纯文本文件：优先按UTF-8解码，失败时按GB18030（兼容GBK）解码，Windows下保存的中文文本多是这种编码
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = data.decode("gb18030", errors="replace")
+    if on_progress:
+        on_progress(1, 1)
+    return text, []
+
+_EXTRACTORS = {
+    "pdf": _extract_pdf,
+    "docx": _extract_docx,
+    "txt": _extract_txt
+}
+
+def extract_document(data, kind, on_progress=None, **options):
+    """
+    从上传文件的内容中提取文本，结果按内容哈希缓存
+
+    Args:
+        data (bytes): 文件内容
+        kind (str): 文件类型，"pdf"、"docx"或"txt"
+        on_progress (callable): on_progress(已完成页数, 总页数)，在调用线程中每完成一页调用一次
+        **options: 传给具体提取函数的参数，如PDF的dpi和page_timeout，不同参数的结果分别缓存
+
+    Returns:
+        tuple: (text, notes)，text是提取出的文本，
+               notes是[(级别, 提示信息), ...]，级别为"info"或"warning"，由界面负责显示
+
+    Raises:
+        Exception: 文件损坏等原因导致无法解析时抛出，失败的结果不会被缓存
+    """
+    key = f"{kind}:{content_hash(data)}:{sorted(options.items())}"
+    cached = _extract_cache.get(key)
+    if cached is not None:
+        return cached
+    result = _EXTRACTORS[kind](data, on_progress=on_progress, **options)
+    _extract_cache.put(key, result)
+    return result
@@ -0,0 +1,273 @@
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from context_builder import estimate_tokens
+
+# 每个文档片段的目标令牌数，以及相邻片段之间重叠的令牌数
+# 重叠可以避免一句话刚好被切在两个片段中间而丢失上下文
+DEFAULT_CHUNK_TOKENS = 400
+DEFAULT_CHUNK_OVERLAP = 50
+
+# 每个步骤最多放入多少个片段，以及这些片段总共可以占用的令牌数
+DEFAULT_TOP_K = 8
+DEFAULT_CONTEXT_TOKENS = 3000
+
+# BM25参数：k1控制词频饱和速度，b控制文档长度归一化的强度
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 进程内最多保留多少个文档的检索索引，同一份文档（按内容哈希）在多个会话和批量任务之间共享，
+# 长时间不用的索引会被淘汰，再次需要时重新构建
+INDEX_CACHE_SIZE = int(os.environ.get("AIGENT_INDEX_CACHE_SIZE", "8"))
+
+# 多个文件合并成的文档中，每个文件的内容前面单独一行写明来源
+SOURCE_HEADER = "【来源: {}】"
+_SOURCE_HEADER_PATTERN = re.compile(r"^【来源: (.+)】$", re.M)
+
+_LATIN_WORD_PATTERN = re.compile(r"[a-zA-Z0-9_]+")
+_CJK_RUN_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff]+")
+_SENTENCE_END_PATTERN = re.compile(r"(?<=[。！？!?；;.\n])")
+
+def tokenize(text):
+    """
+    把文本切分成检索用的词项
+
+    中文没有空格分词，这里用相邻两个汉字组成的二元组作为词项（单字的片段保留单字），
+    英文和数字按单词切分并转为小写，不需要任何分词库或向量模型。
+
+    Args:
+        text (str): 需要切分的文本
+
+    Returns:
+        list: 词项列表
+    """
+    terms = [w.lower() for w in _LATIN_WORD_PATTERN.findall(text)]
+    for run in _CJK_RUN_PATTERN.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+def _split_long_paragraph(paragraph, chunk_tokens):
+    # 超长段落先按句子切分，单个句子仍然超长时直接按字符数硬切
+    pieces = []
+    for sentence in _SENTENCE_END_PATTERN.split(paragraph):
+        if estimate_tokens(sentence) > chunk_tokens:
+            # 按估算规则，每个令牌至少对应一个字符，按chunk_tokens个字符切分一定不会超出
+            pieces.extend(sentence[i:i + chunk_tokens] for i in range(0, len(sentence), chunk_tokens))
+        elif sentence.strip():
+            pieces.append(sentence)
+    return pieces
+
+def chunk_text(text, chunk_tokens=DEFAULT_CHUNK_TOKENS, overlap_tokens=DEFAULT_CHUNK_OVERLAP):
+    """
+    把长文档切分成大小接近chunk_tokens的片段
+
+    尽量按段落边界切分，段落过长时再按句子切分；相邻片段之间保留overlap_tokens的重叠。
+
+    Args:
+        text (str): 文档全文
+        chunk_tokens (int): 每个片段的目标令牌数
+        overlap_tokens (int): 相邻片段的重叠令牌数
+
+    Returns:
+        list: 片段文本列表，按在文档中的顺序排列
+    """
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_tokens(paragraph) > chunk_tokens:
+            pieces.extend(_split_long_paragraph(paragraph, chunk_tokens))
+        else:
+            pieces.append(paragraph)
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece in pieces:
+        piece_tokens = estimate_tokens(piece)
+        if current and current_tokens + piece_tokens > chunk_tokens:
+            chunks.append("\n".join(current))
+            # 从当前片段末尾取出不超过overlap_tokens的内容作为下一个片段的开头
+            overlap = []
+            overlap_size = 0
+            for previous in reversed(current):
+                size = estimate_tokens(previous)
+                if overlap_size + size > overlap_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += size
+            current = overlap
+            current_tokens = overlap_size
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def split_sources(text):
+    """
+    按来源标记把合并后的文档拆回各个文件的内容
+
+    Args:
+        text (str): 文档全文
+
+    Returns:
+        list: [(来源名称, 内容), ...]，没有来源标记的部分来源名称为空字符串
+    """
+    sections = []
+    parts = _SOURCE_HEADER_PATTERN.split(text)
+    # split结果为[标记前的内容, 来源1, 内容1, 来源2, 内容2, ...]
+    if parts[0].strip():
+        sections.append(("", parts[0]))
+    for i in range(1, len(parts), 2):
+        sections.append((parts[i], parts[i + 1]))
+    return sections
+
+class DocumentIndex:
+    """
+    上传文档的BM25词法检索索引
+
+    上传时构建一次并在进程内共享（见get_document_index），每个步骤只取出与该步骤最相关的若干片段，
+    不需要重复发送整份文档，完全在本地运行，不依赖任何向量服务。
+    """
+
+    def __init__(self, chunks, text=None):
+        self.chunks = chunks
+        # 保留原文，文档不大时直接使用原文（片段之间有重叠，拼起来会有重复内容）
+        self.text = text if text is not None else "\n\n".join(chunks)
+        self.chunk_tokens = [estimate_tokens(chunk) for chunk in chunks]
+        self.total_tokens = estimate_tokens(self.text)
+        self._term_freqs = [Counter(tokenize(chunk)) for chunk in chunks]
+        self._lengths = [sum(tf.values()) for tf in self._term_freqs]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+        # 统计每个词项出现在多少个片段中，用于计算逆文档频率
+        doc_freqs = Counter()
+        for tf in self._term_freqs:
+            doc_freqs.update(tf.keys())
+        n = len(chunks)
+        self._idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()}
+
+    @classmethod
+    def from_text(cls, text, chunk_tokens=DEFAULT_CHUNK_TOKENS, overlap_tokens=DEFAULT_CHUNK_OVERLAP):
+        """
+        由文档全文构建索引
+
+        Args:
+            text (str): 文档全文
+            chunk_tokens (int): 每个片段的目标令牌数
+            overlap_tokens (int): 相邻片段的重叠令牌数
+
+        Returns:
+            DocumentIndex: 构建好的索引
+        """
+        # 多个文件合并成的文档按文件分别切分，片段不会跨越两个文件，并在每个片段开头标明来源
+        chunks = []
+        for source, body in split_sources(text):
+            header = SOURCE_HEADER.format(source) + "\n" if source else ""
+            chunks.extend(header + chunk for chunk in chunk_text(body, chunk_tokens, overlap_tokens))
+        return cls(chunks, text)
+
+    def search(self, query, top_k=DEFAULT_TOP_K):
+        """
+        按BM25得分检索与查询最相关的片段
+
+        Args:
+            query (str): 查询文本，一般是当前步骤的prompt
+            top_k (int): 最多返回的片段数
+
+        Returns:
+            list: [(片段下标, 得分), ...]，按得分从高到低排列，只包含得分大于0的片段
+        """
+        query_terms = set(tokenize(query))
+        scores = []
+        for i, tf in enumerate(self._term_freqs):
+            score = 0.0
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[i] / self._avg_length) if self._avg_length else BM25_K1
+            for term in query_terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self._idf[term] * freq * (BM25_K1 + 1) / (freq + norm)
+            if score > 0:
+                scores.append((i, score))
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:top_k]
+
+    def select(self, query, token_budget=DEFAULT_CONTEXT_TOKENS, top_k=DEFAULT_TOP_K):
+        """
+        选出放进当前步骤prompt的片段
+
+        文档本身放得下预算时直接返回全部片段；否则按相关度从高到低选取，
+        直到达到top_k或令牌预算，最后按在文档中的原始顺序返回，便于AI阅读。
+        没有任何相关片段时使用文档开头的片段。
+
+        Args:
+            query (str): 查询文本，一般是当前步骤的prompt
+            token_budget (int): 片段总共可以占用的令牌数
+            top_k (int): 最多选取的片段数
+
+        Returns:
+            list: 选中的片段下标，按文档顺序排列
+        """
+        if self.total_tokens <= token_budget:
+            return list(range(len(self.chunks)))
+        # 查询和文档没有任何共同词项时（例如"请总结以上内容"），退回到文档开头的片段
+        candidates = [i for i, _ in self.search(query, top_k)] or list(range(min(top_k, len(self.chunks))))
+        selected = []
+        used = 0
+        for i in candidates:
+            if used + self.chunk_tokens[i] > token_budget:
+                continue
+            selected.append(i)
+            used += self.chunk_tokens[i]
+        return sorted(selected)
+
+    def context_for(self, query, token_budget=DEFAULT_CONTEXT_TOKENS, top_k=DEFAULT_TOP_K):
+        """
+        生成放进prompt的文档内容：全文放得下时返回全文，否则返回带编号的相关片段
+
+        Args:
+            query (str): 查询文本，一般是当前步骤的prompt
+            token_budget (int): 片段总共可以占用的令牌数
+            top_k (int): 最多选取的片段数
+
+        Returns:
+            str: 文档内容文本
+        """
+        if self.total_tokens <= token_budget:
+            return self.text
+        selected = self.select(query, token_budget, top_k)
+        return "\n\n".join(f"[片段 {i + 1}/{len(self.chunks)}]\n{self.chunks[i]}" for i in selected)
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+def get_document_index(key, load_text):
+    """
+    获取进程内共享的检索索引，不存在时读取文档全文构建
+
+    Args:
+        key (str): 文档的内容哈希
+        load_text (callable): 返回文档全文的函数，只在需要构建索引时调用
+
+    Returns:
+        DocumentIndex: 文档的检索索引
+    """
+    with _index_cache_lock:
+        index = _index_cache.get(key)
+        if index is not None:
+            _index_cache.move_to_end(key)
+            return index
+    # 构建比较慢，不持有锁；两个会话同时构建同一份文档时后写入的覆盖前面的，结果相同
+    index = DocumentIndex.from_text(load_text())
+    with _index_cache_lock:
+        _index_cache[key] = index
+        _index_cache.move_to_end(key)
+        while len(_index_cache) > max(INDEX_CACHE_SIZE, 1):
+            _index_cache.popitem(last=False)
+    return index
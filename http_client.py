@@ -0,0 +1,197 @@
+import os
+import socket
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# 连接池配置 - 所有AI请求共用同一个HTTP会话，复用TCP/TLS连接
+# 可以通过环境变量调整，方便在多人同时使用的服务器上放大连接池
+# AIGENT_POOL_CONNECTIONS: 缓存多少个不同主机的连接池
+# AIGENT_POOL_MAXSIZE: 每个主机最多保持多少条连接（即单主机并发上限）
+# AIGENT_POOL_BLOCK: 连接用完时是否排队等待（1）而不是临时新建连接（0）
+HTTP_POOL_CONFIG = {
+    "pool_connections": int(os.environ.get("AIGENT_POOL_CONNECTIONS", "4")),
+    "pool_maxsize": int(os.environ.get("AIGENT_POOL_MAXSIZE", "32")),
+    "pool_block": os.environ.get("AIGENT_POOL_BLOCK", "1") == "1"
+}
+
+# 进程级别的共享会话，所有Streamlit会话和线程共用
+_session = None
+_session_lock = threading.Lock()
+
+# 当前线程中正在发送的请求对应的RequestHandle，由post设置，连接池取出连接时登记到上面
+_tracking = threading.local()
+
+class RequestHandle:
+    """
+    一次正在进行的请求的中止句柄
+
+    post在发送期间把从连接池取出的连接登记到句柄上，abort()可以在其他线程中关闭这条连接的套接字，
+    正在等待响应的发送线程会立即出错结束，不必等到网络超时。post返回后连接已经归还或交给了响应对象，不再登记。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+        self.aborted = False
+
+    def _attach(self, conn):
+        with self._lock:
+            if self.aborted:
+                # 中止之后才取到连接：不再发送
+                raise OSError("请求已取消")
+            self._conn = conn
+
+    def _detach(self):
+        with self._lock:
+            self._conn = None
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            conn = self._conn
+        sock = getattr(conn, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # 套接字已经关闭
+                pass
+
+class _TrackedPoolMixin:
+    # 取出连接时登记到当前线程的RequestHandle上
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        handle = getattr(_tracking, "handle", None)
+        if handle is not None:
+            try:
+                handle._attach(conn)
+            except OSError:
+                # 连接池在出错时会补回这个空位，这条连接直接关闭
+                conn.close()
+                raise
+        return conn
+
+class _TrackedHTTPConnectionPool(_TrackedPoolMixin, HTTPConnectionPool):
+    pass
+
+class _TrackedHTTPSConnectionPool(_TrackedPoolMixin, HTTPSConnectionPool):
+    pass
+
+class _TrackedAdapter(HTTPAdapter):
+    # 连接池使用可以登记连接的子类，其余行为与HTTPAdapter相同
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TrackedHTTPConnectionPool,
+                                                   "https": _TrackedHTTPSConnectionPool}
+
+def _build_session(pool_connections, pool_maxsize, pool_block):
+    session = requests.Session()
+    # 重试由调用方自己的重试循环负责，这里不让urllib3再重试一遍
+    adapter = _TrackedAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+        max_retries=0
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # 显式声明保持长连接，同一主机的后续请求直接复用已建立的连接
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+def get_http_session():
+    """
+    获取进程内共享的HTTP会话
+
+    第一次调用时按HTTP_POOL_CONFIG创建，之后所有调用返回同一个对象。
+    requests.Session的连接池是线程安全的，可以被多个Streamlit会话同时使用。
+
+    Returns:
+        requests.Session: 带连接池和长连接的共享会话
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            # 双重检查，避免多个线程同时创建会话
+            if _session is None:
+                _session = _build_session(**HTTP_POOL_CONFIG)
+    return _session
+
+def post(url, handle=None, **kwargs):
+    """
+    通过共享会话发送POST请求
+
+    Args:
+        url (str): 请求地址
+        handle (RequestHandle): 中止句柄，在其他线程中调用handle.abort()会关闭这次请求使用的连接，
+                                post随即以requests.exceptions.ConnectionError结束
+        **kwargs: 交给requests.Session.post的其他参数
+
+    Returns:
+        requests.Response: 响应对象
+    """
+    _tracking.handle = handle
+    try:
+        return get_http_session().post(url, **kwargs)
+    finally:
+        _tracking.handle = None
+        if handle is not None:
+            handle._detach()
+
+def configure_http_pool(pool_connections=None, pool_maxsize=None, pool_block=None):
+    """
+    调整连接池配置并重建共享会话
+
+    旧会话中正在进行的请求不受影响，新请求会使用新的连接池。
+
+    Args:
+        pool_connections (int): 缓存的主机连接池数量
+        pool_maxsize (int): 每个主机的最大连接数
+        pool_block (bool): 连接用完时是否排队等待
+    """
+    global _session
+    with _session_lock:
+        if pool_connections is not None:
+            HTTP_POOL_CONFIG["pool_connections"] = pool_connections
+        if pool_maxsize is not None:
+            HTTP_POOL_CONFIG["pool_maxsize"] = pool_maxsize
+        if pool_block is not None:
+            HTTP_POOL_CONFIG["pool_block"] = pool_block
+        _session = _build_session(**HTTP_POOL_CONFIG)
+
+class RateLimiter:
+    """
+    全局请求速率限制，多个线程共用一个对象时，所有请求合起来不超过设定的速率
+
+    按固定间隔发放请求机会，不允许突发：每分钟rpm个请求即每隔60/rpm秒放行一个。
+    """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute and requests_per_minute > 0 else 0.0
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        预约下一个请求机会，不等待
+
+        Returns:
+            float: 还需要等待多少秒才能发送
+        """
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            scheduled = max(now, self._next_time)
+            self._next_time = scheduled + self.interval
+        return scheduled - now
+
+    def acquire(self):
+        """等待到可以发送下一个请求为止"""
+        # 在锁外等待，其他线程可以同时预约后面的时间点
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
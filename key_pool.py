@@ -0,0 +1,240 @@
+import email.utils
+import os
+import threading
+import time
+
+# 每个API密钥的默认限额 - 每分钟最多的请求数(RPM)和令牌数(TPM)
+# 按所用账号的实际等级调整，超出限额的请求会在本地排队，而不是发出去再被服务器以429拒绝
+# AIGENT_KEY_RPM / AIGENT_KEY_TPM: 通过环境变量修改默认值
+DEFAULT_KEY_RPM = int(os.environ.get("AIGENT_KEY_RPM", "1000"))
+DEFAULT_KEY_TPM = int(os.environ.get("AIGENT_KEY_TPM", "50000"))
+
+# 密钥出错后的冷却时间（秒）：连续失败n次后冷却 KEY_COOLDOWN_BASE * 2^(n-1)，最长KEY_COOLDOWN_MAX
+# 冷却中的密钥不会被选中，除非所有密钥都在冷却
+KEY_COOLDOWN_BASE = 1.0
+KEY_COOLDOWN_MAX = 60.0
+
+# 延迟的指数移动平均系数，越大越看重最近的调用
+LATENCY_EWMA_ALPHA = 0.3
+
+# 所有密钥都不可用时，每次最多等待这么久再重新检查
+_MAX_WAIT_SLICE = 1.0
+
+class TokenBucket:
+    """
+    令牌桶限流器：容量为每分钟的限额，按限额匀速补充
+
+    允许透支：实际用量在调用结束后才知道，多用的部分直接记账，桶变为负数时后续请求要等补回来。
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(float(self.per_minute), self.level + (now - self._updated) * self.per_minute / 60.0)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """
+        Returns:
+            float: 需要等待多少秒桶里才有amount个令牌，0表示现在就够
+        """
+        if not self.per_minute:
+            return 0.0
+        self._refill()
+        # 单次需求超过桶容量时按装满计算，否则永远等不到
+        amount = min(amount, self.per_minute)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.per_minute
+
+    def charge(self, amount):
+        if not self.per_minute:
+            return
+        self._refill()
+        self.level -= amount
+
+    def set_rate(self, per_minute):
+        self._refill()
+        self.per_minute = per_minute
+        self.level = min(self.level, float(per_minute))
+
+class KeyState:
+    """
+    单个API密钥的限额、健康状况和使用统计，同一个密钥在进程内只有一个KeyState，所有会话共享
+    """
+
+    def __init__(self, api_key, rpm=DEFAULT_KEY_RPM, tpm=DEFAULT_KEY_TPM):
+        self.api_key = api_key
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.in_flight = 0
+        self.total_requests = 0
+        self.total_tokens = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.latency = None
+        self.last_status = None
+
+    @property
+    def masked(self):
+        # 界面上只显示密钥的最后4位
+        return f"···{self.api_key[-4:]}" if len(self.api_key) > 4 else "···"
+
+    def wait_time(self, estimated_tokens, now):
+        # 冷却时间和两个令牌桶中最晚的那个决定这个密钥还要多久才能用
+        return max(self.cooldown_until - now, self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens), 0.0)
+
+# 进程内所有密钥的状态，按密钥字符串保存
+_states = {}
+_lock = threading.Condition()
+
+def parse_retry_after(value):
+    """
+    解析Retry-After响应头
+
+    Args:
+        value (str): 秒数或HTTP日期，可以为None
+
+    Returns:
+        float: 需要等待的秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class KeyPool:
+    """
+    API密钥池：每次调用选择当前负载最小的健康密钥
+
+    选择规则：跳过冷却中和超出RPM/TPM限额的密钥，在剩下的密钥中选进行中请求最少的，
+    相同时选平均延迟最低的。所有密钥都不可用时等待最早可用的那个。
+    """
+
+    def __init__(self, api_keys, rpm=DEFAULT_KEY_RPM, tpm=DEFAULT_KEY_TPM):
+        if not api_keys:
+            raise ValueError("至少需要一个API密钥")
+        with _lock:
+            self.keys = []
+            for api_key in api_keys:
+                state = _states.get(api_key)
+                if state is None:
+                    state = _states[api_key] = KeyState(api_key, rpm, tpm)
+                else:
+                    if state.requests.per_minute != rpm:
+                        state.requests.set_rate(rpm)
+                    if state.tokens.per_minute != tpm:
+                        state.tokens.set_rate(tpm)
+                self.keys.append(state)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def acquire(self, estimated_tokens=0, timeout=None):
+        """
+        选出一个密钥并占用它的限额，没有可用的密钥时阻塞等待
+
+        Args:
+            estimated_tokens (int): 本次请求预计消耗的令牌数，用于TPM限额
+            timeout (float): 最多等待的秒数，为None时一直等待
+
+        Returns:
+            int: 选中的密钥在池中的下标，调用结束后必须调用release；等待超时时返回None
+        """
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        with _lock:
+            while True:
+                now = time.monotonic()
+                waits = [state.wait_time(estimated_tokens, now) for state in self.keys]
+                available = [i for i, wait in enumerate(waits) if wait <= 0]
+                if available:
+                    index = min(available, key=lambda i: (self.keys[i].in_flight,
+                                                          self.keys[i].latency if self.keys[i].latency is not None else 0.0))
+                    state = self.keys[index]
+                    state.requests.charge(1)
+                    state.tokens.charge(estimated_tokens)
+                    state.in_flight += 1
+                    state.total_requests += 1
+                    return index
+                if give_up_at is not None and now >= give_up_at:
+                    return None
+                # 其他线程释放密钥或冷却结束时会被唤醒重新检查
+                wait = min(min(waits), _MAX_WAIT_SLICE)
+                _lock.wait(min(wait, give_up_at - now) if give_up_at is not None else wait)
+
+    def api_key(self, index):
+        return self.keys[index].api_key
+
+    def release(self, index, status_code=None, latency=None, retry_after=None, estimated_tokens=0, used_tokens=None,
+                aborted=False):
+        """
+        归还密钥并记录本次调用的结果
+
+        Args:
+            index (int): acquire返回的下标
+            status_code (int): HTTP状态码，网络错误时为None
+            latency (float): 本次调用的耗时（秒）
+            retry_after (float): 429响应中Retry-After要求等待的秒数
+            estimated_tokens (int): acquire时预估的令牌数
+            used_tokens (int): 实际消耗的令牌数，知道时用来修正TPM记账
+            aborted (bool): 调用被取消或超过总时限而中止，不计入密钥的健康状况和延迟统计
+        """
+        with _lock:
+            state = self.keys[index]
+            state.in_flight -= 1
+            if aborted:
+                _lock.notify_all()
+                return
+            state.last_status = status_code
+            if used_tokens is not None:
+                state.tokens.charge(used_tokens - estimated_tokens)
+                state.total_tokens += used_tokens
+            if latency is not None and status_code == 200:
+                state.latency = latency if state.latency is None else (
+                    LATENCY_EWMA_ALPHA * latency + (1 - LATENCY_EWMA_ALPHA) * state.latency)
+            if status_code == 200:
+                state.consecutive_failures = 0
+            elif status_code is None or status_code == 429 or status_code >= 500:
+                # 限流、服务器错误和网络错误让密钥进入冷却，其他错误（如401）是请求本身的问题
+                state.failures += 1
+                state.consecutive_failures += 1
+                cooldown = min(KEY_COOLDOWN_MAX, KEY_COOLDOWN_BASE * 2 ** (state.consecutive_failures - 1))
+                if status_code == 429:
+                    state.rate_limited += 1
+                    if retry_after is not None:
+                        cooldown = retry_after
+                state.cooldown_until = max(state.cooldown_until, time.monotonic() + cooldown)
+            else:
+                state.failures += 1
+            _lock.notify_all()
+
+    def snapshot(self):
+        """
+        Returns:
+            list: 每个密钥的使用情况，供界面显示
+        """
+        now = time.monotonic()
+        with _lock:
+            return [{
+                "label": f"API {i + 1} {state.masked}",
+                "requests": state.total_requests,
+                "tokens": state.total_tokens,
+                "failures": state.failures,
+                "rate_limited": state.rate_limited,
+                "in_flight": state.in_flight,
+                "latency": state.latency,
+                "cooldown": max(0.0, state.cooldown_until - now),
+                "last_status": state.last_status
+            } for i, state in enumerate(self.keys)]
@@ -0,0 +1,179 @@
+import math
+import os
+import threading
+
+# 尾延迟控制 - 在运行中按模型统计每次请求从发出到收到第一个令牌（非流式为完整响应）的耗时直方图，
+# 用来代替固定的超时时间，并在请求明显比平时慢时发出一个对冲请求
+# 同一模型的不同调用类型（如很短的指令优化和很长的最终总结）耗时差别很大，按调用类型分开统计
+# AIGENT_HEDGE_BUDGET: 对冲请求最多占全部调用的比例
+# AIGENT_HEDGE_PERCENTILE: 请求超过该模型这个分位的耗时还没有响应时发出对冲请求
+HEDGE_BUDGET = float(os.environ.get("AIGENT_HEDGE_BUDGET", "0.05"))
+HEDGE_PERCENTILE = float(os.environ.get("AIGENT_HEDGE_PERCENTILE", "0.95"))
+
+# 对冲请求至少在发出请求这么多秒后才会发出，避免对本来就很快的请求重复发送
+HEDGE_MIN_DELAY = 1.0
+
+# 对冲时机最晚不超过中位数的这么多倍：卡住的请求多于(1 - HEDGE_PERCENTILE)时，分位数本身就落在卡住的耗时上
+HEDGE_MEDIAN_FACTOR = 4.0
+
+# 预算允许连续发出的对冲请求数，空闲一段时间后突发的几个慢请求也能得到对冲
+HEDGE_BURST = 2.0
+
+# 自适应超时：单次请求的超时为该模型耗时的ADAPTIVE_TIMEOUT_PERCENTILE分位乘以ADAPTIVE_TIMEOUT_FACTOR，
+# 不低于ADAPTIVE_TIMEOUT_FLOOR秒，每次重试翻倍，始终不超过重试策略中配置的timeout
+ADAPTIVE_TIMEOUT_PERCENTILE = 0.99
+ADAPTIVE_TIMEOUT_FACTOR = 3.0
+ADAPTIVE_TIMEOUT_FLOOR = 20.0
+
+# 一个模型至少有这么多次成功的请求后，才使用它的直方图计算超时和对冲时机
+MIN_SAMPLES = 20
+
+# 直方图的分桶：从0.05秒开始每个桶比前一个大25%，最后一个桶到约1000秒
+_BUCKET_START = 0.05
+_BUCKET_RATIO = 1.25
+_BUCKET_COUNT = 46
+
+# 直方图中的样本数超过这个值时所有计数减半，让统计跟上服务端状况的变化
+_DECAY_SAMPLES = 500
+
+class LatencyHistogram:
+    """
+    按对数分桶的耗时直方图，旧的样本会逐渐衰减
+    """
+
+    def __init__(self):
+        self.counts = [0.0] * _BUCKET_COUNT
+        self.total = 0.0
+        self.samples = 0
+
+    def add(self, seconds):
+        if seconds <= _BUCKET_START:
+            index = 0
+        else:
+            index = min(_BUCKET_COUNT - 1, int(math.ceil(math.log(seconds / _BUCKET_START, _BUCKET_RATIO))))
+        self.counts[index] += 1
+        self.total += 1
+        self.samples += 1
+        if self.total > _DECAY_SAMPLES:
+            self.counts = [count / 2 for count in self.counts]
+            self.total /= 2
+
+    def percentile(self, q):
+        """
+        Args:
+            q (float): 0到1之间的分位
+
+        Returns:
+            float: 该分位所在桶的上界（秒），没有样本时为None
+        """
+        if not self.total:
+            return None
+        target = q * self.total
+        seen = 0.0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return _BUCKET_START * _BUCKET_RATIO ** index
+        return _BUCKET_START * _BUCKET_RATIO ** (_BUCKET_COUNT - 1)
+
+# 所有模型的直方图{(模型, 是否流式, 调用类型): LatencyHistogram}和对冲预算，由_lock保护
+_histograms = {}
+_lock = threading.Lock()
+_hedge_credit = HEDGE_BURST
+_hedge_totals = {"calls": 0, "hedges": 0}
+
+def observe(model, stream, seconds, kind=""):
+    """
+    记录一次成功请求的响应耗时
+
+    Args:
+        model (str): 模型名称
+        stream (bool): 是否为流式请求，流式和非流式分开统计
+        seconds (float): 从发出请求到收到第一个令牌（非流式为完整响应）的秒数
+        kind (str): 调用类型（如"step"、"final"），不同类型分开统计
+    """
+    if seconds is None:
+        return
+    with _lock:
+        histogram = _histograms.get((model, stream, kind))
+        if histogram is None:
+            histogram = _histograms[(model, stream, kind)] = LatencyHistogram()
+        histogram.add(seconds)
+
+def percentile(model, stream, q, kind=""):
+    """
+    Returns:
+        float: 该模型这类调用响应耗时的q分位（秒），样本不足MIN_SAMPLES时为None
+    """
+    with _lock:
+        histogram = _histograms.get((model, stream, kind))
+        if histogram is None or histogram.samples < MIN_SAMPLES:
+            return None
+        return histogram.percentile(q)
+
+def adaptive_timeout(model, stream, timeout, attempt=0, kind=""):
+    """
+    根据观测到的耗时计算单次请求的超时时间
+
+    Args:
+        model (str): 模型名称
+        stream (bool): 是否为流式请求
+        timeout (float): 重试策略中配置的超时时间，作为上限，样本不足时直接使用
+        attempt (int): 第几次尝试（从0开始），每次重试超时时间翻倍
+        kind (str): 调用类型，只按同类调用的耗时计算；最终总结这类每条链只有一次的调用很难攒够样本，一般使用固定超时
+
+    Returns:
+        float: 本次请求使用的超时时间（秒）
+    """
+    p = percentile(model, stream, ADAPTIVE_TIMEOUT_PERCENTILE, kind)
+    if p is None:
+        return timeout
+    return min(timeout, max(ADAPTIVE_TIMEOUT_FLOOR, p * ADAPTIVE_TIMEOUT_FACTOR) * 2 ** attempt)
+
+def hedge_delay(model, stream, kind=""):
+    """
+    Returns:
+        float: 这类调用的请求发出多少秒后还没有响应就发出对冲请求，样本不足时为None（不对冲）
+    """
+    p = percentile(model, stream, HEDGE_PERCENTILE, kind)
+    if p is None:
+        return None
+    return max(HEDGE_MIN_DELAY, min(p, percentile(model, stream, 0.5, kind) * HEDGE_MEDIAN_FACTOR))
+
+def note_call():
+    """每次调用开始时调用一次，按HEDGE_BUDGET的比例积累对冲预算"""
+    global _hedge_credit
+    with _lock:
+        _hedge_totals["calls"] += 1
+        _hedge_credit = min(HEDGE_BURST, _hedge_credit + HEDGE_BUDGET)
+
+def reserve_hedge():
+    """
+    Returns:
+        bool: 预算足够时占用一次对冲机会并返回True
+    """
+    global _hedge_credit
+    with _lock:
+        if _hedge_credit < 1:
+            return False
+        _hedge_credit -= 1
+        _hedge_totals["hedges"] += 1
+        return True
+
+def snapshot():
+    """
+    Returns:
+        dict: {"models": 每个(模型, 是否流式, 调用类型)的样本数和p50/p95/p99耗时, "calls": 调用数, "hedges": 对冲请求数}，
+              供界面显示
+    """
+    with _lock:
+        models = [{
+            "model": model,
+            "stream": stream,
+            "kind": kind,
+            "samples": histogram.samples,
+            "p50": histogram.percentile(0.5),
+            "p95": histogram.percentile(0.95),
+            "p99": histogram.percentile(0.99)
+        } for (model, stream, kind), histogram in sorted(_histograms.items())]
+        return {"models": models, **_hedge_totals}
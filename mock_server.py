@@ -0,0 +1,375 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from context_builder import estimate_tokens
+
+# 本地模拟的OpenAI兼容接口 - 用于基准测试和离线调试，不消耗真实的API额度
+# 支持可配置的延迟分布、流式输出速度、429/5xx错误注入和回答长度，
+# 并统计收到的请求数、字节数和每个请求的提示令牌数；还会模拟服务端的前缀缓存，在usage中返回命中的令牌数。
+#
+# 单独运行：python mock_server.py --port 8765 --latency uniform:0.2,1 --error-429 0.05
+# 然后把ai_utils.API_URL指向 http://127.0.0.1:8765/v1/chat/completions
+
+# 识别规划请求：规划步骤的系统提示里要求"拆分"步骤，并行模式下还会要求标出"依赖"
+_PLANNER_MARK = "拆分"
+_DEPENDENCY_MARK = "[依赖"
+# 融合规划（优化和规划在同一次调用中完成）要求回答分为优化后的指令和步骤两部分
+_FUSED_OPTIMIZED_MARK = "【优化后的指令】"
+_FUSED_STEPS_MARK = "【步骤】"
+# JSON格式的规划（并行模式下带depends_on字段），以及只补写个别步骤的修复请求
+_JSON_PLAN_MARK = '{"steps"'
+_JSON_DEPENDENCY_MARK = '"depends_on"'
+_REPAIR_MARK = "（待补写）"
+# 提前结束：步骤请求中要求在任务完成时写上的标记，以及确认任务是否完成的检查请求
+_EARLY_STOP_MARK = "【可以总结】"
+_EARLY_STOP_CHECK_MARK = "是否已经可以结束"
+
+# 模拟回答使用的填充文本
+_FILLER = "这是模拟服务器生成的回答内容，用于测量编排开销。"
+
+def parse_distribution(spec):
+    """
+    解析延迟分布的描述
+
+    Args:
+        spec (str): "fixed:0.2"、"uniform:0.1,0.5"、"exp:0.3"（均值）或"lognormal:mu,sigma"，单位为秒
+
+    Returns:
+        callable: 每次调用返回一个采样值（秒）
+
+    Raises:
+        ValueError: 格式不正确时抛出
+    """
+    kind, _, args = spec.partition(":")
+    try:
+        values = [float(v) for v in args.split(",")] if args else []
+        if kind == "fixed" and len(values) == 1:
+            return lambda: values[0]
+        if kind == "uniform" and len(values) == 2:
+            return lambda: random.uniform(values[0], values[1])
+        if kind == "exp" and len(values) == 1:
+            return lambda: random.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+        if kind == "lognormal" and len(values) == 2:
+            return lambda: random.lognormvariate(values[0], values[1])
+    except ValueError:
+        pass
+    raise ValueError(f"无法解析延迟分布: {spec}，支持fixed:秒、uniform:最小,最大、exp:均值、lognormal:mu,sigma")
+
+class MockStats:
+    """
+    模拟服务器的请求统计，可以被多个处理线程同时更新
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.statuses = {}
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.service_time = 0.0
+            self.prompt_tokens = []
+
+    def record(self, status, received, sent, service_time, prompt_tokens):
+        with self._lock:
+            self.requests += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes_received += received
+            self.bytes_sent += sent
+            self.service_time += service_time
+            if status == 200:
+                self.prompt_tokens.append(prompt_tokens)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "statuses": dict(self.statuses),
+                "bytes_received": self.bytes_received,
+                "bytes_sent": self.bytes_sent,
+                "service_time": self.service_time,
+                "prompt_tokens": list(self.prompt_tokens)
+            }
+
+class PrefixCache:
+    """
+    模拟服务端的前缀缓存（KV缓存）：以消息为粒度记录见过的消息前缀，
+    新请求的开头若干条消息与之前某个请求完全相同时，这部分消息的令牌算作命中缓存
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prefixes = set()
+
+    def lookup_and_store(self, messages):
+        """
+        Returns:
+            int: 命中缓存的输入令牌数
+        """
+        digest = hashlib.sha256()
+        keys = []
+        for message in messages:
+            digest.update(json.dumps(message, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            keys.append(digest.hexdigest())
+        with self._lock:
+            hit = 0
+            for i, key in enumerate(keys):
+                if key not in self._prefixes:
+                    break
+                hit = i + 1
+            self._prefixes.update(keys)
+        return sum(estimate_tokens(message.get("content") or "") for message in messages[:hit])
+
+    def clear(self):
+        with self._lock:
+            self._prefixes.clear()
+
+class MockConfig:
+    """
+    模拟服务器的行为配置，运行中可以直接修改属性，下一个请求立即生效
+    """
+
+    def __init__(self, latency="fixed:0.05", stream_tps=200.0, error_429=0.0, error_5xx=0.0, retry_after=1,
+                 completion_chars=400, plan_steps=3, reasoning_chars=0, stall=0.0, stall_seconds=10.0, done_rate=0.0,
+                 malformed_steps=0):
+        self.latency = parse_distribution(latency) if isinstance(latency, str) else latency
+        self.stream_tps = stream_tps
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.retry_after = retry_after
+        self.completion_chars = completion_chars
+        self.plan_steps = plan_steps
+        # 模拟推理模型：每个步骤的回答前附带这么多字的<think>推理过程
+        self.reasoning_chars = reasoning_chars
+        # 模拟上游偶尔卡住：按stall的概率在首字前额外等待stall_seconds秒
+        self.stall = stall
+        self.stall_seconds = stall_seconds
+        # 模拟提前完成：要求判断任务是否完成的步骤请求按done_rate的概率在回答最后写上完成标记
+        self.done_rate = done_rate
+        # 模拟有缺陷的规划：从第2步开始这么多个步骤缺失（文本格式中缺少编号，JSON格式中内容为空）
+        self.malformed_steps = malformed_steps
+
+def _step_prompt(i):
+    return f"第{i}步：请围绕任务的第{i}个方面进行详细分析，并给出具体可行的结论和建议。"
+
+def _plan_text(steps, with_dependencies, fused=False, json_format=False, malformed=0):
+    # 生成符合规划格式的回答：第一行是步骤数，之后每行一个步骤（json_format时为JSON对象）；融合规划时前面先给出优化后的指令
+    # 一半步骤互相独立，其余步骤依赖前一步，让依赖图有一定的宽度；第2步开始的malformed个步骤缺失
+    damaged = set(range(2, 2 + malformed))
+    lines = ["<think>模拟规划</think>"]
+    if fused:
+        lines = ["<think>模拟规划</think>" + _FUSED_OPTIMIZED_MARK, _answer_text(200), _FUSED_STEPS_MARK]
+    if json_format:
+        items = []
+        for i in range(1, steps + 1):
+            item = {"prompt": "" if i in damaged else _step_prompt(i)}
+            if with_dependencies:
+                item["depends_on"] = [] if i % 2 == 1 else [i - 1]
+            items.append(item)
+        lines.append(json.dumps({"steps": items}, ensure_ascii=False))
+        return "\n".join(lines)
+    lines[-1] += str(steps)
+    for i in range(1, steps + 1):
+        if i in damaged:
+            continue
+        line = f"{i}. {_step_prompt(i)}"
+        if with_dependencies:
+            line += " [依赖 无]" if i % 2 == 1 else f" [依赖 {i - 1}]"
+        lines.append(line)
+    return "\n".join(lines)
+
+def _repair_text(request):
+    # 按"请补写第2、3步"补写对应的步骤
+    match = re.search(r"请补写第([\d、]+)步", request)
+    numbers = [int(n) for n in match.group(1).split("、")] if match else []
+    return json.dumps({"steps": [{"index": i, "prompt": _step_prompt(i), "depends_on": []} for i in numbers]},
+                      ensure_ascii=False)
+
+def _answer_text(chars):
+    return (_FILLER * (chars // len(_FILLER) + 1))[:chars]
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "AIgentMock/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        return len(data)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+        return len(data)
+
+    def do_POST(self):
+        started_at = time.time()
+        config = self.server.mock_config
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        try:
+            payload = json.loads(raw)
+            messages = payload["messages"]
+        except (ValueError, KeyError):
+            sent = self._send_json(400, {"error": "invalid request"})
+            self.server.mock_stats.record(400, length, sent, time.time() - started_at, 0)
+            return
+
+        prompt_tokens = sum(estimate_tokens(message.get("content") or "") for message in messages)
+        # 错误注入：按概率返回429（带Retry-After）或503
+        roll = random.random()
+        if roll < config.error_429:
+            sent = self._send_json(429, {"error": "rate limited"}, {"Retry-After": str(config.retry_after)})
+            self.server.mock_stats.record(429, length, sent, time.time() - started_at, prompt_tokens)
+            return
+        if roll < config.error_429 + config.error_5xx:
+            sent = self._send_json(503, {"error": "service unavailable"})
+            self.server.mock_stats.record(503, length, sent, time.time() - started_at, prompt_tokens)
+            return
+
+        system = messages[0]["content"] if messages and messages[0].get("role") == "system" else ""
+        finish_reason = "stop"
+        if _REPAIR_MARK in messages[-1]["content"]:
+            text = _repair_text(messages[-1]["content"])
+        elif _PLANNER_MARK in system:
+            json_format = _JSON_PLAN_MARK in system
+            text = _plan_text(config.plan_steps,
+                              (_JSON_DEPENDENCY_MARK if json_format else _DEPENDENCY_MARK) in system,
+                              _FUSED_STEPS_MARK in system, json_format, config.malformed_steps)
+        elif _EARLY_STOP_CHECK_MARK in system:
+            text = "是"
+        else:
+            # 回答长度超过max_tokens时截断，finish_reason为length
+            max_tokens = payload.get("max_tokens") or config.completion_chars
+            text = _answer_text(min(config.completion_chars, max_tokens))
+            if config.completion_chars > max_tokens:
+                finish_reason = "length"
+            elif (_EARLY_STOP_MARK in messages[-1]["content"] or _EARLY_STOP_MARK in system) and random.random() < config.done_rate:
+                text += f"\n{_EARLY_STOP_MARK}"
+            if config.reasoning_chars:
+                text = f"<think>{_answer_text(config.reasoning_chars)}</think>\n\n{text}"
+        completion_tokens = estimate_tokens(text)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": self.server.prefix_cache.lookup_and_store(messages)}}
+
+        # 首字之前的等待时间按配置的分布采样
+        time.sleep(max(0.0, config.latency()) + (config.stall_seconds if random.random() < config.stall else 0.0))
+        if not payload.get("stream"):
+            # 非流式时一次性返回，生成时间按流式速度折算
+            if config.stream_tps:
+                time.sleep(completion_tokens / config.stream_tps)
+            sent = self._send_json(200, {
+                "id": "mock", "object": "chat.completion", "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}],
+                "usage": usage
+            })
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            sent = 0
+            # 每个数据块约8个字，按配置的令牌速度匀速发送
+            pieces = [text[i:i + 8] for i in range(0, len(text), 8)] or [""]
+            interval = (completion_tokens / config.stream_tps / len(pieces)) if config.stream_tps else 0
+            for piece in pieces:
+                if interval:
+                    time.sleep(interval)
+                event = {"choices": [{"index": 0, "delta": {"content": piece}}]}
+                sent += self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            final = {"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}], "usage": usage}
+            sent += self._write_chunk(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+            sent += self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        self.server.mock_stats.record(200, length, sent, time.time() - started_at, prompt_tokens)
+
+class MockServer:
+    """
+    在后台线程中运行的模拟服务器
+
+    用法：
+        with MockServer(MockConfig(latency="uniform:0.1,0.3")) as server:
+            ai_utils.API_URL = server.url
+            ...
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockConfig()
+        self.stats = MockStats()
+        self.prefix_cache = PrefixCache()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.mock_config = self.config
+        self._server.mock_stats = self.stats
+        self._server.prefix_cache = self.prefix_cache
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地模拟的OpenAI兼容对话接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="fixed:0.05", help="首字前的延迟分布，如uniform:0.1,0.5")
+    parser.add_argument("--stream-tps", type=float, default=200, help="每秒生成的令牌数，0表示不限速")
+    parser.add_argument("--error-429", type=float, default=0.0, help="返回429的概率")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="返回503的概率")
+    parser.add_argument("--retry-after", type=int, default=1, help="429响应中的Retry-After秒数")
+    parser.add_argument("--completion-chars", type=int, default=400, help="每个回答的字数")
+    parser.add_argument("--plan-steps", type=int, default=3, help="规划请求返回的步骤数")
+    parser.add_argument("--reasoning-chars", type=int, default=0, help="每个回答前附带的<think>推理过程字数")
+    parser.add_argument("--stall", type=float, default=0.0, help="请求卡住（首字前额外等待）的概率")
+    parser.add_argument("--stall-seconds", type=float, default=10.0, help="卡住时额外等待的秒数")
+    parser.add_argument("--done-rate", type=float, default=0.0, help="开启提前结束时，步骤回答写上任务完成标记的概率")
+    parser.add_argument("--malformed-steps", type=int, default=0, help="规划回答中缺失的步骤数（从第2步开始）")
+    args = parser.parse_args(argv)
+    config = MockConfig(args.latency, args.stream_tps, args.error_429, args.error_5xx, args.retry_after,
+                        args.completion_chars, args.plan_steps, args.reasoning_chars, args.stall, args.stall_seconds,
+                        args.done_rate, args.malformed_steps)
+    server = MockServer(config, args.host, args.port)
+    print(f"模拟服务器已启动: {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+if __name__ == "__main__":
+    main()
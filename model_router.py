@@ -0,0 +1,229 @@
+import threading
+import time
+from collections import deque
+from ai_utils import MODEL_CONFIGS
+from key_pool import LATENCY_EWMA_ALPHA
+
+# 按角色选择模型 - 指令优化、步骤规划、中间步骤和最终总结可以分别使用不同的模型，
+# 例如中间步骤用便宜快速的模型，只在规划和最终总结时使用慢的推理模型
+ROLES = ("optimizer", "planner", "step", "final")
+ROLE_LABELS = {
+    "optimizer": "指令优化",
+    "planner": "步骤规划",
+    "step": "中间步骤",
+    "final": "最终总结"
+}
+
+# 开启自动选择时，只有中间步骤会根据观测到的速度换用其他模型，规划和最终总结始终使用指定的模型
+AUTO_ROUTE_ROLES = ("step",)
+
+# 一个模型至少被成功调用这么多次后，它的速度统计才会用于自动选择
+AUTO_ROUTE_MIN_SAMPLES = 2
+
+# 模型连续这么多次调用失败（每次调用已经包含了重试）后进入冷却，冷却期间优先使用其他模型
+MODEL_FAILURE_THRESHOLD = 2
+MODEL_COOLDOWN = 120.0
+
+# 一次调用失败后最多再换几个模型重试
+MAX_FALLBACK_MODELS = 1
+
+# 输出长度预算 - 开启后中间步骤的max_tokens按同一角色和模型最近的输出长度估算，不再每一步都预留模型的最大输出，
+# 密钥的令牌额度也按这个预算预留；最终总结的长度决定了交付的内容，始终使用模型的最大输出
+OUTPUT_BUDGET_ROLES = ("step",)
+
+# 每个(角色, 模型)保留最近这么多次的输出长度，至少有OUTPUT_BUDGET_MIN_SAMPLES次后才按它估算
+OUTPUT_BUDGET_WINDOW = 50
+OUTPUT_BUDGET_MIN_SAMPLES = 3
+
+# 预算为最近输出长度的OUTPUT_BUDGET_PERCENTILE分位乘以OUTPUT_BUDGET_FACTOR，不低于OUTPUT_BUDGET_FLOOR个令牌
+OUTPUT_BUDGET_PERCENTILE = 0.9
+OUTPUT_BUDGET_FACTOR = 1.5
+OUTPUT_BUDGET_FLOOR = 1024
+
+class ModelState:
+    """
+    单个模型在本进程中的调用统计，所有会话和批量任务共享
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        # 成功调用的指数移动平均：首字延迟、生成速度、输出令牌数和输入令牌数
+        self.samples = 0
+        self.ttft = None
+        self.tokens_per_sec = None
+        self.completion_tokens = None
+        self.prompt_tokens = None
+
+    def update(self, name, value):
+        if value is None:
+            return
+        previous = getattr(self, name)
+        setattr(self, name, value if previous is None else
+                LATENCY_EWMA_ALPHA * value + (1 - LATENCY_EWMA_ALPHA) * previous)
+
+    def estimated_seconds(self, prompt_tokens):
+        # 预计的调用耗时：首字延迟按输入长度等比放大，加上按平均输出长度和生成速度算出的生成时间
+        if self.samples < AUTO_ROUTE_MIN_SAMPLES or not self.tokens_per_sec or self.ttft is None:
+            return None
+        ttft = self.ttft * max(1.0, prompt_tokens / self.prompt_tokens) if self.prompt_tokens else self.ttft
+        return ttft + (self.completion_tokens or 0) / self.tokens_per_sec
+
+# 所有模型的统计和{(角色, 模型): 最近的输出令牌数}，由_lock保护
+_states = {}
+_output_lengths = {}
+_lock = threading.Lock()
+
+def _state(model):
+    state = _states.get(model)
+    if state is None:
+        state = _states[model] = ModelState()
+    return state
+
+def observe(record):
+    """
+    记录一次调用的结果，由runner在每次调用结束时调用
+
+    Args:
+        record (dict): telemetry的调用记录，命中响应缓存的记录会被忽略；
+                       被取消或超过总时限的调用（停止按钮、整条链的时限、对冲中输掉的请求）不说明模型的好坏，同样忽略
+    """
+    model = record.get("model")
+    if not model or record["status"] in ("cached", "aborted"):
+        return
+    with _lock:
+        state = _state(model)
+        state.calls += 1
+        if record["status"] == "ok":
+            state.consecutive_failures = 0
+            state.samples += 1
+            state.update("ttft", record.get("ttft"))
+            state.update("tokens_per_sec", record.get("tokens_per_sec"))
+            state.update("completion_tokens", record.get("completion_tokens"))
+            state.update("prompt_tokens", record.get("prompt_tokens"))
+        else:
+            state.failures += 1
+            state.consecutive_failures += 1
+            if state.consecutive_failures >= MODEL_FAILURE_THRESHOLD:
+                state.cooldown_until = time.monotonic() + MODEL_COOLDOWN
+
+def observe_output(role, model, completion_tokens, truncated=False):
+    """
+    记录一次成功调用的输出长度，用于估算同一角色后续调用的输出预算
+
+    Args:
+        role (str): 调用的角色，只记录OUTPUT_BUDGET_ROLES中的角色
+        model (str): 模型名称
+        completion_tokens (int): 输出令牌数（推理模型包括推理过程）
+        truncated (bool): 回答是否因为达到max_tokens被截断，截断时实际需要的长度未知，按输出长度的两倍记录
+    """
+    if role not in OUTPUT_BUDGET_ROLES or not completion_tokens:
+        return
+    with _lock:
+        lengths = _output_lengths.get((role, model))
+        if lengths is None:
+            lengths = _output_lengths[(role, model)] = deque(maxlen=OUTPUT_BUDGET_WINDOW)
+        lengths.append(completion_tokens * 2 if truncated else completion_tokens)
+
+def output_budget(role, model, max_tokens):
+    """
+    Args:
+        role (str): 调用的角色
+        model (str): 模型名称
+        max_tokens (int): 模型的最大输出，作为上限，观测数据不足或不按预算的角色直接使用
+
+    Returns:
+        int: 本次调用的max_tokens
+    """
+    if role not in OUTPUT_BUDGET_ROLES:
+        return max_tokens
+    with _lock:
+        lengths = sorted(_output_lengths.get((role, model), ()))
+    if len(lengths) < OUTPUT_BUDGET_MIN_SAMPLES:
+        return max_tokens
+    p = lengths[min(len(lengths) - 1, int(OUTPUT_BUDGET_PERCENTILE * len(lengths)))]
+    return min(max_tokens, max(OUTPUT_BUDGET_FLOOR, int(p * OUTPUT_BUDGET_FACTOR)))
+
+def _fits(model, prompt_tokens):
+    # 用模型配置中的上下文预算粗略判断输入是否放得下，没有配置的模型不做限制
+    budget = MODEL_CONFIGS.get(model, {}).get("context_budget")
+    return budget is None or prompt_tokens <= budget
+
+class ModelRouter:
+    """
+    为每次调用选出要使用的模型以及失败后依次换用的模型
+
+    每个角色使用routes中指定的模型，没有指定时使用default_model。开启auto_route时，
+    中间步骤会在放得下输入的模型中选预计最快的（需要有足够的观测数据），输入超出当前模型的上下文预算时
+    换用预算更大的模型。处于冷却中的模型排在后面，失败后按顺序换用下一个模型。
+    """
+
+    def __init__(self, default_model, routes=None, auto_route=False, fallback_models=None):
+        self.default_model = default_model
+        self.routes = routes or {}
+        self.auto_route = auto_route
+        # 失败后换用的模型，默认先换回默认模型，再按配置顺序尝试其他模型
+        self.fallback_models = fallback_models if fallback_models is not None else [default_model] + list(MODEL_CONFIGS)
+
+    def model_for(self, role):
+        """
+        Args:
+            role (str): ROLES中的一个
+
+        Returns:
+            str: 该角色指定的模型
+        """
+        return self.routes.get(role) or self.default_model
+
+    def candidates(self, role, prompt_tokens=0):
+        """
+        Args:
+            role (str): ROLES中的一个
+            prompt_tokens (int): 本次请求的输入令牌数（估算）
+
+        Returns:
+            list: 按顺序尝试的模型，第一个是首选模型
+        """
+        primary = self.model_for(role)
+        now = time.monotonic()
+        with _lock:
+            if self.auto_route and role in AUTO_ROUTE_ROLES:
+                primary = self._auto_choice(primary, prompt_tokens, now)
+            ordered = list(dict.fromkeys([primary] + self.fallback_models))
+            cooling = {m for m in ordered if m in _states and _states[m].cooldown_until > now}
+        # 冷却中的模型排到最后，全部都在冷却时仍按原顺序尝试
+        ordered = [m for m in ordered if m not in cooling] + [m for m in ordered if m in cooling]
+        return ordered[:1 + MAX_FALLBACK_MODELS]
+
+    def _auto_choice(self, primary, prompt_tokens, now):
+        options = [m for m in MODEL_CONFIGS if _fits(m, prompt_tokens)
+                   and not (m in _states and _states[m].cooldown_until > now)]
+        if not _fits(primary, prompt_tokens) and options:
+            # 输入放不下时优先换用上下文预算最大的模型
+            primary = max(options, key=lambda m: MODEL_CONFIGS[m]["context_budget"])
+        primary_estimate = _states[primary].estimated_seconds(prompt_tokens) if primary in _states else None
+        if primary_estimate is None:
+            # 首选模型还没有足够的观测数据时继续使用它，积累数据
+            return primary
+        estimates = {m: _states[m].estimated_seconds(prompt_tokens) for m in options if m in _states}
+        estimates = {m: t for m, t in estimates.items() if t is not None}
+        return min(estimates, key=estimates.get) if estimates else primary
+
+def snapshot():
+    """
+    Returns:
+        list: 每个被调用过的模型的统计，供界面显示
+    """
+    now = time.monotonic()
+    with _lock:
+        return [{
+            "model": model,
+            "calls": state.calls,
+            "failures": state.failures,
+            "ttft": state.ttft,
+            "tokens_per_sec": state.tokens_per_sec,
+            "completion_tokens": state.completion_tokens,
+            "cooldown": max(0.0, state.cooldown_until - now)
+        } for model, state in sorted(_states.items())]
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+# 响应缓存配置 - 相同的模型、消息和采样参数直接返回上次的回答，不再调用API
+# AIGENT_CACHE_DIR: 缓存数据库所在目录
+# AIGENT_CACHE_MAX_BYTES: 缓存占用的最大字节数（压缩后），超出时淘汰最久未使用的条目
+# AIGENT_CACHE_TTL: 缓存条目的有效期（秒），过期后不再使用
+CACHE_DIR = os.environ.get("AIGENT_CACHE_DIR", ".aigent_cache")
+CACHE_MAX_BYTES = int(os.environ.get("AIGENT_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+CACHE_TTL = int(os.environ.get("AIGENT_CACHE_TTL", str(7 * 24 * 3600)))
+
+# 计算缓存键时使用的请求参数，stream只影响传输方式不影响回答内容，不参与计算
+CACHE_KEY_FIELDS = ("model", "messages", "max_tokens", "stop", "temperature", "top_p", "top_k",
+                    "frequency_penalty", "n", "response_format")
+
+def cache_key(payload):
+    """
+    根据请求参数计算内容寻址的缓存键
+
+    Args:
+        payload (dict): 发给API的请求参数
+
+    Returns:
+        str: 请求参数规范化JSON的SHA-256哈希
+    """
+    relevant = {field: payload.get(field) for field in CACHE_KEY_FIELDS}
+    canonical = json.dumps(relevant, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    基于SQLite的持久化响应缓存
+
+    回答内容用zlib压缩后保存，按最近访问时间做LRU淘汰，并支持过期时间。
+    每次操作都使用独立的数据库连接，可以被多个线程和Streamlit会话同时使用。
+    """
+
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+
+    @contextmanager
+    def _connect(self):
+        # sqlite3自带的with只负责提交事务不会关闭连接，这里提交后顺便关闭
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, payload):
+        """
+        查找请求对应的缓存回答
+
+        Args:
+            payload (dict): 发给API的请求参数
+
+        Returns:
+            dict: 缓存的响应数据（与接口返回结构一致），未命中或已过期时返回None
+        """
+        key = cache_key(payload)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl and now - created_at > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            # 更新访问时间，用于LRU淘汰
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(zlib.decompress(value).decode("utf-8"))
+
+    def put(self, payload, response_data):
+        """
+        保存请求对应的回答，并在超出容量时淘汰最久未使用的条目
+
+        Args:
+            payload (dict): 发给API的请求参数
+            response_data (dict): 接口返回的响应数据
+        """
+        key = cache_key(payload)
+        value = zlib.compress(json.dumps(response_data, ensure_ascii=False).encode("utf-8"))
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now)
+            )
+            if self.ttl:
+                conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # 按最近访问时间从旧到新删除，直到总大小回到上限以内
+                for old_key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    total -= size
+
+    def stats(self):
+        """
+        Returns:
+            dict: 缓存条目数(entries)和占用字节数(bytes)
+        """
+        with self._lock, self._connect() as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"entries": entries, "bytes": size}
+
+    def clear(self):
+        """清空所有缓存条目"""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+# 进程内共享的缓存对象
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """
+    获取进程内共享的响应缓存，第一次调用时创建数据库
+
+    Returns:
+        ResponseCache: 响应缓存
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(os.path.join(CACHE_DIR, "responses.sqlite3"))
+    return _cache
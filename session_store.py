@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import weakref
+from collections.abc import MutableMapping
+
+# 会话数据的磁盘存储 - 文档全文、步骤结果和原始响应等大块数据写到每个会话自己的目录里，
+# 会话状态中只保留很小的引用，需要时才读回来、用完即释放，避免服务器内存随用户数和文档大小无限增长
+# AIGENT_SESSION_DIR: 会话数据所在目录
+# AIGENT_SPILL_THRESHOLD: 超过这个字节数（UTF-8编码后）的数据才写到磁盘，更小的直接留在内存中
+# AIGENT_SESSION_TTL: 会话目录超过这么久（秒）没有读写就视为过期，在创建新会话时清理
+SESSION_DIR = os.environ.get("AIGENT_SESSION_DIR", ".aigent_sessions")
+SPILL_THRESHOLD = int(os.environ.get("AIGENT_SPILL_THRESHOLD", str(32 * 1024)))
+SESSION_TTL = int(os.environ.get("AIGENT_SESSION_TTL", str(24 * 3600)))
+
+class BlobRef:
+    """
+    指向磁盘上一块数据的引用，只保存路径和大小，读取时才加载
+
+    读取的结果要整个交给模型、检索索引或界面，调用方总是需要完整的文本，所以这里直接读出全文，
+    节省的内存来自两次读取之间不再常驻在会话状态中
+    """
+    __slots__ = ("path", "size", "is_json")
+
+    def __init__(self, path, size, is_json=False):
+        self.path = path
+        self.size = size
+        self.is_json = is_json
+
+    def read(self):
+        """
+        Returns:
+            str或对象: 写入时的文本，JSON数据会解析成对象
+
+        Raises:
+            FileNotFoundError: 数据已经被清理时抛出
+        """
+        with open(self.path, "rb") as f:
+            text = f.read().decode("utf-8")
+        return json.loads(text) if self.is_json else text
+
+    def __repr__(self):
+        return f"BlobRef({os.path.basename(self.path)}, {self.size} bytes)"
+
+class SessionStore:
+    """
+    单个会话的数据存储：小数据原样返回，大数据写入会话目录并返回BlobRef
+
+    相同的内容只写一次（按内容哈希命名）。会话对象被回收（Streamlit会话过期）时自动删除整个目录，
+    进程异常退出留下的目录由cleanup_expired_sessions按过期时间清理。
+    """
+
+    def __init__(self, root=SESSION_DIR, threshold=SPILL_THRESHOLD, session_id=None):
+        self.threshold = threshold
+        self.path = os.path.join(root, session_id or uuid.uuid4().hex)
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        # 会话结束、对象被回收时删除目录
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    def put(self, value):
+        """
+        保存一个值
+
+        Args:
+            value (str或可JSON序列化的对象): 要保存的数据
+
+        Returns:
+            原值（小于阈值时）或BlobRef
+        """
+        if value is None or isinstance(value, BlobRef):
+            return value
+        is_json = not isinstance(value, str)
+        data = (json.dumps(value, ensure_ascii=False) if is_json else value).encode("utf-8")
+        if len(data) < self.threshold or not data:
+            return value
+        path = os.path.join(self.path, hashlib.sha256(data).hexdigest() + (".json" if is_json else ".txt"))
+        with self._lock:
+            if not os.path.exists(path):
+                # 先写临时文件再改名，其他线程不会读到写了一半的文件
+                os.makedirs(self.path, exist_ok=True)
+                temp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            else:
+                os.utime(path)
+        return BlobRef(path, len(data), is_json)
+
+    def get(self, value):
+        """
+        Args:
+            value: put返回的值
+
+        Returns:
+            保存时的原始数据
+        """
+        if not isinstance(value, BlobRef):
+            return value
+        # 更新修改时间，仍在使用的会话不会被cleanup_expired_sessions当成过期
+        os.utime(value.path)
+        return value.read()
+
+    def clear(self, keep=()):
+        """
+        删除会话中的所有数据
+
+        Args:
+            keep (iterable): 仍在使用、需要保留的值（put的返回值），其中的BlobRef不会被删除
+        """
+        kept = {value.path for value in keep if isinstance(value, BlobRef)}
+        with self._lock:
+            if not os.path.isdir(self.path):
+                return
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                if path not in kept:
+                    os.remove(path)
+
+    def usage(self):
+        """
+        Returns:
+            dict: 会话目录中的文件数(files)和字节数(bytes)
+        """
+        with self._lock:
+            names = os.listdir(self.path) if os.path.isdir(self.path) else []
+            sizes = [os.path.getsize(os.path.join(self.path, name)) for name in names]
+        return {"files": len(sizes), "bytes": sum(sizes)}
+
+    def close(self):
+        """立即删除整个会话目录"""
+        self._finalizer()
+
+class SpilledDict(MutableMapping):
+    """
+    值保存在SessionStore中的字典：写入时大值落盘，读取时再加载，内存中只保留键和引用
+    """
+
+    def __init__(self, store, initial=None):
+        self.store = store
+        self._refs = {}
+        for key, value in (initial or {}).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        return self.store.get(self._refs[key])
+
+    def __setitem__(self, key, value):
+        self._refs[key] = self.store.put(value)
+
+    def __delitem__(self, key):
+        del self._refs[key]
+
+    def __iter__(self):
+        return iter(list(self._refs))
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __contains__(self, key):
+        return key in self._refs
+
+    def refs(self):
+        # 所有值的引用，用于SessionStore.clear的keep参数
+        return list(self._refs.values())
+
+def cleanup_expired_sessions(root=SESSION_DIR, ttl=SESSION_TTL):
+    """
+    删除超过ttl秒没有读写的会话目录（服务重启前留下的、或会话过期后没来得及清理的）
+
+    Returns:
+        int: 删除的目录数
+    """
+    if not ttl or not os.path.isdir(root):
+        return 0
+    removed = 0
+    cutoff = time.time() - ttl
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            files = [os.path.join(path, f) for f in os.listdir(path)]
+            last_write = max([os.path.getmtime(path)] + [os.path.getmtime(f) for f in files])
+        except OSError:
+            continue
+        if last_write < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
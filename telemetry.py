@@ -0,0 +1,250 @@
+import json
+import time
+from collections import defaultdict
+
+# 调用耗时直方图的分桶边界（秒），用于Prometheus格式的导出
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+# 每次调用记录包含的字段：
+#   call_id / step / model / stream / key_index  调用的基本信息，key_index是最后一次尝试使用的密钥
+#   status          "ok"成功、"failed"失败、"aborted"被取消或超过总时限（调用方的决定，不代表模型出错）、"cached"命中响应缓存
+#   started_at      调用开始的时间戳（包含排队）
+#   queue_wait      在密钥池和全局速率限制处排队的总时间（秒）
+#   backoff         重试前等待的总时间（秒）
+#   send_offset     从调用开始到最后一次尝试发出请求的时间（秒），包含排队、重试和退避
+#   connect_time    最后一次尝试从发出请求到收到响应头的时间（秒），包含建立连接
+#   ttft            最后一次尝试的首字延迟（秒），非流式调用时等于请求耗时
+#   latency         调用的总耗时（秒），包含排队和重试
+#   attempts        尝试次数，retries = attempts - 1
+#   prompt_tokens / completion_tokens / total_tokens  接口返回的令牌用量
+#   cached_tokens   输入令牌中命中服务端前缀缓存的部分，接口没有返回时为0
+#   tokens_per_sec  生成速度：输出令牌数 / 从首字到结束的时间（非流式时为整个请求耗时）
+#   hedged          是否发出过对冲请求（主请求太慢时用另一个密钥再发一次），hedge_won表示最终采用的是对冲请求
+#   finish_reason / status_code / error
+
+def new_call_record(call_id, step_name, payload):
+    """
+    创建一条调用记录，在调用开始时调用
+
+    Args:
+        call_id: 调用编号
+        step_name (str): 调用所属的步骤名称
+        payload (dict): 发给API的请求参数
+
+    Returns:
+        dict: 调用记录，调用过程中由发送方逐步填写
+    """
+    return {
+        "call_id": call_id,
+        "step": step_name,
+        "model": payload.get("model"),
+        "stream": bool(payload.get("stream")),
+        "key_index": None,
+        "status": "failed",
+        "started_at": time.time(),
+        "queue_wait": 0.0,
+        "backoff": 0.0,
+        "send_offset": 0.0,
+        "connect_time": None,
+        "ttft": None,
+        "latency": None,
+        "attempts": 0,
+        "retries": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+        "cached_tokens": 0,
+        "tokens_per_sec": None,
+        "hedged": False,
+        "hedge_won": False,
+        "finish_reason": None,
+        "status_code": None,
+        "error": None
+    }
+
+def cached_prompt_tokens(usage):
+    """
+    读取接口返回的前缀缓存命中令牌数，兼容两种常见的写法：
+    OpenAI风格的usage.prompt_tokens_details.cached_tokens和DeepSeek风格的usage.prompt_cache_hit_tokens
+
+    Args:
+        usage (dict): 接口返回的usage字段
+
+    Returns:
+        int: 命中缓存的输入令牌数，没有返回时为0
+    """
+    if not usage:
+        return 0
+    details = usage.get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens") or 0
+
+def finish_call_record(record, response_data=None):
+    """
+    在调用结束时补全记录：总耗时、令牌用量和生成速度
+
+    Args:
+        record (dict): new_call_record创建的记录
+        response_data (dict): 成功时的响应数据，失败时为None
+    """
+    record["latency"] = time.time() - record["started_at"]
+    record["retries"] = max(0, record["attempts"] - 1)
+    if response_data is None:
+        return record
+    record["status"] = "ok"
+    usage = response_data.get("usage") or {}
+    for name in ("prompt_tokens", "completion_tokens", "total_tokens"):
+        record[name] = usage.get(name, 0)
+    record["cached_tokens"] = cached_prompt_tokens(usage)
+    choices = response_data.get("choices") or []
+    if choices:
+        record["finish_reason"] = choices[0].get("finish_reason")
+    # 生成阶段的时间：流式调用从首字开始算，非流式调用只能用整个请求的耗时
+    generation_time = record["latency"] - record["send_offset"]
+    if record["stream"] and record["ttft"] is not None:
+        generation_time -= record["ttft"]
+    if record["completion_tokens"] and generation_time > 0:
+        record["tokens_per_sec"] = record["completion_tokens"] / generation_time
+    return record
+
+def cached_call_record(call_id, step_name, payload, response_data):
+    """
+    为命中响应缓存的调用生成记录，令牌用量是缓存中保存的原始用量，并不是实际消耗
+    """
+    record = new_call_record(call_id, step_name, payload)
+    finish_call_record(record, response_data)
+    record["status"] = "cached"
+    record["ttft"] = record["latency"]
+    record["tokens_per_sec"] = None
+    return record
+
+def to_jsonl(records):
+    """
+    Args:
+        records (list): 调用记录列表
+
+    Returns:
+        str: 每行一条记录的JSONL文本
+    """
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+def _label_text(labels):
+    # Prometheus标签值需要转义反斜杠、双引号和换行
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+def to_prometheus(records, prefix="aigent"):
+    """
+    把调用记录汇总为Prometheus文本格式的指标，可以交给node_exporter的textfile收集器
+
+    Args:
+        records (list): 调用记录列表
+        prefix (str): 指标名前缀
+
+    Returns:
+        str: Prometheus文本格式的指标
+    """
+    calls = defaultdict(int)
+    tokens = defaultdict(int)
+    sums = defaultdict(float)
+    buckets = defaultdict(int)
+    counts = defaultdict(int)
+    throughput = defaultdict(list)
+    for record in records:
+        model = record.get("model") or ""
+        key = "" if record.get("key_index") is None else str(record["key_index"] + 1)
+        calls[(("model", model), ("key", key), ("status", record.get("status")))] += 1
+        if record.get("status") == "cached":
+            continue
+        for kind in ("prompt", "completion", "cached"):
+            tokens[(("model", model), ("kind", kind))] += record.get(f"{kind}_tokens") or 0
+        model_label = (("model", model),)
+        sums[("retries_total", model_label)] += record.get("retries") or 0
+        sums[("backoff_seconds_total", model_label)] += record.get("backoff") or 0.0
+        sums[("queue_wait_seconds_total", model_label)] += record.get("queue_wait") or 0.0
+        sums[("hedges_total", model_label)] += 1 if record.get("hedged") else 0
+        sums[("hedge_wins_total", model_label)] += 1 if record.get("hedge_won") else 0
+        if record.get("status") != "ok":
+            continue
+        counts[model_label] += 1
+        sums[("call_latency_seconds_sum", model_label)] += record["latency"]
+        for bound in LATENCY_BUCKETS:
+            if record["latency"] <= bound:
+                buckets[(model_label, bound)] += 1
+        if record.get("ttft") is not None:
+            sums[("ttft_seconds_sum", model_label)] += record["ttft"]
+            sums[("ttft_seconds_count", model_label)] += 1
+        if record.get("tokens_per_sec"):
+            throughput[model_label].append(record["tokens_per_sec"])
+
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+        for suffix, labels, value in samples:
+            lines.append(f"{prefix}_{name}{suffix}{_label_text(labels)} {value:g}")
+
+    metric("calls_total", "counter", "Number of model calls by model, key and status",
+           [("", labels, value) for labels, value in sorted(calls.items())])
+    metric("tokens_total", "counter",
+           "Tokens consumed by model and kind (response-cache hits excluded); "
+           "kind=cached is the part of prompt tokens served from the provider's prefix cache",
+           [("", labels, value) for labels, value in sorted(tokens.items())])
+    for name, help_text in (("retries_total", "Retries after failed attempts"),
+                            ("backoff_seconds_total", "Seconds spent sleeping before retries"),
+                            ("queue_wait_seconds_total", "Seconds spent waiting for a key or the global rate limit"),
+                            ("hedges_total", "Calls that sent a duplicate (hedged) request because the first one was slow"),
+                            ("hedge_wins_total", "Hedged calls where the duplicate request answered first")):
+        metric(name, "counter", help_text,
+               [("", labels, value) for (metric_name, labels), value in sorted(sums.items()) if metric_name == name])
+    latency_samples = []
+    for labels, count in sorted(counts.items()):
+        for bound in LATENCY_BUCKETS:
+            latency_samples.append(("_bucket", labels + (("le", f"{bound:g}"),), buckets[(labels, bound)]))
+        latency_samples.append(("_bucket", labels + (("le", "+Inf"),), count))
+        latency_samples.append(("_sum", labels, sums[("call_latency_seconds_sum", labels)]))
+        latency_samples.append(("_count", labels, count))
+    metric("call_latency_seconds", "histogram", "Total call latency including queueing and retries", latency_samples)
+    ttft_samples = []
+    for labels in sorted(counts):
+        if sums[("ttft_seconds_count", labels)]:
+            ttft_samples.append(("_sum", labels, sums[("ttft_seconds_sum", labels)]))
+            ttft_samples.append(("_count", labels, sums[("ttft_seconds_count", labels)]))
+    metric("ttft_seconds", "summary", "Time to first token of the final attempt", ttft_samples)
+    metric("tokens_per_second", "gauge", "Mean generation speed by model",
+           [("", labels, sum(values) / len(values)) for labels, values in sorted(throughput.items())])
+    return "\n".join(lines) + "\n"
+
+def timeline_rows(records):
+    """
+    把调用记录转换成时间线（瀑布图）用的数据，每条调用分为"排队/重试"、"等待首字"、"生成"三段
+
+    Args:
+        records (list): 调用记录列表
+
+    Returns:
+        list: [{"call": 调用名称, "phase": 阶段, "start": 开始秒数, "end": 结束秒数}, ...]，时间相对最早的调用
+    """
+    finished = [record for record in records if record.get("latency") is not None]
+    if not finished:
+        return []
+    origin = min(record["started_at"] for record in finished)
+    rows = []
+    for record in finished:
+        start = record["started_at"] - origin
+        name = f"#{record['call_id']} {record['step'] or '未命名'}"
+        send = start + record["send_offset"]
+        end = start + record["latency"]
+        first_token = min(end, send + record["ttft"]) if record["ttft"] is not None else end
+        segments = [("排队/重试", start, send), ("等待首字", send, first_token), ("生成", first_token, end)]
+        if record["status"] == "cached":
+            segments = [("缓存命中", start, end)]
+        elif record["status"] == "aborted":
+            segments = [("已取消", start, end)]
+        elif record["status"] != "ok":
+            segments = [("失败", start, end)]
+        for phase, phase_start, phase_end in segments:
+            if phase_end > phase_start or phase in ("缓存命中", "已取消", "失败"):
+                rows.append({"call": name, "phase": phase, "start": round(phase_start, 3), "end": round(phase_end, 3)})
+    return rows
@@ -0,0 +1,16 @@
+from chain_dag import run_dag
+
+
+def test_step_exception_is_reported():
+    errors = []
+
+    def run_step(index, dep_outputs):
+        if index == 1:
+            raise ValueError("步骤出错")
+        return f"输出{index}"
+
+    results, failed = run_dag(3, [[], [], [0, 1]], run_step, on_error=lambda i, e: errors.append((i, e)))
+    assert results == {0: "输出0"}
+    assert failed == [1]
+    assert [(i, str(e)) for i, e in errors] == [(1, "步骤出错")]
+    assert errors[0][1].__traceback__ is not None
@@ -0,0 +1,88 @@
+import time
+
+import pytest
+
+from chain_runner import ChainConfig, ChainRunner
+
+
+class StopScript(Exception):
+    pass
+
+
+def test_sequential_step_cancelled_while_waiting():
+    runner = ChainRunner(ChainConfig(api_keys=["k1"], checkpoints=False))
+    runner.prompts = ["第一步", "总结"]
+    runner.begin()
+
+    def slow_step(index, dep_outputs):
+        # 模拟还没有响应的HTTP调用，只有取消后才会结束
+        runner.cancel_event.wait(30)
+        return None
+
+    def on_event(event, data):
+        # 界面在waiting事件中刷新页面，停止按钮在这时中断脚本
+        if event == "waiting":
+            raise StopScript()
+
+    runner._run_step = slow_step
+    runner.on_event = on_event
+    started = time.monotonic()
+    with pytest.raises(StopScript):
+        runner.run_steps()
+    assert runner.cancel_event.is_set()
+    assert time.monotonic() - started < 5
+
+
+def test_prefix_layout_early_stop_keeps_requests_as_prefix_extensions():
+    runner = ChainRunner(ChainConfig(api_keys=["k1"], checkpoints=False, message_layout="prefix", early_stop=True,
+                                     strip_reasoning=False, adaptive_max_tokens=False))
+    runner.optimized_prompt = "写一篇报告"
+    runner.prompts = [f"第{n}步的具体任务" for n in range(1, 5)] + ["总结"]
+    sent = []
+
+    def fake_complete(payload, step_name, with_reasoning=False, role=None, **kwargs):
+        sent.append(payload["messages"])
+        return f"{step_name}的回答", ""
+
+    runner.complete = fake_complete
+    outputs = {}
+    for index in range(2):
+        outputs[index] = runner._run_step(index, dict(outputs))
+    # 提前结束后跳过中间步骤，总结步骤的请求同样是之前请求的延伸
+    runner._skip_to_final(1)
+    runner._run_step(2, dict(outputs))
+
+    for previous, current in zip(sent, sent[1:]):
+        assert current[:len(previous)] == previous
+    assert "【可以总结】" in sent[0][0]["content"]
+
+
+def test_early_stop_note_is_not_part_of_retrieval_query():
+    runner = ChainRunner(ChainConfig(api_keys=["k1"], checkpoints=False, early_stop=True, strip_reasoning=False,
+                                     adaptive_max_tokens=False))
+    runner.optimized_prompt = "写一篇关于城市交通的报告"
+    runner.prompts = ["整理交通数据", "分析拥堵原因", "提出治理建议", "总结"]
+    # 之前的输出已经覆盖了后面步骤的大部分内容，这一步会追加提前结束的说明
+    runner.results[0] = "分析拥堵原因，提出治理建议"
+    queries, sent = [], []
+    runner.document_context = lambda query: queries.append(query) or ""
+    runner.call_model = lambda prompt, **kwargs: sent.append(prompt) or ("回答", "")
+
+    runner._run_step(1, {0: runner.results[0]})
+    assert queries == ["分析拥堵原因"]
+    assert "【可以总结】" in sent[0]
+
+
+def test_local_coverage_check_finishes_without_marker():
+    runner = ChainRunner(ChainConfig(api_keys=["k1"], checkpoints=False, early_stop=True))
+    runner.prompts = ["整理交通数据", "分析拥堵原因", "提出治理建议", "总结"]
+    answer = "交通数据整理如下。" * 30
+    runner.results[0] = answer
+    assert not runner._locally_finished(0, answer)
+
+    answer += "进一步分析拥堵原因……最后提出治理建议……"
+    runner.results[0] = answer
+    assert runner._locally_finished(0, answer)
+    # 太短的回答不会提前结束
+    runner.results[0] = "分析拥堵原因，提出治理建议"
+    assert not runner._locally_finished(0, runner.results[0])
@@ -0,0 +1,64 @@
+import sqlite3
+
+import checkpoint
+from chain_runner import ChainConfig, ChainRunner
+from checkpoint import CheckpointStore
+
+
+def test_runs_are_scoped_to_owner(tmp_path):
+    store = CheckpointStore(str(tmp_path / "runs.db"))
+    store.save_plan("run_a", "任务A", "任务A", ["步骤"], [], owner="alice")
+    store.save_plan("run_b", "任务B", "任务B", ["步骤"], [], owner="bob")
+
+    assert [run["run_id"] for run in store.list_runs(owner="alice")] == ["run_a"]
+    assert store.load_run("run_b", owner="alice") is None
+    assert store.load_run("run_a", owner="alice")["user_prompt"] == "任务A"
+    # 不指定所有者时（命令行批处理）不做检查
+    assert {run["run_id"] for run in store.list_runs()} == {"run_a", "run_b"}
+    assert store.load_run("run_b") is not None
+
+
+def test_old_database_gets_owner_column(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE runs (run_id TEXT PRIMARY KEY, status TEXT NOT NULL, user_prompt TEXT NOT NULL, "
+        "optimized_prompt TEXT NOT NULL, prompts TEXT NOT NULL, dependencies TEXT NOT NULL, "
+        "document_label TEXT NOT NULL, document_hash TEXT NOT NULL, document BLOB, "
+        "settings TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO runs VALUES ('old', 'planned', 'x', 'x', '[]', '[]', '', '', NULL, '{}', 0, 1e12)")
+    conn.commit()
+    conn.close()
+
+    store = CheckpointStore(path)
+    assert store.list_runs(owner="alice") == []
+    assert store.load_run("old", owner="alice") is None
+    assert store.load_run("old") is not None
+
+
+def test_skipped_steps_survive_resume(tmp_path, monkeypatch):
+    store = CheckpointStore(str(tmp_path / "runs.db"))
+    monkeypatch.setattr(checkpoint, "_store", store)
+    runner = ChainRunner(ChainConfig(api_keys=["k1"], early_stop=True))
+    runner.run_id = "run_a"
+    runner.prompts = ["第1步", "第2步", "第3步", "总结"]
+    store.save_plan("run_a", "任务", "任务", runner.prompts, [])
+    runner._skip_to_final(0)
+    assert store.load_run("run_a")["skipped_steps"] == ["第2步", "第3步"]
+
+    resumed = ChainRunner(ChainConfig(api_keys=["k1"], early_stop=True))
+    assert resumed.resume("run_a")
+    assert resumed.prompts == ["第1步", "总结"]
+    assert resumed.skipped_steps == ["第2步", "第3步"]
+    assert resumed.stats.early_stop == {"after": 0, "skipped": 2}
+
+
+def test_claim_run_moves_it_to_new_owner(tmp_path):
+    store = CheckpointStore(str(tmp_path / "runs.db"))
+    store.save_plan("run_a", "任务A", "任务A", ["步骤"], [], owner="old-session")
+
+    assert not store.claim_run("missing", "new-session")
+    assert store.claim_run("run_a", "new-session")
+    assert store.load_run("run_a", owner="old-session") is None
+    assert [run["run_id"] for run in store.list_runs(owner="new-session")] == ["run_a"]
@@ -0,0 +1,69 @@
+from context_builder import SummaryCache, build_context, estimate_tokens, truncate_to_tokens, TRUNCATION_MARK
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    # 每个汉字和全角标点按1个令牌，其他字符按4个字符1个令牌
+    assert estimate_tokens("城市交通。") == 5
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("交通abcd") == 3
+
+
+def test_truncate_to_tokens():
+    text = "城市交通" * 50
+    assert truncate_to_tokens(text, 200) == text
+    truncated = truncate_to_tokens(text, 20)
+    # 省略标记也计入预算
+    assert truncated == text[:20 - estimate_tokens(TRUNCATION_MARK)] + TRUNCATION_MARK
+    assert estimate_tokens(truncated) == 20
+
+
+def test_outputs_within_budget_are_kept():
+    outputs = [(1, "第一步的输出"), (2, "第二步的输出")]
+    entries, saved = build_context(outputs, 100, SummaryCache())
+    assert entries == [(1, "第一步的输出", False), (2, "第二步的输出", False)]
+    assert saved == 0
+
+
+def test_older_outputs_are_summarized_first():
+    outputs = [(n, f"第{n}步" + "很长的输出" * 40) for n in range(1, 5)]
+    summaries = []
+
+    def summarize(text):
+        summaries.append(text)
+        return "摘要"
+
+    entries, saved = build_context(outputs, 450, SummaryCache(), summarize, keep_recent=2)
+    # 只摘要必要的个数，最近两步保留原文
+    assert [(step, is_summary) for step, _, is_summary in entries] == [(1, True), (2, True), (3, False), (4, False)]
+    assert len(summaries) == 2
+    assert sum(estimate_tokens(text) for _, text, _ in entries) <= 450
+    assert saved == sum(estimate_tokens(text) for _, text in outputs) - sum(estimate_tokens(t) for _, t, _ in entries)
+
+
+def test_budget_is_enforced_when_recent_outputs_are_too_long():
+    outputs = [(1, "较早的输出" * 100), (2, "最近的输出" * 100), (3, "最后的输出" * 100)]
+    entries, _ = build_context(outputs, 200, SummaryCache(), keep_recent=2)
+    # 摘要仍然放不下时丢弃，最近的原文平均截断
+    assert [step for step, _, _ in entries] == [2, 3]
+    assert sum(estimate_tokens(text) for _, text, _ in entries) <= 200
+
+
+def test_summary_is_generated_once():
+    cache = SummaryCache()
+    calls = []
+    summarize = lambda text: calls.append(text) or "摘要"
+    assert cache.get("输出", summarize) == "摘要"
+    assert cache.get("输出", summarize) == "摘要"
+    assert len(calls) == 1
+    # 摘要失败时退回到截断后的原文
+    assert cache.get("另一个输出", lambda text: None) == "另一个输出"
+
+
+def test_failed_summary_is_not_cached():
+    cache = SummaryCache()
+    assert cache.get("输出", lambda text: None) == "输出"
+    assert cache.get("输出", lambda text: "  ") == "输出"
+    # 之前的失败没有被缓存，这次重新生成摘要
+    assert cache.get("输出", lambda text: "摘要") == "摘要"
+    assert cache.get("输出", lambda text: None) == "摘要"
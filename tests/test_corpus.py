@@ -0,0 +1,60 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import corpus
+import doc_extract
+
+
+def test_page_progress_reported_for_each_file(monkeypatch):
+    def fake_extract(data, kind, on_progress=None, **options):
+        for page in range(1, 4):
+            time.sleep(0.05)
+            on_progress(page, 3)
+        return data.decode("utf-8"), []
+
+    monkeypatch.setattr(corpus, "extract_document", fake_extract)
+    monkeypatch.setattr(corpus, "PAGE_PROGRESS_INTERVAL", 0.01)
+    pages = []
+    files = [("a.pdf", "第一份文件的内容" * 10), ("b.pdf", "第二份文件的内容" * 10)]
+    result = corpus.build_corpus([(name, text.encode("utf-8")) for name, text in files],
+                                 on_page_progress=lambda name, done, total: pages.append((name, done, total)))
+    assert result.summary()["used_files"] == 2
+    assert {name for name, _, _ in pages} == {"a.pdf", "b.pdf"}
+    assert all(total == 3 and name in ("a.pdf", "b.pdf") for name, _, total in pages)
+
+
+def test_ocr_slots_are_shared(monkeypatch):
+    monkeypatch.setattr(doc_extract, "_ocr_slots", threading.Semaphore(3))
+    first = doc_extract._acquire_ocr_slots(5)
+    assert first == 3
+
+    # 名额用完后其他文件要等到有名额释放
+    granted = []
+    waiter = threading.Thread(target=lambda: granted.append(doc_extract._acquire_ocr_slots(2)))
+    waiter.start()
+    waiter.join(0.2)
+    assert not granted
+    doc_extract._release_ocr_slots(first)
+    waiter.join(5)
+    assert granted == [2]
+    doc_extract._release_ocr_slots(2)
+
+
+def test_stuck_ocr_workers_are_terminated():
+    executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        # 模拟tesseract卡住的页面
+        stuck = [executor.submit(time.sleep, 60) for _ in range(2)]
+        deadline = time.monotonic() + 30
+        while not all(future.running() for future in stuck) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        processes = list(executor._processes.values())
+        assert processes
+        started = time.monotonic()
+        doc_extract._terminate_workers(executor)
+        assert time.monotonic() - started < 10
+        assert not any(process.is_alive() for process in processes)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,48 @@
+from context_builder import estimate_tokens
+from doc_index import DocumentIndex, SOURCE_HEADER, chunk_text, tokenize
+
+CHUNKS = [
+    "城市交通拥堵的原因包括道路容量不足和停车管理混乱。",
+    "公共交通票价调整方案：地铁起步价两元。",
+    "交通数据显示早高峰拥堵最严重的路段集中在市中心，拥堵时长超过一小时。",
+    "绿化带养护和园林管理的年度计划。",
+]
+
+
+def test_tokenize_uses_cjk_bigrams_and_lowercase_words():
+    assert tokenize("城市交通") == ["城市", "市交", "交通"]
+    assert tokenize("堵 车") == ["堵", "车"]
+    assert tokenize("BM25 检索Index") == ["bm25", "index", "检索"]
+
+
+def test_search_ranks_by_bm25():
+    index = DocumentIndex(CHUNKS)
+    results = index.search("分析早高峰拥堵")
+    # 命中"拥堵"和"早高峰"的片段排在只命中"拥堵"的片段前面，无关片段不返回
+    assert [i for i, _ in results] == [2, 0]
+    assert results[0][1] > results[1][1] > 0
+    assert index.search("量子计算") == []
+    assert len(index.search("交通", top_k=2)) == 2
+
+
+def test_select_respects_budget_and_keeps_document_order():
+    index = DocumentIndex(CHUNKS)
+    budget = estimate_tokens(CHUNKS[2]) + estimate_tokens(CHUNKS[0])
+    assert index.select("早高峰拥堵", token_budget=budget) == [0, 2]
+    assert index.select("早高峰拥堵", token_budget=estimate_tokens(CHUNKS[2])) == [2]
+    # 没有相关片段时使用文档开头的片段
+    assert index.select("量子计算", token_budget=estimate_tokens(CHUNKS[0]), top_k=1) == [0]
+    # 全文放得下时返回全部片段
+    assert index.context_for("量子计算", token_budget=10000) == index.text
+
+
+def test_chunks_stay_within_size_and_source():
+    text = "\n\n".join(f"第{n}段。" + "内容" * 30 for n in range(10))
+    chunks = chunk_text(text, chunk_tokens=100, overlap_tokens=20)
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 100 for chunk in chunks)
+
+    merged = f"{SOURCE_HEADER.format('a.txt')}\n{text}\n{SOURCE_HEADER.format('b.txt')}\n结尾"
+    index = DocumentIndex.from_text(merged, chunk_tokens=100, overlap_tokens=20)
+    assert index.chunks[-1] == f"{SOURCE_HEADER.format('b.txt')}\n结尾"
+    assert all(chunk.startswith(SOURCE_HEADER.format("a.txt")) for chunk in index.chunks[:-1])
@@ -0,0 +1,50 @@
+import asyncio
+import ai_utils
+import latency_tracker
+from telemetry import new_call_record
+
+PAYLOAD = {"model": "Qwen/QwQ-32B", "messages": [{"role": "user", "content": "测试"}]}
+
+def _failing_send(delay, error):
+    # 等待delay秒后失败（重试用完）的请求
+    async def send(on_event, base, record, control):
+        record["attempts"] = 1
+        await control.sleep(delay)
+        record["status"] = "failed"
+        record["error"] = error
+        return None
+    return send
+
+def _run_hedged(send, hedge_delay):
+    record = new_call_record(1, "步骤 1", PAYLOAD)
+    events = []
+    control = ai_utils._CallControl(None, None)
+    result = asyncio.run(ai_utils._send_hedged(send, hedge_delay, PAYLOAD, lambda event, data: events.append(event),
+                                               {}, record, control))
+    return result, record, events
+
+def test_primary_fails_before_hedge(monkeypatch):
+    monkeypatch.setattr(latency_tracker, "reserve_hedge", lambda: True)
+    result, record, events = _run_hedged(_failing_send(0.05, "主请求失败"), hedge_delay=10)
+    assert result is None
+    assert "hedge" not in events
+    assert record["status"] == "failed"
+    assert not record["hedged"]
+
+def test_all_contenders_fail(monkeypatch):
+    monkeypatch.setattr(latency_tracker, "reserve_hedge", lambda: True)
+    calls = []
+
+    async def send(on_event, base, record, control):
+        # 主请求在对冲请求发出之后才失败，对冲请求也失败
+        calls.append(record)
+        if len(calls) == 1:
+            return await _failing_send(0.5, None)(on_event, base, record, control)
+        return await _failing_send(0.05, "对冲请求失败")(on_event, base, record, control)
+
+    result, record, events = _run_hedged(send, hedge_delay=0.1)
+    assert result is None
+    assert events.count("hedge") == 1
+    assert record["hedged"] and not record["hedge_won"]
+    assert record["status"] == "failed"
+    assert record["error"] == "对冲请求失败"
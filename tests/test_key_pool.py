@@ -0,0 +1,142 @@
+import email.utils
+
+import pytest
+
+import key_pool
+from key_pool import KeyPool, TokenBucket, parse_retry_after, KEY_COOLDOWN_BASE
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(key_pool, "time", clock)
+    # 密钥状态在进程内共享，每个测试使用新的状态
+    monkeypatch.setattr(key_pool, "_states", {})
+    return clock
+
+
+def test_token_bucket_refills_at_rate(clock):
+    bucket = TokenBucket(60)
+    bucket.charge(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+    clock.advance(0.5)
+    assert bucket.wait_time(1) == pytest.approx(0.5)
+    clock.advance(0.5)
+    assert bucket.wait_time(1) == 0.0
+    # 补充不会超过容量
+    clock.advance(600)
+    assert bucket.wait_time(60) == 0.0
+    assert bucket.level == 60
+    # 超过容量的需求按装满计算
+    bucket.charge(90)
+    assert bucket.wait_time(1000) == pytest.approx(90.0)
+
+
+def test_token_bucket_unlimited():
+    bucket = TokenBucket(0)
+    bucket.charge(10 ** 6)
+    assert bucket.wait_time(10 ** 6) == 0.0
+
+
+def test_rpm_limit_moves_to_next_key(clock):
+    pool = KeyPool(["key-a", "key-b"], rpm=1, tpm=0)
+    first = pool.acquire(timeout=0)
+    pool.release(first, status_code=200, latency=1.0)
+    second = pool.acquire(timeout=0)
+    pool.release(second, status_code=200, latency=1.0)
+    assert {first, second} == {0, 1}
+    # 两个密钥这一分钟的请求数都用完了
+    assert pool.acquire(timeout=0) is None
+    clock.advance(60)
+    assert pool.acquire(timeout=0) is not None
+
+
+def test_tpm_limit_and_usage_correction(clock):
+    pool = KeyPool(["key-a"], rpm=0, tpm=1000)
+    index = pool.acquire(estimated_tokens=100, timeout=0)
+    # 实际用量比预估多，多出的部分计入令牌桶
+    pool.release(index, status_code=200, estimated_tokens=100, used_tokens=1000)
+    assert pool.acquire(estimated_tokens=100, timeout=0) is None
+    clock.advance(6)
+    assert pool.acquire(estimated_tokens=100, timeout=0) == 0
+
+
+def test_parse_retry_after(clock):
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("") is None
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("-5") == 0.0
+    assert parse_retry_after("无效") is None
+    http_date = email.utils.formatdate(clock.now + 30, usegmt=True)
+    assert parse_retry_after(http_date) == pytest.approx(30.0)
+    # 已经过去的时间不需要等待
+    assert parse_retry_after(email.utils.formatdate(clock.now - 30, usegmt=True)) == 0.0
+
+
+def test_cooldown_grows_with_consecutive_failures(clock):
+    pool = KeyPool(["key-a"])
+    for failures in range(1, 4):
+        index = pool.acquire(timeout=0)
+        pool.release(index, status_code=500)
+        cooldown = KEY_COOLDOWN_BASE * 2 ** (failures - 1)
+        assert pool.snapshot()[0]["cooldown"] == pytest.approx(cooldown)
+        assert pool.acquire(timeout=0) is None
+        clock.advance(cooldown)
+    index = pool.acquire(timeout=0)
+    pool.release(index, status_code=200, latency=1.0)
+    assert pool.keys[0].consecutive_failures == 0
+    assert pool.snapshot()[0]["failures"] == 3
+
+
+def test_rate_limit_uses_retry_after(clock):
+    pool = KeyPool(["key-a"])
+    index = pool.acquire(timeout=0)
+    pool.release(index, status_code=429, retry_after=20)
+    snapshot = pool.snapshot()[0]
+    assert snapshot["cooldown"] == pytest.approx(20)
+    assert snapshot["rate_limited"] == 1
+
+
+def test_client_errors_do_not_cool_down(clock):
+    pool = KeyPool(["key-a"])
+    pool.release(pool.acquire(timeout=0), status_code=401)
+    assert pool.snapshot()[0]["cooldown"] == 0
+    assert pool.acquire(timeout=0) == 0
+
+
+def test_aborted_release_keeps_health_and_latency(clock):
+    pool = KeyPool(["key-a"])
+    pool.release(pool.acquire(timeout=0), status_code=200, latency=2.0)
+    index = pool.acquire(timeout=0)
+    assert pool.snapshot()[0]["in_flight"] == 1
+    pool.release(index, status_code=None, latency=50.0, aborted=True)
+    snapshot = pool.snapshot()[0]
+    assert snapshot["in_flight"] == 0
+    assert snapshot["failures"] == 0
+    assert snapshot["cooldown"] == 0
+    assert snapshot["latency"] == 2.0
+
+
+def test_least_loaded_key_is_chosen(clock):
+    pool = KeyPool(["key-a", "key-b"])
+    first = pool.acquire(timeout=0)
+    second = pool.acquire(timeout=0)
+    assert first != second
+    pool.release(first, status_code=200, latency=5.0)
+    pool.release(second, status_code=200, latency=1.0)
+    # 进行中的请求数相同时选平均延迟低的
+    assert pool.acquire(timeout=0) == second
@@ -0,0 +1,15 @@
+import latency_tracker
+
+MODEL = "Qwen/QwQ-32B"
+
+def test_call_kinds_have_separate_histograms(monkeypatch):
+    monkeypatch.setattr(latency_tracker, "_histograms", {})
+    for _ in range(latency_tracker.MIN_SAMPLES):
+        latency_tracker.observe(MODEL, False, 1.0, "optimizer")
+        latency_tracker.observe(MODEL, False, 200.0, "final")
+
+    # 很短的指令优化调用不会把最终总结的超时压低
+    assert latency_tracker.adaptive_timeout(MODEL, False, 600, kind="optimizer") == latency_tracker.ADAPTIVE_TIMEOUT_FLOOR
+    assert latency_tracker.adaptive_timeout(MODEL, False, 600, kind="final") == 600
+    assert latency_tracker.hedge_delay(MODEL, False, "step") is None
+    assert {item["kind"] for item in latency_tracker.snapshot()["models"]} == {"optimizer", "final"}
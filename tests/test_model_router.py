@@ -0,0 +1,31 @@
+import threading
+
+import ai_utils
+import model_router
+from key_pool import KeyPool
+from telemetry import new_call_record
+
+PAYLOAD = {"model": "Qwen/QwQ-32B", "messages": [{"role": "user", "content": "测试"}], "max_tokens": 16}
+
+def _record(status):
+    return dict(new_call_record(1, "步骤 1", PAYLOAD), status=status)
+
+def test_aborted_calls_do_not_cool_down_model(monkeypatch):
+    monkeypatch.setattr(model_router, "_states", {})
+    for _ in range(model_router.MODEL_FAILURE_THRESHOLD + 1):
+        model_router.observe(_record("aborted"))
+    state = model_router._state(PAYLOAD["model"])
+    assert state.failures == 0 and state.cooldown_until == 0.0
+
+    for _ in range(model_router.MODEL_FAILURE_THRESHOLD):
+        model_router.observe(_record("failed"))
+    assert state.cooldown_until > 0.0
+
+def test_cancelled_call_is_recorded_as_aborted():
+    cancel_event = threading.Event()
+    cancel_event.set()
+    records = []
+    result = ai_utils.chat_completion(dict(PAYLOAD), KeyPool(["k1"]), cancel_event=cancel_event,
+                                      on_event=lambda event, data: event == "call_trace" and records.append(data["record"]))
+    assert result is None
+    assert [record["status"] for record in records] == ["aborted"]
@@ -0,0 +1,151 @@
+import json
+
+import pytest
+
+from ai_utils import (parse_plan, parse_plan_repair, split_fused_plan, split_reasoning, FUSED_OPTIMIZED_MARK,
+                      FUSED_STEPS_MARK, PLAN_MAX_STEPS)
+
+STEP_A = "收集城市交通的相关数据并整理成表格"
+STEP_B = "分析早晚高峰拥堵的主要原因和分布"
+STEP_C = "根据分析结果提出具体可行的治理建议"
+
+
+@pytest.mark.parametrize("response, plan_format", [
+    # 带步骤数的编号文本
+    (f"3\n1. {STEP_A}\n2. {STEP_B}\n3. {STEP_C}", "numbered"),
+    # 编号前有说明文字，编号写法不同
+    (f"好的，下面是规划：\n第1步：{STEP_A}\n步骤2、{STEP_B}\n(3) {STEP_C}", "numbered"),
+    # 带推理过程的编号文本
+    (f"<think>先想一想</think>\n共3步\n1、{STEP_A}\n2、{STEP_B}\n3、{STEP_C}", "numbered"),
+    # 列表符号
+    (f"步骤如下：\n- {STEP_A}\n* {STEP_B}\n• {STEP_C}", "lines"),
+    # 没有编号，每行一个步骤
+    (f"{STEP_A}\n{STEP_B}\n{STEP_C}", "lines"),
+    # JSON
+    (json.dumps({"steps": [{"prompt": STEP_A}, {"prompt": STEP_B}, {"prompt": STEP_C}]}, ensure_ascii=False), "json"),
+    # 代码块中的JSON数组
+    ("```json\n" + json.dumps([STEP_A, STEP_B, STEP_C], ensure_ascii=False) + "\n```", "json"),
+])
+def test_plan_formats(response, plan_format):
+    parsed = parse_plan(response)
+    assert parsed.format == plan_format
+    assert parsed.steps == [STEP_A, STEP_B, STEP_C]
+    assert parsed.missing == []
+
+
+@pytest.mark.parametrize("response, missing", [
+    # 缺少第2个编号
+    (f"3\n1. {STEP_A}\n3. {STEP_C}", [1]),
+    # 第2步过短
+    (f"1. {STEP_A}\n2. 分析\n3. {STEP_C}", [1]),
+    # 步骤数多于实际给出的行数
+    (f"3\n{STEP_A}\n{STEP_B}", [2]),
+    # JSON中的步骤为空
+    (json.dumps([{"prompt": STEP_A}, {"prompt": ""}, {"prompt": STEP_C}], ensure_ascii=False), [1]),
+])
+def test_broken_steps_are_marked_missing(response, missing):
+    warnings = []
+    parsed = parse_plan(response, on_event=lambda event, data: event == "warning" and warnings.append(data["message"]))
+    assert parsed.missing == missing
+    assert warnings
+
+
+def test_truncated_json_keeps_complete_steps():
+    warnings = []
+    parsed = parse_plan(f'[{{"prompt": "{STEP_A}"}}, {{"prompt": "{STEP_B}"}}, {{"prompt": "根据',
+                        on_event=lambda event, data: event == "warning" and warnings.append(data["message"]))
+    assert parsed.format == "json"
+    assert parsed.steps == [STEP_A, STEP_B]
+    assert 2 in parsed.problems
+    assert len(warnings) == 1
+
+
+def test_wrapped_lines_join_the_numbered_step():
+    parsed = parse_plan(f"1. {STEP_A}\n2. 分析早晚高峰拥堵\n的主要原因和分布\n\n3. {STEP_C}")
+    assert parsed.steps == [STEP_A, "分析早晚高峰拥堵 的主要原因和分布", STEP_C]
+
+
+def test_dependencies():
+    parsed = parse_plan(f"1. {STEP_A} [依赖 无]\n2. {STEP_B} [依赖 1]\n3. {STEP_C}【依赖：1、2】", with_dependencies=True)
+    assert parsed.steps == [STEP_A, STEP_B, STEP_C]
+    assert parsed.dependencies == [[], [0], [0, 1]]
+
+    response = json.dumps([{"prompt": STEP_A, "depends_on": []}, {"prompt": STEP_B, "depends_on": [1]},
+                           {"prompt": STEP_C}], ensure_ascii=False)
+    assert parse_plan(response, with_dependencies=True).dependencies == [[], [0], None]
+
+
+def test_usable_renumbers_dependencies_around_missing_steps():
+    parsed = parse_plan(f"1. {STEP_A} [依赖 无]\n2. 分析\n3. {STEP_C} [依赖 1 2]", with_dependencies=True)
+    assert parsed.usable() == ([STEP_A, STEP_C], [[], [0]])
+
+
+def test_duplicate_numbers_are_merged_into_previous_step():
+    parsed = parse_plan(f"1. {STEP_A}\n2. {STEP_B}\n1. 注意高峰时段\n3. {STEP_C}")
+    assert parsed.steps == [STEP_A, f"{STEP_B} 1. 注意高峰时段", STEP_C]
+
+
+def test_step_count_is_capped():
+    response = "\n".join(f"{n}. 第{n}个步骤的详细任务描述内容" for n in range(1, PLAN_MAX_STEPS + 6))
+    warnings = []
+    parsed = parse_plan(response, on_event=lambda event, data: event == "warning" and warnings.append(data["message"]))
+    assert len(parsed.steps) == PLAN_MAX_STEPS
+    assert any(str(PLAN_MAX_STEPS) in message for message in warnings)
+
+
+@pytest.mark.parametrize("response, expected", [
+    # 按index补写，多余和无效的条目被忽略
+    (json.dumps([{"index": 4, "prompt": STEP_C}, {"index": 2, "prompt": STEP_B, "depends_on": [1]},
+                 {"index": 5, "prompt": "过短"}], ensure_ascii=False),
+     {1: (STEP_B, [0]), 3: (STEP_C, None)}),
+    # 没有index时按顺序填入
+    ("```json\n" + json.dumps([STEP_B, STEP_C], ensure_ascii=False) + "\n```", {1: (STEP_B, None), 3: (STEP_C, None)}),
+    ("", {}),
+    ("无法补写", {}),
+])
+def test_parse_plan_repair(response, expected):
+    assert parse_plan_repair(response, [1, 3]) == expected
+
+
+def test_split_fused_plan():
+    response = f"<think>推理</think>\n{FUSED_OPTIMIZED_MARK}\n优化后的任务\n{FUSED_STEPS_MARK}\n1. {STEP_A}"
+    optimized_prompt, plan_text = split_fused_plan(response)
+    assert optimized_prompt == "优化后的任务"
+    assert plan_text == f"<think>推理</think>\n1. {STEP_A}"
+    # 没有标记时原样返回
+    assert split_fused_plan(f"1. {STEP_A}") == (None, f"1. {STEP_A}")
+
+
+@pytest.mark.parametrize("text, expected", [
+    # 没有推理标记
+    ("直接的回答", ("", "直接的回答")),
+    ("", ("", "")),
+    ("<think>先想一想</think>\n正式回答", ("先想一想", "正式回答")),
+    # 缺少开头的<think>
+    ("先想一想\n</think>\n\n正式回答", ("先想一想", "正式回答")),
+    # 被截断在思考过程中
+    ("<think>想到一半", ("想到一半", "")),
+    ("  \n<think>\n想到一半", ("想到一半", "")),
+    # 多个</think>时正式回答在最后一个之后
+    ("<think>第一段</think>中间<think>第二段</think>正式回答", ("第一段</think>中间第二段", "正式回答")),
+])
+def test_split_reasoning(text, expected):
+    assert split_reasoning(text) == expected
+
+
+@pytest.mark.parametrize("response, expected", [
+    # 缺少开头的<think>时推理过程仍然会保留下来
+    (f"推理\n</think>\n{FUSED_OPTIMIZED_MARK}任务\n{FUSED_STEPS_MARK}\n1. {STEP_A}",
+     ("任务", f"<think>推理</think>\n1. {STEP_A}")),
+    # 推理过程中提到的标记不算
+    (f"<think>先写{FUSED_OPTIMIZED_MARK}再写{FUSED_STEPS_MARK}</think>\n1. {STEP_A}",
+     (None, f"<think>先写{FUSED_OPTIMIZED_MARK}再写{FUSED_STEPS_MARK}</think>\n1. {STEP_A}")),
+    # 被截断在思考过程中
+    (f"<think>{FUSED_OPTIMIZED_MARK}任务", (None, f"<think>{FUSED_OPTIMIZED_MARK}任务")),
+    # 只有优化后的指令、没有步骤标记
+    (f"{FUSED_OPTIMIZED_MARK}任务\n1. {STEP_A}", (None, f"{FUSED_OPTIMIZED_MARK}任务\n1. {STEP_A}")),
+    # 优化后的指令为空
+    (f"{FUSED_OPTIMIZED_MARK}\n{FUSED_STEPS_MARK}\n1. {STEP_A}", (None, f"1. {STEP_A}")),
+])
+def test_split_fused_plan_reasoning(response, expected):
+    assert split_fused_plan(response) == expected
@@ -0,0 +1,79 @@
+import pytest
+
+import response_cache
+from response_cache import ResponseCache, cache_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(response_cache, "time", clock)
+    return clock
+
+
+def payload(content, **params):
+    return {"model": "Qwen/QwQ-32B", "messages": [{"role": "user", "content": content}], **params}
+
+
+def response(n):
+    return {"choices": [{"message": {"content": f"回答{n}"}}]}
+
+
+def test_cache_key_covers_model_messages_and_sampling():
+    base = payload("问题", temperature=0.7, max_tokens=100)
+    assert cache_key(base) == cache_key(dict(base))
+    # stream只影响传输方式
+    assert cache_key(base) == cache_key({**base, "stream": True})
+    assert cache_key(base) != cache_key({**base, "model": "deepseek-ai/DeepSeek-V3"})
+    assert cache_key(base) != cache_key(payload("另一个问题", temperature=0.7, max_tokens=100))
+    assert cache_key(base) != cache_key({**base, "messages": [{"role": "system", "content": "问题"}]})
+    assert cache_key(base) != cache_key({**base, "temperature": 0.2})
+    assert cache_key(base) != cache_key({**base, "max_tokens": 200})
+    assert cache_key(base) != cache_key({**base, "top_p": 0.9})
+
+
+def test_get_returns_stored_response(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.db"))
+    assert cache.get(payload("问题")) is None
+    cache.put(payload("问题"), response(1))
+    assert cache.get(payload("问题")) == response(1)
+    assert cache.get(payload("问题", temperature=0.2)) is None
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.db"), ttl=60)
+    cache.put(payload("问题"), response(1))
+    clock.now += 59
+    assert cache.get(payload("问题")) == response(1)
+    clock.now += 2
+    assert cache.get(payload("问题")) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.db"), ttl=0)
+    cache.put(payload("问题1"), response(1))
+    entry_size = cache.stats()["bytes"]
+    # 最多放下三个大小相同的条目
+    cache.max_bytes = entry_size * 3
+    for n in (2, 3):
+        clock.now += 1
+        cache.put(payload(f"问题{n}"), response(n))
+    clock.now += 1
+    # 读取第一个条目后它变成最近使用的，超出容量时淘汰第二个
+    assert cache.get(payload("问题1")) == response(1)
+    clock.now += 1
+    cache.put(payload("问题4"), response(4))
+
+    assert cache.stats() == {"entries": 3, "bytes": entry_size * 3}
+    assert cache.get(payload("问题2")) is None
+    for n in (1, 3, 4):
+        assert cache.get(payload(f"问题{n}")) == response(n)
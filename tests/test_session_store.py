@@ -0,0 +1,85 @@
+import gc
+import os
+import time
+
+import pytest
+
+from session_store import BlobRef, SessionStore, SpilledDict, cleanup_expired_sessions
+
+
+def test_values_under_threshold_stay_in_memory(tmp_path):
+    store = SessionStore(str(tmp_path), threshold=100)
+    assert store.put("短文本") == "短文本"
+    assert store.put({"a": 1}) == {"a": 1}
+    assert store.put(None) is None
+    assert store.usage() == {"files": 0, "bytes": 0}
+
+
+def test_values_over_threshold_are_spilled_and_read_back(tmp_path):
+    store = SessionStore(str(tmp_path), threshold=100)
+    text = "很长的文档内容" * 50
+    ref = store.put(text)
+    assert isinstance(ref, BlobRef)
+    assert ref.size == len(text.encode("utf-8"))
+    assert store.get(ref) == text
+    data = {"choices": [{"message": {"content": text}}]}
+    json_ref = store.put(data)
+    assert isinstance(json_ref, BlobRef)
+    assert store.get(json_ref) == data
+    # 相同的内容只写一次
+    assert store.put(text).path == ref.path
+    assert store.usage()["files"] == 2
+
+
+def test_spilled_dict_keeps_only_references(tmp_path):
+    store = SessionStore(str(tmp_path), threshold=100)
+    results = SpilledDict(store, {0: "短", 1: "长" * 200})
+    assert isinstance(results.refs()[1], BlobRef)
+    assert results[0] == "短"
+    assert results[1] == "长" * 200
+    assert 1 in results and len(results) == 2
+    del results[1]
+    assert list(results) == [0]
+
+
+def test_clear_keeps_values_still_in_use(tmp_path):
+    store = SessionStore(str(tmp_path), threshold=10)
+    kept = store.put("保留的内容" * 10)
+    dropped = store.put("删除的内容" * 10)
+    store.clear(keep=[kept, "不是引用"])
+    assert store.get(kept) == "保留的内容" * 10
+    with pytest.raises(FileNotFoundError):
+        dropped.read()
+    store.clear()
+    assert store.usage()["files"] == 0
+
+
+def test_close_and_finalize_remove_the_session_dir(tmp_path):
+    store = SessionStore(str(tmp_path), threshold=10, session_id="closed")
+    store.put("内容" * 20)
+    store.close()
+    assert not os.path.exists(tmp_path / "closed")
+
+    store = SessionStore(str(tmp_path), threshold=10, session_id="collected")
+    store.put("内容" * 20)
+    assert os.path.isdir(tmp_path / "collected")
+    # 会话对象被回收时目录随之删除
+    del store
+    gc.collect()
+    assert not os.path.exists(tmp_path / "collected")
+
+
+def test_cleanup_removes_only_expired_sessions(tmp_path):
+    stale = SessionStore(str(tmp_path), threshold=10, session_id="stale")
+    stale_ref = stale.put("旧会话的内容" * 10)
+    fresh = SessionStore(str(tmp_path), threshold=10, session_id="fresh")
+    fresh.put("新会话的内容" * 10)
+    old = time.time() - 7200
+    for path in (stale_ref.path, stale.path):
+        os.utime(path, (old, old))
+    assert cleanup_expired_sessions(str(tmp_path), ttl=3600) == 1
+    assert not os.path.exists(stale.path)
+    assert os.path.isdir(fresh.path)
+    # ttl为0时不清理
+    assert cleanup_expired_sessions(str(tmp_path), ttl=0) == 0
+    assert cleanup_expired_sessions(str(tmp_path / "missing"), ttl=3600) == 0
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import ai_utils
+
+
+class FakeStreamResponse:
+    """按顺序返回预先准备好的SSE行，可以在某一行之前停顿"""
+
+    def __init__(self, lines, delays=None):
+        self.lines = lines
+        self.delays = delays or {}
+        self.closed = threading.Event()
+
+    def iter_lines(self):
+        for i, line in enumerate(self.lines):
+            if i in self.delays:
+                time.sleep(self.delays[i])
+            if self.closed.is_set():
+                return
+            yield line.encode("utf-8")
+
+    def close(self):
+        self.closed.set()
+
+
+def sse(chunk):
+    return "data: " + json.dumps(chunk, ensure_ascii=False)
+
+
+def delta(content=None, reasoning=None, finish_reason=None):
+    return sse({"choices": [{"index": 0, "delta": {"content": content, "reasoning_content": reasoning},
+                             "finish_reason": finish_reason}]})
+
+
+def collect(response, **kwargs):
+    async def run():
+        return await ai_utils._acollect_stream(response, ai_utils._CallControl(), **kwargs)
+    return asyncio.run(run())
+
+
+def test_stream_is_assembled_like_a_normal_response():
+    lines = [
+        ": keep-alive",
+        delta(reasoning="先想"),
+        "",
+        delta(reasoning="一想"),
+        "event: message",
+        delta(content="你好"),
+        "data: {残缺的数据",
+        delta(content="，世界", finish_reason="stop"),
+        sse({"choices": [], "usage": {"prompt_tokens": 10, "completion_tokens": 4, "total_tokens": 14}}),
+        "data: [DONE]",
+        delta(content="结束之后的内容"),
+    ]
+    response = FakeStreamResponse(lines)
+    data = collect(response)
+    message = data["choices"][0]["message"]
+    assert message == {"role": "assistant", "content": "你好，世界", "reasoning_content": "先想一想"}
+    assert data["choices"][0]["finish_reason"] == "stop"
+    assert data["usage"]["total_tokens"] == 14
+    assert response.closed.is_set()
+
+
+def test_ttft_is_measured_from_the_request():
+    response = FakeStreamResponse([delta(content=""), delta(content="第一个字"), delta(content="。")], delays={1: 0.3})
+    started_at = time.time()
+    data = collect(response, started_at=started_at)
+    # 空的数据块不算首字
+    assert 0.3 <= data["ttft"] < 2
+    assert data["choices"][0]["message"]["content"] == "第一个字。"
+
+
+def test_empty_stream_has_no_ttft():
+    data = collect(FakeStreamResponse(["data: [DONE]"]))
+    assert data["ttft"] is None
+    assert data["choices"][0]["message"] == {"role": "assistant", "content": ""}
+
+
+def test_on_delta_receives_the_final_text():
+    updates = []
+    collect(FakeStreamResponse([delta(content="一"), delta(content="二")]),
+            on_delta=lambda content, reasoning, done: updates.append((content, done)))
+    assert updates[-1] == ("一二", True)
+
+
+def test_cancelled_stream_closes_the_response():
+    cancel_event = threading.Event()
+    response = FakeStreamResponse([delta(content="一"), delta(content="二")], delays={1: 5})
+    threading.Timer(0.2, cancel_event.set).start()
+
+    async def run():
+        return await ai_utils._acollect_stream(response, ai_utils._CallControl(cancel_event))
+
+    started = time.monotonic()
+    with pytest.raises(ai_utils._CallAborted):
+        asyncio.run(run())
+    assert time.monotonic() - started < 2
+    assert response.closed.is_set()
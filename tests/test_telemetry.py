@@ -0,0 +1,73 @@
+import json
+
+from telemetry import cached_call_record, new_call_record, to_jsonl, to_prometheus
+
+PAYLOAD = {"model": "Qwen/QwQ-32B", "messages": [{"role": "user", "content": "测试"}], "stream": True}
+RESPONSE = {"choices": [{"message": {"content": "回答"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 40, "total_tokens": 140,
+                      "prompt_tokens_details": {"cached_tokens": 60}}}
+
+
+def make_record(call_id, status="ok", latency=1.5, ttft=0.5, **fields):
+    record = new_call_record(call_id, f"步骤 {call_id}", PAYLOAD)
+    record.update({"status": status, "latency": latency, "ttft": ttft, "key_index": 0, "attempts": 1, **fields})
+    return record
+
+
+def records():
+    return [
+        make_record(1, prompt_tokens=100, completion_tokens=40, cached_tokens=60, tokens_per_sec=20.0),
+        make_record(2, latency=7.0, ttft=None, attempts=3, retries=2, backoff=4.0, queue_wait=0.5, hedged=True,
+                    hedge_won=True, prompt_tokens=50, completion_tokens=10, tokens_per_sec=40.0),
+        make_record(3, status="failed", latency=3.0, retries=1, key_index=1, error='HTTP 500 "bad"'),
+        cached_call_record(4, "步骤 4", PAYLOAD, RESPONSE),
+    ]
+
+
+def test_jsonl_has_one_record_per_line():
+    lines = to_jsonl(records()).splitlines()
+    assert len(lines) == 4
+    parsed = [json.loads(line) for line in lines]
+    assert [record["call_id"] for record in parsed] == [1, 2, 3, 4]
+    assert parsed[0]["step"] == "步骤 1"
+    assert parsed[3]["status"] == "cached"
+    assert to_jsonl([]) == ""
+
+
+def test_prometheus_text():
+    text = to_prometheus(records())
+    lines = text.splitlines()
+    assert text.endswith("\n")
+    samples = dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+    model = 'model="Qwen/QwQ-32B"'
+    assert samples[f'aigent_calls_total{{{model},key="1",status="ok"}}'] == "2"
+    assert samples[f'aigent_calls_total{{{model},key="2",status="failed"}}'] == "1"
+    assert samples[f'aigent_calls_total{{{model},key="",status="cached"}}'] == "1"
+    # 命中响应缓存的调用不计入令牌用量
+    assert samples[f'aigent_tokens_total{{{model},kind="prompt"}}'] == "150"
+    assert samples[f'aigent_tokens_total{{{model},kind="completion"}}'] == "50"
+    assert samples[f'aigent_tokens_total{{{model},kind="cached"}}'] == "60"
+    assert samples[f'aigent_retries_total{{{model}}}'] == "3"
+    assert samples[f'aigent_backoff_seconds_total{{{model}}}'] == "4"
+    assert samples[f'aigent_hedges_total{{{model}}}'] == "1"
+    assert samples[f'aigent_hedge_wins_total{{{model}}}'] == "1"
+    # 只统计成功调用的耗时
+    assert samples[f'aigent_call_latency_seconds_bucket{{{model},le="1"}}'] == "0"
+    assert samples[f'aigent_call_latency_seconds_bucket{{{model},le="2"}}'] == "1"
+    assert samples[f'aigent_call_latency_seconds_bucket{{{model},le="10"}}'] == "2"
+    assert samples[f'aigent_call_latency_seconds_bucket{{{model},le="+Inf"}}'] == "2"
+    assert samples[f'aigent_call_latency_seconds_sum{{{model}}}'] == "8.5"
+    assert samples[f'aigent_call_latency_seconds_count{{{model}}}'] == "2"
+    assert samples[f'aigent_ttft_seconds_sum{{{model}}}'] == "0.5"
+    assert samples[f'aigent_ttft_seconds_count{{{model}}}'] == "1"
+    assert samples[f'aigent_tokens_per_second{{{model}}}'] == "30"
+    assert "# TYPE aigent_call_latency_seconds histogram" in lines
+    assert "# TYPE aigent_calls_total counter" in lines
+
+
+def test_prometheus_escapes_labels_and_uses_prefix():
+    record = make_record(1)
+    record["model"] = 'a"b\\c'
+    text = to_prometheus([record], prefix="chain")
+    assert 'chain_calls_total{model="a\\"b\\\\c",key="1",status="ok"} 1' in text.splitlines()
+    assert "aigent_" not in text
@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+
+import pytest
+import requests
+
+import ai_utils
+import http_client
+from chain_runner import ChainConfig, ChainRunner
+from key_pool import KeyPool
+from mock_server import MockConfig, MockServer
+
+PAYLOAD = {"model": "Qwen/QwQ-32B", "messages": [{"role": "user", "content": "测试"}], "max_tokens": 64}
+
+
+@pytest.fixture
+def stalled_server(monkeypatch):
+    # 收到请求后很久才响应的上游
+    with MockServer(MockConfig(latency="fixed:30")) as server:
+        monkeypatch.setattr(ai_utils, "API_URL", server.url)
+        yield server
+
+
+def test_abort_closes_the_connection_of_a_running_post(stalled_server):
+    handle = http_client.RequestHandle()
+    threading.Timer(0.3, handle.abort).start()
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http_client.post(stalled_server.url, handle=handle, json=PAYLOAD, timeout=30)
+    assert time.monotonic() - started < 5
+
+
+def test_aborted_handle_does_not_send():
+    handle = http_client.RequestHandle()
+    handle.abort()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http_client.post("http://127.0.0.1:9/never", handle=handle, timeout=5)
+
+
+def test_cancelled_call_releases_its_thread_slot_and_key(stalled_server):
+    pool = KeyPool(["transport-test-key"])
+    cancel_event = threading.Event()
+    threading.Timer(0.3, cancel_event.set).start()
+    started = time.monotonic()
+    result = ai_utils.chat_completion(PAYLOAD, pool, timeout=30, cancel_event=cancel_event, adaptive_timeout=False)
+    assert result is None
+    assert time.monotonic() - started < 5
+    # 名额立即归还，发送线程在连接被关闭后很快结束
+    assert ai_utils._in_flight._value == ai_utils.MAX_IN_FLIGHT_REQUESTS
+    deadline = time.monotonic() + 5
+    while any(t.name == "aigent-request" for t in threading.enumerate()) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not any(t.name == "aigent-request" for t in threading.enumerate())
+    assert pool.snapshot()[0]["in_flight"] == 0
+
+
+def test_calls_queue_when_in_flight_limit_is_reached(monkeypatch, stalled_server):
+    monkeypatch.setattr(ai_utils, "_in_flight", threading.BoundedSemaphore(1))
+    ai_utils._in_flight.acquire()
+    events = []
+    cancel_event = threading.Event()
+    threading.Timer(0.3, cancel_event.set).start()
+    result = ai_utils.chat_completion(PAYLOAD, KeyPool(["transport-test-key"]), cancel_event=cancel_event,
+                                      on_event=lambda event, data: events.append(event))
+    assert result is None
+    assert "queued" in events
+    assert "call_start" not in events
+    ai_utils._in_flight.release()
+
+
+def test_async_calls_of_one_runner_run_concurrently(monkeypatch):
+    with MockServer(MockConfig(latency="fixed:0.5", stream_tps=0)) as server:
+        monkeypatch.setattr(ai_utils, "API_URL", server.url)
+        runner = ChainRunner(ChainConfig(api_keys=[f"async-test-{time.time_ns()}"], checkpoints=False,
+                                         adaptive_timeout=False))
+        runner.begin()
+
+        async def both():
+            return await asyncio.gather(runner.acall_model("第一个问题", step_name="步骤 1"),
+                                        runner.acall_model("第二个问题", step_name="步骤 2"))
+
+        started = time.monotonic()
+        answers = asyncio.run(both())
+        elapsed = time.monotonic() - started
+        assert all(answers)
+        # 两次调用各等待0.5秒，同时发出时总耗时远小于1秒
+        assert elapsed < 0.9
+        assert server.stats.snapshot()["requests"] == 2